@@ -1,10 +1,11 @@
+from utils.serializacion import codificar, decodificar, ErrorDecodificacion
+from utils.jwt_auth import usuario_existe_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from .models import Chat, Mensaje, obtener_o_crear_chat
 from django.contrib.auth.models import AnonymousUser
 from asgiref.sync import sync_to_async
 from django.utils.timezone import now
 from usuarios.models import Usuario
-import json
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -12,7 +13,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         # Obtengo usuario autenticado desde el middleware
         self.usuario = self.scope.get('usuario', AnonymousUser())
-        if isinstance(self.usuario, AnonymousUser):
+        if isinstance(self.usuario, AnonymousUser) or not await usuario_existe_async(self.usuario):
             await self.close(code=403)
             return
 
@@ -40,11 +41,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            data = decodificar(text_data)
             contenido = data.get('contenido', '').strip()
 
             if not contenido:
-                await self.send(text_data=json.dumps({'error': 'El mensaje no puede estar vacío'}))
+                await self.send(text_data=codificar({'error': 'El mensaje no puede estar vacío'}))
                 return
             
             mensaje = await sync_to_async(Mensaje.objects.create)(
@@ -54,19 +55,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 fecha_envio=now()
             )
             
+            # Se codifica una vez para todos los miembros del grupo
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
-                    'emisor': self.usuario.id,
-                    'contenido': mensaje.contenido,
-                    'fecha_envio': mensaje.fecha_envio.strftime('%Y-%m-%d %H:%M:%S')
+                    'texto': codificar({
+                        'type': 'chat_message',
+                        'emisor': self.usuario.id,
+                        'contenido': mensaje.contenido,
+                        'fecha_envio': mensaje.fecha_envio.strftime('%Y-%m-%d %H:%M:%S')
+                    })
                 }
             )
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({'error': 'Formato de mensaje inválido'}))
+        except ErrorDecodificacion:
+            await self.send(text_data=codificar({'error': 'Formato de mensaje inválido'}))
         except Usuario.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'Receptor no encontrado'}))            
+            await self.send(text_data=codificar({'error': 'Receptor no encontrado'}))            
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
\ No newline at end of file
+        if 'texto' in event:
+            await self.send(text_data=event['texto'])
+            return
+        await self.send(text_data=codificar(event))
\ No newline at end of file
@@ -1,10 +1,11 @@
-import json
 from django.contrib.auth.models import AnonymousUser
 from channels.generic.websocket import AsyncWebsocketConsumer
 from chat_partida.models import MensajePartida, Chat_partida as Chat
 from usuarios.models import Usuario
 from asgiref.sync import sync_to_async
 from django.utils.timezone import now
+from utils.serializacion import codificar, decodificar, ErrorDecodificacion
+from utils.jwt_auth import usuario_existe_async
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -14,20 +15,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.usuario = self.scope.get('usuario', AnonymousUser())
         self.chat_id = self.scope['url_route']['kwargs'].get('chat_id')
 
-        if not self.chat_id or isinstance(self.usuario, AnonymousUser):
-            await self.close(code=403)
-            return
+        if not self.chat_id or isinstance(self.usuario, AnonymousUser) or \
+            not await usuario_existe_async(self.usuario):
+                await self.close(code=403)
+                return
 
         # Cargar el chat
         self.chat = await sync_to_async(self.get_chat)()
         if not self.chat:
-            await self.send(text_data=json.dumps({'error': 'Chat no encontrado'}))
+            await self.send(text_data=codificar({'error': 'Chat no encontrado'}))
             await self.close(code=404)
             return
 
         ok = await sync_to_async(self.chat.add_participant)(self.usuario)
         if not ok:
-            await self.send(text_data=json.dumps({'error': 'No puedes unirte a este chat'}))
+            await self.send(text_data=codificar({'error': 'No puedes unirte a este chat'}))
             await self.close(code=403)
             return
 
@@ -47,11 +49,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Called when the WebSocket receives a message.
         """
         try:
-            data = json.loads(text_data)
+            data = decodificar(text_data)
             contenido = data.get('contenido', '').strip()
 
             if not contenido:
-                await self.send(text_data=json.dumps({'error': 'El mensaje no puede estar vacío'}))
+                await self.send(text_data=codificar({'error': 'El mensaje no puede estar vacío'}))
                 return
 
             mensaje = await sync_to_async(MensajePartida.objects.create)(
@@ -61,27 +63,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 fecha_envio=now()
             )
 
+            # Se codifica una vez para todos los miembros del grupo
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
-                    'emisor': {
-                        'id': self.usuario.id,
-                        'nombre': self.usuario.nombre
-                    },
-                    'contenido': mensaje.contenido,
-                    'fecha_envio': mensaje.fecha_envio.strftime('%Y-%m-%d %H:%M:%S')
+                    'texto': codificar({
+                        'type': 'chat_message',
+                        'emisor': {
+                            'id': self.usuario.id,
+                            'nombre': self.usuario.nombre
+                        },
+                        'contenido': mensaje.contenido,
+                        'fecha_envio': mensaje.fecha_envio.strftime('%Y-%m-%d %H:%M:%S')
+                    })
                 }
             )
         
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({'error': 'Formato de mensaje inválido'}))
+        except ErrorDecodificacion:
+            await self.send(text_data=codificar({'error': 'Formato de mensaje inválido'}))
     
     async def chat_message(self, event):
         """
         Send the message to the WebSocket.
         """
-        await self.send(text_data=json.dumps(event))
+        if 'texto' in event:
+            await self.send(text_data=event['texto'])
+            return
+        await self.send(text_data=codificar(event))
 
     def get_chat(self):
         try:
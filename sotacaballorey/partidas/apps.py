@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 class PartidasConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'partidas'
+
+    def ready(self):
+        # Señales que invalidan la caché de salas en espera del lobby
+        from . import lobby
+
+        # Partidas en curso y salas en espera que había antes de arrancar: se
+        # recuperan desde que arranca el servidor, sin esperar a ninguna conexión
+        if getattr(settings, 'RECUPERAR_PARTIDAS', True):
+            from .game.recuperacion import arrancar_con_el_servidor
+            arrancar_con_el_servidor()
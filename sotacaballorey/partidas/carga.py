@@ -0,0 +1,285 @@
+"""
+Generador de carga para /ws/partida/.
+
+Cada jugador simulado abre su conexión autenticada con token, entra en
+partida por emparejamiento (sin id_partida, como el front-end), sigue el
+estado de la partida a partir de los mensajes y juega una carta válida cada
+vez que recibe su turn_update. Se mide la latencia de conexión, el tiempo
+desde que se envía una carta hasta que llega su card_played y las conexiones
+que se caen antes de terminar la partida.
+
+Por defecto las conexiones se hacen dentro del proceso contra la aplicación
+ASGI (sin red); con una URL se conecta a un servidor real (daphne) y hace
+falta la librería websockets.
+"""
+from partidas.game.cartas import (
+    carta_a_int, int_a_carta, mascara, cartas_de, jugadas_validas, resolver_baza, PALO
+)
+from partidas.metricas import percentil
+import asyncio
+import random
+import time
+import json
+
+#-----------------------------------------------------------------------------------#
+# Conexiones                                                                        #
+#-----------------------------------------------------------------------------------#
+
+class ConexionLocal:
+    """Conexión dentro del proceso contra la aplicación ASGI"""
+
+    def __init__(self, application, ruta: str):
+        from channels.testing import WebsocketCommunicator
+        self.comm = WebsocketCommunicator(application, ruta)
+
+    async def conectar(self, timeout: float) -> bool:
+        conectado, _ = await self.comm.connect(timeout)
+        return conectado
+
+    async def enviar(self, texto: str):
+        await self.comm.send_to(text_data=texto)
+
+    async def recibir(self, timeout: float):
+        """Siguiente mensaje de texto (None si el servidor ha cerrado)"""
+        # No se usa receive_output(): al vencer su timeout cancela la aplicación
+        # sin pasar por disconnect() y el jugador se quedaría en la partida
+        salida = await asyncio.wait_for(self.comm.output_queue.get(), timeout)
+        if salida['type'] == 'websocket.close':
+            return None
+        return salida.get('text')
+
+    async def cerrar(self):
+        # Si la aplicación ya terminó (o se canceló por timeout) no hay nada que cerrar
+        try:
+            await self.comm.disconnect()
+        except (Exception, asyncio.CancelledError):
+            pass
+
+class ConexionRemota:
+    """Conexión real a un servidor con la librería websockets"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ws = None
+
+    async def conectar(self, timeout: float) -> bool:
+        import websockets
+        try:
+            self.ws = await asyncio.wait_for(websockets.connect(self.url), timeout)
+        except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+            return False
+        return True
+
+    async def enviar(self, texto: str):
+        await self.ws.send(texto)
+
+    async def recibir(self, timeout: float):
+        import websockets
+        try:
+            return await asyncio.wait_for(self.ws.recv(), timeout)
+        except websockets.exceptions.ConnectionClosed:
+            return None
+
+    async def cerrar(self):
+        if self.ws:
+            await self.ws.close()
+
+#-----------------------------------------------------------------------------------#
+# Métricas                                                                          #
+#-----------------------------------------------------------------------------------#
+
+class MetricasCarga:
+    """Resultados de una prueba de carga"""
+
+    def __init__(self):
+        self.latencias_conexion = []    # s
+        self.latencias_jugada = []      # s (envío de la carta -> card_played)
+        self.rechazadas = 0             # Conexiones que el servidor no acepta
+        self.caidas = 0                 # Cerradas antes de acabar la partida
+        self.sin_partida = 0            # Nunca recibieron start_game
+        self.terminadas = 0             # Jugadores que llegaron a end_game
+        self.errores = 0                # Mensajes de error del servidor
+        self.mensajes = 0
+        self.conectados = 0
+        self.max_conectados = 0
+        self.duracion = 0.0
+
+    def resumen(self) -> dict:
+        def ms(valores, p):
+            valor = percentil(valores, p)
+            return None if valor is None else valor * 1000
+        return {
+            'duracion_s': self.duracion,
+            'max_conectados': self.max_conectados,
+            'terminadas': self.terminadas,
+            'rechazadas': self.rechazadas,
+            'caidas': self.caidas,
+            'sin_partida': self.sin_partida,
+            'errores': self.errores,
+            'mensajes': self.mensajes,
+            'mensajes_por_segundo': self.mensajes / self.duracion if self.duracion else 0.0,
+            'jugadas': len(self.latencias_jugada),
+            'conexion_p50_ms': ms(self.latencias_conexion, 50),
+            'conexion_p99_ms': ms(self.latencias_conexion, 99),
+            'jugada_p50_ms': ms(self.latencias_jugada, 50),
+            'jugada_p95_ms': ms(self.latencias_jugada, 95),
+            'jugada_p99_ms': ms(self.latencias_jugada, 99),
+            'jugada_max_ms': ms(self.latencias_jugada, 100),
+        }
+
+#-----------------------------------------------------------------------------------#
+# Jugador simulado                                                                  #
+#-----------------------------------------------------------------------------------#
+
+class JugadorSimulado:
+    """Cliente que juega una partida completa con cartas válidas aleatorias"""
+
+    def __init__(self, usuario_id: int, conexion, capacidad: int, rng: random.Random, metricas: MetricasCarga):
+        self.usuario_id = usuario_id
+        self.conexion = conexion
+        self.capacidad = capacidad
+        self.rng = rng
+        self.metricas = metricas
+
+        self.mano = set()
+        self.baza = []              # [(usuario_id, carta), ...]
+        self.equipos = {}           # usuario_id -> equipo
+        self.triunfo = None
+        self.fase_arrastre = False
+        self.empezada = False
+        self.terminada = False
+        self.enviada = None         # (carta, instante de envío)
+        self.rechazadas = set()
+
+    async def jugar(self, timeout: float):
+        """Conecta y juega hasta el final de la partida o hasta que se cae"""
+        m = self.metricas
+        inicio = time.perf_counter()
+        try:
+            if not await self.conexion.conectar(timeout):
+                m.rechazadas += 1
+                return
+        except Exception:
+            m.rechazadas += 1
+            return
+        m.latencias_conexion.append(time.perf_counter() - inicio)
+        m.conectados += 1
+        m.max_conectados = max(m.max_conectados, m.conectados)
+
+        try:
+            while not self.terminada:
+                texto = await self.conexion.recibir(timeout)
+                if texto is None:
+                    break
+                m.mensajes += 1
+                mensaje = json.loads(texto)
+                await self.procesar(mensaje.get('type'), mensaje.get('data') or {})
+        except (asyncio.TimeoutError, TimeoutError):
+            pass
+        except Exception as e:
+            print(f"Error en el jugador simulado {self.usuario_id}: {e!r}")
+        finally:
+            m.conectados -= 1
+            if self.terminada:
+                m.terminadas += 1
+            elif not self.empezada:
+                m.sin_partida += 1
+            else:
+                m.caidas += 1
+            await self.conexion.cerrar()
+
+    async def procesar(self, tipo: str, data: dict):
+        """Actualiza lo que sabe el cliente de la partida y juega si le toca"""
+        if tipo == 'start_game':
+            self.empezada = True
+            self.mano = {carta_a_int(c) for c in data['mis_cartas']}
+            self.triunfo = PALO[carta_a_int(data['carta_triunfo'])]
+            self.fase_arrastre = data['fase_arrastre']
+            self.equipos = {j['id']: j['equipo'] for j in data['jugadores']}
+            self.baza = [
+                (j['id'], carta_a_int(j['carta_jugada']))
+                for j in data['jugadores'] if j.get('carta_jugada')
+            ]
+
+        elif tipo == 'card_drawn':
+            self.mano.add(carta_a_int(data['carta']))
+
+        elif tipo == 'card_played':
+            jugador_id = data['jugador']['id']
+            carta = carta_a_int(data['carta'])
+            self.baza.append((jugador_id, carta))
+            if jugador_id == self.usuario_id:
+                self.mano.discard(carta)
+                if self.enviada and self.enviada[0] == carta:
+                    self.metricas.latencias_jugada.append(time.perf_counter() - self.enviada[1])
+                self.enviada = None
+
+        elif tipo == 'round_result':
+            self.baza = []
+
+        elif tipo == 'phase_update':
+            self.fase_arrastre = True
+
+        elif tipo == 'turn_update':
+            if data['jugador']['id'] == self.usuario_id:
+                self.rechazadas = set()
+                await self.jugar_carta()
+
+        elif tipo == 'error':
+            self.metricas.errores += 1
+            if self.enviada:
+                # El servidor no ha aceptado la carta: se prueba con otra
+                self.rechazadas.add(self.enviada[0])
+                self.enviada = None
+                await self.jugar_carta()
+
+        elif tipo == 'end_game':
+            self.terminada = True
+
+    def cartas_validas(self) -> set:
+        """Cartas que se pueden jugar según lo que ha visto el cliente"""
+        if not self.fase_arrastre or not self.baza:
+            return self.mano
+        cartas = [c for _, c in self.baza]
+        companero_gana = False
+        if self.capacidad == 4:
+            mejor = self.baza[resolver_baza(cartas, self.triunfo)[0]][0]
+            companero_gana = mejor != self.usuario_id and \
+                self.equipos.get(mejor) == self.equipos.get(self.usuario_id)
+        return set(cartas_de(jugadas_validas(mascara(self.mano), cartas, self.triunfo, companero_gana)))
+
+    async def jugar_carta(self):
+        candidatas = (self.cartas_validas() - self.rechazadas) or (self.mano - self.rechazadas)
+        if not candidatas:
+            return
+        carta = self.rng.choice(sorted(candidatas))
+        self.enviada = (carta, time.perf_counter())
+        await self.conexion.enviar(json.dumps({'accion': 'jugar_carta', 'carta': int_a_carta(carta)}))
+
+#-----------------------------------------------------------------------------------#
+# Ejecución                                                                         #
+#-----------------------------------------------------------------------------------#
+
+async def ejecutar_carga(jugadores: list, capacidad: int, crear_conexion, intervalo: float = 0.0,
+                         timeout: float = 60.0, semilla: int = 0) -> MetricasCarga:
+    """
+    Lanza un jugador simulado por cada (usuario_id, token) de <jugadores>,
+    separados <intervalo> segundos, y espera a que terminen todos.
+    <crear_conexion> recibe la ruta con el token y devuelve la conexión
+    """
+    metricas = MetricasCarga()
+    rng = random.Random(semilla)
+    tareas = []
+
+    inicio = time.perf_counter()
+    for usuario_id, token in jugadores:
+        ruta = f'/ws/partida/?token={token}&capacidad={capacidad}'
+        jugador = JugadorSimulado(usuario_id, crear_conexion(ruta), capacidad,
+                                  random.Random(rng.getrandbits(32)), metricas)
+        tareas.append(asyncio.create_task(jugador.jugar(timeout)))
+        if intervalo:
+            await asyncio.sleep(intervalo)
+
+    await asyncio.gather(*tareas)
+    metricas.duracion = time.perf_counter() - inicio
+    return metricas
@@ -0,0 +1,123 @@
+"""
+Acceso a la base de datos desde los consumidores.
+
+Las consultas de los consumidores son funciones síncronas del ORM que se
+llaman con <consulta>, que es database_sync_to_async midiendo cuánto espera
+cada llamada al hilo de la base de datos (todas comparten uno por proceso) y
+cuánto tarda dentro. Antes y después de cada llamada Django revisa la
+conexión (cierra la vencida o rota y, con CONN_HEALTH_CHECKS, la comprueba en
+la siguiente consulta). Por eso no se usa el ORM asíncrono (aget, acount...):
+va al mismo hilo, pero sin esa revisión, y podría reutilizar una conexión
+vencida o caída.
+
+Las sentencias SQL que se ejecutan mientras se atiende una acción de un
+jugador se cuentan por acción (<contar_consultas>): cada conexión lleva un
+execute_wrapper que las suma al contador de la acción en curso, que pasa al
+hilo de la base de datos con el contexto de la tarea. Los volcados en segundo
+plano (sala.py) no cuentan para la acción que los lanza (<sin_contar>)
+"""
+from partidas.metricas import registrar_metricas, percentil
+from django.db.backends.signals import connection_created
+from channels.db import database_sync_to_async
+from django.conf import settings
+from contextvars import ContextVar
+from collections import deque
+import contextlib
+import functools
+import time
+
+class MetricasBD:
+    """Llamadas al hilo de la base de datos y conexiones"""
+
+    def __init__(self, muestras: int = 1000):
+        self.llamadas = 0
+        self.en_curso = 0
+        self.max_en_curso = 0
+        self.conexiones = 0
+        self._esperas = deque(maxlen=muestras)
+        self._duraciones = deque(maxlen=muestras)
+        self._acciones = {}     # acción -> [veces, consultas]
+
+    def metricas(self) -> dict:
+        """Esperas y duraciones (ms) de las llamadas, conexiones abiertas y consultas por acción"""
+        esperas = [e * 1000 for e in self._esperas]
+        duraciones = [d * 1000 for d in self._duraciones]
+        db = settings.DATABASES['default']
+        return {
+            'llamadas': self.llamadas,
+            'en_curso': self.en_curso,
+            'max_en_curso': self.max_en_curso,
+            'espera_p50_ms': percentil(esperas, 50),
+            'espera_p99_ms': percentil(esperas, 99),
+            'duracion_p50_ms': percentil(duraciones, 50),
+            'duracion_p99_ms': percentil(duraciones, 99),
+            'conexiones_abiertas': self.conexiones,
+            'conn_max_age': db.get('CONN_MAX_AGE', 0),
+            'pool': 'pool' in db.get('OPTIONS', {}),
+            'consultas_por_accion': {
+                accion: {'veces': veces, 'consultas': consultas, 'media': consultas / veces}
+                for accion, (veces, consultas) in self._acciones.items()
+            },
+        }
+
+    def anotar_accion(self, accion: str, consultas: int):
+        veces_consultas = self._acciones.setdefault(accion, [0, 0])
+        veces_consultas[0] += 1
+        veces_consultas[1] += consultas
+
+# Métricas únicas del proceso
+bd = MetricasBD()
+registrar_metricas('base_de_datos', bd.metricas)
+
+# Contador de la acción que se está atendiendo (propio de cada tarea)
+_consultas_accion = ContextVar('consultas_accion', default=None)
+
+def _contar_sql(execute, sql, params, many, context):
+    contador = _consultas_accion.get()
+    if contador is not None:
+        contador[0] += 1
+    return execute(sql, params, many, context)
+
+def _conexion_creada(sender, connection, **kwargs):
+    bd.conexiones += 1
+    if _contar_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_contar_sql)
+
+connection_created.connect(_conexion_creada, dispatch_uid='partidas_conexiones')
+
+@contextlib.contextmanager
+def contar_consultas(accion: str):
+    """Cuenta las sentencias SQL ejecutadas dentro del bloque y las anota para <accion>"""
+    contador = [0]
+    token = _consultas_accion.set(contador)
+    try:
+        yield contador
+    finally:
+        _consultas_accion.reset(token)
+        bd.anotar_accion(accion, contador[0])
+
+def sin_contar():
+    """La tarea actual deja de contar sus consultas para la acción que la creó"""
+    _consultas_accion.set(None)
+
+def consulta(funcion):
+    """database_sync_to_async midiendo la espera al hilo y la duración"""
+    @database_sync_to_async
+    def en_hilo(encolada, *args, **kwargs):
+        empieza = time.perf_counter()
+        bd._esperas.append(empieza - encolada)
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            bd._duraciones.append(time.perf_counter() - empieza)
+
+    @functools.wraps(funcion)
+    async def llamada(*args, **kwargs):
+        bd.llamadas += 1
+        bd.en_curso += 1
+        bd.max_en_curso = max(bd.max_en_curso, bd.en_curso)
+        try:
+            return await en_hilo(time.perf_counter(), *args, **kwargs)
+        finally:
+            bd.en_curso -= 1
+    return llamada
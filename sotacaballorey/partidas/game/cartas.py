@@ -0,0 +1,139 @@
+"""
+Baraja española de 40 cartas codificada con enteros pequeños.
+
+Cada carta es palo * 10 + posición del valor en VALORES, de modo que
+0-9 son los Oros, 10-19 las Copas, etc. Una mano se representa como máscara
+de bits (bit n = carta n). Las tablas de fuerza, puntos y resolución de bazas
+se calculan una sola vez al importar el módulo; los diccionarios
+{'palo', 'valor'} solo se usan de cara al front-end y a la base de datos.
+"""
+
+PALOS = ('Oros', 'Copas', 'Espadas', 'Bastos')
+VALORES = (1, 2, 3, 4, 5, 6, 7, 10, 11, 12)
+NUM_CARTAS = len(PALOS) * len(VALORES)
+
+# Orden de fuerza de los valores (de mayor a menor) y puntos de cada valor
+ORDEN_FUERZA = (1, 3, 12, 10, 11, 7, 6, 5, 4, 2)
+PUNTOS_VALOR = {1: 11, 3: 10, 12: 4, 10: 3, 11: 2}
+
+_IDX_PALO = {p: i for i, p in enumerate(PALOS)}
+_IDX_VALOR = {v: i for i, v in enumerate(VALORES)}
+
+#-----------------------------------------------------------------------------------#
+# Tablas precalculadas (indexadas por carta)                                        #
+#-----------------------------------------------------------------------------------#
+
+PALO = tuple(c // len(VALORES) for c in range(NUM_CARTAS))
+VALOR = tuple(VALORES[c % len(VALORES)] for c in range(NUM_CARTAS))
+FUERZA = tuple(len(ORDEN_FUERZA) - ORDEN_FUERZA.index(VALOR[c]) for c in range(NUM_CARTAS))
+PUNTOS = tuple(PUNTOS_VALOR.get(VALOR[c], 0) for c in range(NUM_CARTAS))
+
+# Máscara con todas las cartas de cada palo
+MASCARA_PALO = tuple(
+    sum(1 << c for c in range(NUM_CARTAS) if PALO[c] == p) for p in range(len(PALOS)))
+
+# Máscara con las cartas del mismo palo que ganan a cada carta
+MAS_FUERTES = tuple(
+    sum(1 << o for o in range(NUM_CARTAS) if PALO[o] == PALO[c] and FUERZA[o] > FUERZA[c])
+    for c in range(NUM_CARTAS))
+
+def _rango(carta: int, palo_inicial: int, triunfo: int) -> int:
+    """Rango de una carta dentro de una baza: gana la de mayor rango"""
+    if PALO[carta] == triunfo:
+        return 200 + FUERZA[carta]
+    if PALO[carta] == palo_inicial:
+        return 100 + FUERZA[carta]
+    return 0
+
+# Rey y sota de cada palo (canto) y siete de cada palo (cambio del 7)
+CANTE = tuple(
+    (1 << (p * len(VALORES) + VALORES.index(12))) | (1 << (p * len(VALORES) + VALORES.index(10)))
+    for p in range(len(PALOS)))
+SIETE = tuple(p * len(VALORES) + VALORES.index(7) for p in range(len(PALOS)))
+
+# RANGO[triunfo][palo_inicial][carta]
+RANGO = tuple(
+    tuple(
+        tuple(_rango(c, inicial, triunfo) for c in range(NUM_CARTAS))
+        for inicial in range(len(PALOS)))
+    for triunfo in range(len(PALOS)))
+
+#-----------------------------------------------------------------------------------#
+# Conversión desde/hacia JSON                                                       #
+#-----------------------------------------------------------------------------------#
+
+def palo_a_int(palo: str) -> int:
+    """Índice de un palo"""
+    return _IDX_PALO[palo]
+
+def carta_a_int(carta: dict) -> int:
+    """Convierte {'palo': ..., 'valor': ...} en su entero (0-39)"""
+    return _IDX_PALO[carta['palo']] * len(VALORES) + _IDX_VALOR[int(carta['valor'])]
+
+def int_a_carta(carta: int) -> dict:
+    """Convierte un entero (0-39) en {'palo': ..., 'valor': ...}"""
+    return {'palo': PALOS[PALO[carta]], 'valor': VALOR[carta]}
+
+def mascara(cartas) -> int:
+    """Máscara de bits de una colección de cartas (enteros)"""
+    m = 0
+    for c in cartas:
+        m |= 1 << c
+    return m
+
+def cartas_de(mascara: int) -> list:
+    """Lista ordenada de las cartas (enteros) de una máscara"""
+    cartas = []
+    while mascara:
+        bajo = mascara & -mascara
+        cartas.append(bajo.bit_length() - 1)
+        mascara ^= bajo
+    return cartas
+
+#-----------------------------------------------------------------------------------#
+# Reglas                                                                            #
+#-----------------------------------------------------------------------------------#
+
+def comparar_cartas(actual: int, nueva: int, palo_inicial: int, triunfo: int) -> int:
+    """Devuelve la carta que gana entre la que va ganando la baza y una nueva"""
+    rangos = RANGO[triunfo][palo_inicial]
+    return nueva if rangos[nueva] > rangos[actual] else actual
+
+def resolver_baza(cartas: list, triunfo: int):
+    """
+    Devuelve (posición de la carta ganadora, puntos de la baza) para las
+    cartas jugadas en orden
+    """
+    rangos = RANGO[triunfo][PALO[cartas[0]]]
+    mejor = 0
+    for i in range(1, len(cartas)):
+        if rangos[cartas[i]] > rangos[cartas[mejor]]:
+            mejor = i
+    return mejor, sum(PUNTOS[c] for c in cartas)
+
+def jugadas_validas(mano: int, baza: list, triunfo: int, companero_gana: bool = False) -> int:
+    """
+    Máscara de las cartas de <mano> que se pueden jugar en fase de arrastre:
+    hay que asistir al palo y superar si se puede; si no se tiene palo, fallar
+    con triunfo (superando el triunfo de la baza si se puede). Si la baza está
+    vacía o va ganando el compañero, vale cualquier carta
+    """
+    if not baza or companero_gana:
+        return mano
+
+    palo_inicial = PALO[baza[0]]
+    mismo_palo = mano & MASCARA_PALO[palo_inicial]
+    if mismo_palo:
+        mejor = max((c for c in baza if PALO[c] == palo_inicial), key=FUERZA.__getitem__)
+        return (mismo_palo & MAS_FUERTES[mejor]) or mismo_palo
+
+    triunfos = mano & MASCARA_PALO[triunfo]
+    if triunfos:
+        en_baza = [c for c in baza if PALO[c] == triunfo]
+        if en_baza:
+            ganadoras = triunfos & MAS_FUERTES[max(en_baza, key=FUERZA.__getitem__)]
+            if ganadoras:
+                return ganadoras
+        return triunfos
+
+    return mano
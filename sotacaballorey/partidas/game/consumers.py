@@ -1,31 +1,137 @@
-from partidas.elo import calcular_nuevo_elo, calcular_nuevo_elo_parejas
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
 from partidas.models import Partida, JugadorPartida
-from asgiref.sync import sync_to_async
+from .sala import SalaPartida, obtener_sala, cargar_sala
+from .cartas import carta_a_int, int_a_carta, cartas_de, PALOS
+from .motor import *
+from .emparejamiento import emparejador, ConfigPartida, config_personalizada
+from partidas.lobby import invalidar_salas_en_espera
+from .lobby import publicar_lobby
+from .temporizador import temporizadores
+from .propiedad import propiedad
+from .bd import contar_consultas
+from utils.serializacion import codificar, decodificar
+from utils.jwt_auth import usuario_existe_async
+from . import protocolo
+from .registro import AUTOMATICA, PAUSA, ANULAR_PAUSA, PAUSADA, PUNTOS, empaquetar_puntos
 from usuarios.models import Usuario
-from datetime import datetime
 from .messages import *
 from .utils import *
 import urllib.parse
+import contextlib
 import asyncio
 import random
-import json
 
 class PartidaConsumer(AsyncWebsocketConsumer):
     """
     Consumer que maneja la lógica de partidas de guiñote.
     """
 
-    palos = ['Oros', 'Copas', 'Espadas', 'Bastos']
-    timer_task = None
+    sala: SalaPartida = None
+
+    # La conexión usa el protocolo compacto (protocolo.py) en lugar de JSON
+    compacto: bool = False
+
+    # Lo que se envía va al canal de una conexión de otro proceso (atender_remoto)
+    remoto: bool = False
+
+    # Identidad del jugador de la conexión: se carga al conectar y no cambia
+    # hasta que se vuelve a conectar (otro consumer). El asiento se calcula
+    # una vez por sala
+    jugador: JugadorPartida = None
+    asiento: int = None
+    _sala_asiento: SalaPartida = None
+
+    @classmethod
+    def sin_conexion(cls, sala: SalaPartida, channel_layer):
+        """
+        Consumer sin WebSocket que lleva los turnos de una sala cuando no hay
+        ninguna conexión que lo haga (partidas recuperadas al arrancar)
+        """
+        consumer = cls()
+        consumer.channel_layer = channel_layer
+        consumer.channel_name = None
+        consumer.usuario = None
+        consumer.sala = sala
+        consumer.partida = sala.partida
+        consumer.capacidad = sala.partida.capacidad
+        consumer.room_group_name = f'partida_{sala.partida.id}'
+        return consumer
+
+    @classmethod
+    async def atender_remoto(cls, channel_layer, mensaje: dict):
+        """
+        Atiende en este proceso, que lleva la sala, lo que otro proceso ha
+        recibido de uno de sus jugadores (propiedad.py). Las respuestas van
+        al canal de la conexión del jugador
+        """
+        sala = obtener_sala(mensaje['partida_id'])
+        jugador = sala.jugador_de_usuario(mensaje['usuario_id']) if sala else None
+        if not jugador:
+            return
+        consumer = cls.sin_conexion(sala, channel_layer)
+        consumer.usuario = jugador.usuario
+        consumer.jugador = jugador
+        consumer.channel_name = mensaje['canal']
+        consumer.send = consumer.enviar_a_canal
+        consumer.remoto = True
+
+        if mensaje['type'] == 'partida.accion':
+            await consumer.receive(text_data=mensaje['texto'])
+            return
+        async with sala.lock:
+            if mensaje['type'] == 'partida.conexion':
+                jugador.channel_name = consumer.channel_name
+                jugador.conectado = True
+                if str(jugador.id) in consumer.partida.jugadores_pausa:
+                    consumer.partida.jugadores_pausa.remove(str(jugador.id))
+                    await consumer.guardar_partida('jugadores_pausa')
+                await consumer.enviar_estado_al_conectar(
+                    jugador, mensaje.get('seq'), mensaje.get('epoca'))
+            elif mensaje['type'] == 'partida.desconexion':
+                jugador.conectado = False
+                if consumer.partida.estado == 'jugando' and \
+                    str(jugador.id) not in consumer.partida.jugadores_pausa:
+                        await consumer.procesar_pausa()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Con el protocolo compacto, lo que se envía en JSON se pasa a MessagePack"""
+        if self.compacto and text_data is not None:
+            text_data, bytes_data = None, protocolo.compacto_desde_texto(text_data)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def enviar_a_canal(self, text_data=None, bytes_data=None, close=False):
+        """send() de los consumers de atender_remoto: reenvía al canal del jugador"""
+        await self.channel_layer.send(self.channel_name, {
+            'type': 'private_message',
+            'texto': text_data
+        })
+
+    async def enviar_al_grupo(self, msg_type: str, data):
+        """Envía un mensaje a todos los de la partida (numerado si hay sala)"""
+        await send_to_group(self.channel_layer, self.room_group_name, msg_type, data, sala=self.sala)
+
+    async def reenviar_al_propietario(self, tipo: str, **datos) -> bool:
+        """Reenvía al proceso que lleva la partida algo de esta conexión"""
+        return await propiedad.reenviar(self.partida.id, {
+            'type': tipo,
+            'partida_id': self.partida.id,
+            'usuario_id': self.usuario.id,
+            'canal': self.channel_name,
+            **datos
+        })
 
     async def connect(self):
 
         self.usuario: Usuario = self.scope.get('usuario', None)
-        if not self.usuario or isinstance(self.usuario, AnonymousUser):
-            await self.close()
-            return
+        if not self.usuario or isinstance(self.usuario, AnonymousUser) or \
+            not await usuario_existe_async(self.usuario):
+                await self.close()
+                return
+
+        # El cliente pide el protocolo compacto como subprotocolo del WebSocket
+        self.compacto = protocolo.disponible and \
+            protocolo.SUBPROTOCOLO in self.scope.get('subprotocols', [])
         
         # Obtener y parsear parámetros de la URL
         query_params = self.scope['query_string'].decode()
@@ -33,6 +139,11 @@ class PartidaConsumer(AsyncWebsocketConsumer):
 
         id_partida_str = params.get('id_partida', [None])[0]
         es_personalizada = params.get('es_personalizada', ['false'])[0].lower() == 'true'
+
+        # Al reconectarse el cliente indica el último mensaje numerado que recibió
+        seq_str = params.get('seq', [None])[0]
+        seq = int(seq_str) if seq_str and seq_str.isdigit() else None
+        epoca = params.get('epoca', [None])[0]
         try:
             capacidad_value = params.get('capacidad', 2)
             if isinstance(capacidad_value, list):
@@ -63,31 +174,65 @@ class PartidaConsumer(AsyncWebsocketConsumer):
                     await self.close()
                     return
 
-        # Crear o unise a partida
+            # Si está en espera ocupa uno de sus huecos (o no cabe)
+            if self.partida.estado == 'esperando' and \
+                not emparejador.ocupar(self.partida.id, self.usuario.id):
+                    await self.close()
+                    return
+
+        # Crear o unise a partida: el emparejador reserva el hueco en una sala
+        # con la configuración pedida (con algún amigo si es solo de amigos)
         else:
             if es_personalizada:
-                self.partida = await obtener_o_crear_partida_personalizada(self.usuario, params)
-                
-                if self.partida.solo_amigos and \
-                    not await tiene_amigos_en_partida(self.partida, self.usuario):
-                        await self.close()
-                        return
+                config = config_personalizada(params)
             else:
-                self.partida = await obtener_o_crear_partida(self.usuario, self.capacidad)
+                config = ConfigPartida(capacidad=self.capacidad)
+            try:
+                self.partida = await emparejador.asignar(self.usuario, config)
+            except Exception as e:
+                print(f"Error al emparejar: {e}")
+                self.partida = None
 
         if not self.partida:
             print(f"error not partida")
             await self.close()
             return
 
-        jugador_existente = await get_jugador(self.partida, self.usuario)
-        if jugador_existente:
-            if jugador_existente.channel_name:
-                # Si el jugador ya está conectado en otro canal, cerramos esa conexión
-                await self.channel_layer.send(jugador_existente.channel_name, {
-                    'type': 'close_connection'
-                })
+        # Si la partida está en curso, su estado autoritativo es el de la sala
+        # (en este proceso o en el que la lleva)
+        self.sala = obtener_sala(self.partida.id)
+        if self.sala:
+            self.partida = self.sala.partida
+        await self.cargar_sala_en_curso()
+
+        jugador, created = await self.entrar_en_partida()
+
+        if not jugador:
+            # No cabe: otro proceso ha llenado o empezado la partida
+            print(f"error not jugador")
+            emparejador.liberar(self.partida.id, self.usuario.id)
+            await self.close()
+            return
 
+        await self.accept(protocolo.SUBPROTOCOLO if self.compacto else None)
+
+        if jugador:
+            jugador = await self.anunciar_jugador(jugador, created)
+
+        if self.en_otro_proceso():
+            await self.reenviar_al_propietario('partida.conexion', seq=seq, epoca=epoca)
+        elif self.partida.estado == 'jugando':
+            await self.enviar_estado_al_conectar(jugador, seq, epoca)
+
+        await self.comprobar_inicio_partida()
+
+        # Si mientras se conectaba su sala se ha reunido con otra, se pasa a ella
+        destino = emparejador.reunida_en(self.partida.id)
+        if destino:
+            await self.cambiar_partida({'origen': self.partida.id, 'destino': destino})
+
+    async def entrar_en_partida(self):
+        """Entra en el grupo de la partida y agrega al jugador. Devuelve (jugador, creado)"""
         # Definimos nombre del grupo
         self.room_group_name = f'partida_{self.partida.id}'
 
@@ -95,79 +240,148 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_add(
             self.room_group_name, self.channel_name)
 
-        jugador, created = await agregar_jugador(self.partida, self.usuario)
+        return await agregar_jugador(self.partida, self.usuario)
 
-        if not jugador:
-            print(f"error not jugador")
-            await self.close()
-            return
-
-        await self.accept()
+    async def anunciar_jugador(self, jugador: JugadorPartida, created: bool) -> JugadorPartida:
+        """
+        Conecta al jugador que acaba de entrar y lo anuncia a la partida y al
+        lobby. Devuelve el jugador (el de la sala si la partida está en curso)
+        """
+        if self.sala:
+            jugador.usuario = self.usuario
+            jugador = self.sala.conectar_jugador(jugador)
+        if jugador.channel_name and jugador.channel_name != self.channel_name:
+            # Si el jugador ya está conectado en otro canal, cerramos esa conexión
+            await self.channel_layer.send(jugador.channel_name, {
+                'type': 'close_connection'
+            })
+        self.jugador = jugador
+        jugador.channel_name = self.channel_name
+        jugador.conectado = True
 
-        if jugador:
-            jugador.channel_name = self.channel_name
-            jugador.conectado = True
+        try:
+            await db_sync_to_async_save(jugador, update_fields=['channel_name', 'conectado'])
+        except Exception as e:
+            print(f"Error al guardar el jugador: {e}")
 
-            try:
-                await db_sync_to_async_save(jugador)
-            except Exception as e:
-                print(f"Error al guardar el jugador: {e}")
+        if str(jugador.id) in self.partida.jugadores_pausa and not self.en_otro_proceso():
+            self.partida.jugadores_pausa.remove(str(jugador.id))
+            await self.guardar_partida('jugadores_pausa', mutar=cambio_de_pausa(jugador.id, False))
+
+        num_jugadores = await contar_jugadores(self.partida)
+        await self.enviar_al_grupo(MessageTypes.PLAYER_JOINED, data={
+            'message': f'{self.usuario.nombre} se ha unido a la partida.',
+            'usuario': {
+                'nombre': self.usuario.nombre,
+                'id': self.usuario.id
+            },
+            'chat_id': await obtener_chat_id(self.partida),
+            'partida_id': self.partida.id,
+            'capacidad': self.capacidad,
+            'jugadores': num_jugadores,
+            'pausados': len(self.partida.jugadores_pausa or [])
+        })      
+
+        # Las salas en espera se anuncian en el lobby
+        if self.partida.estado == 'esperando' and created:
+            tipo = MessageTypes.ROOM_CREATED if num_jugadores == 1 else MessageTypes.PLAYER_JOINED
+            await publicar_lobby(self.channel_layer, tipo, self.partida, usuario=self.usuario)
+        return jugador
+
+    async def cambiar_partida(self, event):
+        """
+        El emparejador ha reunido la sala en espera de esta conexión con otra
+        (emparejamiento.py): el jugador sale de su partida y entra en la otra
+        """
+        if not self.partida or self.partida.id != event['origen'] or self.partida.estado != 'esperando':
+            return
+        destino = await obtener_partida_por_id(event['destino'])
+        if not destino:
+            return
 
-            if str(jugador.id) in self.partida.jugadores_pausa:
-                self.partida.jugadores_pausa.remove(str(jugador.id))
-                await db_sync_to_async_save(self.partida)
+        if self.jugador:
+            await db_sync_to_async_delete(self.jugador)
+            self.jugador = None
+        if await contar_jugadores(self.partida) == 0:
+            await db_sync_to_async_delete(self.partida)
+        await publicar_lobby(self.channel_layer, MessageTypes.PLAYER_LEFT, self.partida, usuario=self.usuario)
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.PLAYER_JOINED, data={
-                'message': f'{self.usuario.nombre} se ha unido a la partida.',
-                'usuario': {
-                    'nombre': self.usuario.nombre,
-                    'id': self.usuario.id
-                },
-                'chat_id': await obtener_chat_id(self.partida),
-                'partida_id': self.partida.id,
-                'capacidad': self.capacidad,
-                'jugadores': await contar_jugadores(self.partida),
-                'pausados': len(self.partida.jugadores_pausa or [])
-            })      
+        self.partida = destino
+        jugador, created = await self.entrar_en_partida()
+        if jugador:
+            await self.anunciar_jugador(jugador, created)
+        await self.comprobar_inicio_partida()
 
-        if self.partida.estado == 'jugando':
+    async def enviar_estado_al_conectar(self, jugador: JugadorPartida, seq: int = None, epoca: str = None):
+        """
+        Envía el estado de la partida en curso a quien se acaba de (re)conectar.
+        Si indica el último mensaje que recibió (<seq>, de la misma <epoca> de la
+        sala) y la sala aún los guarda, se le envían solo los que le faltan; si
+        no, el estado completo. El cliente descarta los 'seq' que ya tenga.
+
+        Los que le faltan se envían directamente al WebSocket: su canal aún no
+        se lee mientras se conecta. Si la conexión es de otro proceso van por
+        su canal, así que solo se reenvían si caben holgadamente en él
+        """
+        pendientes = None
+        if self.sala and seq is not None and epoca == self.sala.epoca:
+            pendientes = self.sala.mensajes_desde(seq, jugador.id)
+        if pendientes and self.remoto and \
+            len(pendientes) > getattr(self.channel_layer, 'capacity', 100) // 2:
+                pendientes = None
+
+        if pendientes is None:
             await send_estado_jugadores(self, MessageTypes.START_GAME, solo_jugador=jugador)
+        else:
+            for contenido in pendientes:
+                await self.private_message(contenido)
 
-        await self.comprobar_inicio_partida()
+        # Si el servidor se ha reiniciado se le recuerda de quién es el turno
+        if self.sala and self.sala.recuperada:
+            await self.channel_layer.send(self.channel_name,
+                mensaje_privado(MessageTypes.TURN_UPDATE, self.datos_turno()))
     
     #------------------------------------------------------------------------------------
 
     async def disconnect(self, code):
         if hasattr(self, 'partida') and self.partida and self.usuario:
             try:
-                self.partida = await refresh(self.partida)
+                await self.sincronizar_partida()
             except Partida.DoesNotExist:
                 if hasattr(self, 'room_group_name') and self.channel_name:
                     await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
                 return
-            jugador: JugadorPartida = await get_jugador(self.partida, self.usuario)
-            if jugador:
-                if self.partida.estado in ['jugando', 'pausada']:
-                    # Si la partida está en curso, marcamos decomo desconectado
-                    # pero no lo eliminamos de la partida
-                    jugador.conectado = False
-                    await db_sync_to_async_save(jugador)
-
-
-                    if self.partida.estado == 'jugando' and str(jugador.id) not in self.partida.jugadores_pausa:
-                        await self.procesar_pausa()
-                        await db_sync_to_async_save(self.partida)
-
-                elif self.partida.estado in ['esperando', 'finalizada']:
-                    # Si aún no ha empezado ('esperando') lo podemos echar
-                    # de la partida. Si todos se desconectan antes de que comienze
-                    # la partida, se elimina
-                    await db_sync_to_async_delete(jugador)
-                    count_jugadores = await contar_jugadores(self.partida)
-                    if count_jugadores == 0:
-                        await db_sync_to_async_delete(self.partida)
+            async with self.bloqueo():
+                jugador: JugadorPartida = self.obtener_jugador()
+                if jugador:
+                    if self.partida.estado in ['jugando', 'pausada']:
+                        # Si la partida está en curso, marcamos decomo desconectado
+                        # pero no lo eliminamos de la partida
+                        jugador.conectado = False
+                        await db_sync_to_async_save(jugador, update_fields=['conectado'])
+
+                        if self.en_otro_proceso():
+                            await self.reenviar_al_propietario('partida.desconexion')
+                        elif self.partida.estado == 'jugando' and str(jugador.id) not in self.partida.jugadores_pausa:
+                            await self.procesar_pausa()
+
+                    elif self.partida.estado in ['esperando', 'finalizada']:
+                        # Si aún no ha empezado ('esperando') lo podemos echar
+                        # de la partida. Si todos se desconectan antes de que comienze
+                        # la partida, se elimina
+                        await db_sync_to_async_delete(jugador)
+                        count_jugadores = emparejador.liberar(self.partida.id, self.usuario.id)
+                        if count_jugadores is None:
+                            count_jugadores = await contar_jugadores(self.partida)
+                        if count_jugadores == 0:
+                            emparejador.cerrar(self.partida.id)
+                            await db_sync_to_async_delete(self.partida)
+                        if self.partida.estado == 'esperando':
+                            await publicar_lobby(self.channel_layer, MessageTypes.PLAYER_LEFT,
+                                                 self.partida, usuario=self.usuario)
         if hasattr(self, 'room_group_name') and self.usuario:
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.PLAYER_LEFT, data={
+            await self.enviar_al_grupo(MessageTypes.PLAYER_LEFT, data={
                 'message': f'{self.usuario.nombre} se ha desconectado.',
                 'usuario': {
                     'nombre': self.usuario.nombre,
@@ -187,67 +401,156 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         """
         Recibir y gestionar mensaje de los miembros del grupo
         """
-        if not text_data:
+        if bytes_data and self.compacto:
+            # Se pasa a JSON para tratarla (o reenviarla) igual que las demás
+            data = protocolo.accion_desde_compacto(bytes_data)
+            text_data = codificar(data)
+        elif text_data:
+            data = decodificar(text_data)
+        else:
             return
-        data = json.loads(text_data)
         accion = data.get('accion')
-        self.partida = await refresh(self.partida)
-        if accion == 'jugar_carta':
-            carta: dict = data.get('carta')
-            await self.jugar_carta(carta)
-        elif accion == 'cantar':
-            await self.procesar_canto()
-        elif accion == 'cambiar_siete':
-            await self.procesar_cambio_siete()
-        elif accion == 'pausa':
-            await self.procesar_pausa()
-        elif accion == 'anular_pausa':
-            await self.procesar_anular_pausa()
-        elif accion == 'debug_state':
-            # Get current game state
-            jugadores = await sync_to_async(list)(self.partida.jugadores.all())
-            jugadores_data = []
-            for j in jugadores:
-                usuario_id = await sync_to_async(lambda: j.usuario.id)()
-                usuario_nombre = await sync_to_async(lambda: j.usuario.nombre)()
-                jugadores_data.append({
-                    'usuario': {
-                        'id': usuario_id,
-                        'nombre': usuario_nombre
-                    },
-                    'equipo': j.equipo,
-                    'cartas_json': j.cartas_json
+        with contar_consultas(str(accion)):
+            await self.atender_accion(accion, data, text_data)
+
+    async def atender_accion(self, accion: str, data: dict, text_data: str):
+        """Aplica la acción recibida (o la reenvía al proceso que lleva la partida)"""
+        await self.sincronizar_partida()
+        if self.en_otro_proceso():
+            await self.reenviar_al_propietario('partida.accion', texto=text_data)
+            return
+        async with self.bloqueo():
+            if accion == 'jugar_carta':
+                carta: dict = data.get('carta')
+                await self.jugar_carta(carta)
+            elif accion == 'cantar':
+                await self.procesar_canto()
+            elif accion == 'cambiar_siete':
+                await self.procesar_cambio_siete()
+            elif accion == 'pausa':
+                await self.procesar_pausa()
+            elif accion == 'anular_pausa':
+                await self.procesar_anular_pausa()
+            elif accion == 'debug_state':
+                # Get current game state
+                if self.sala:
+                    self.sala.exportar()
+                    jugadores = self.sala.jugadores
+                else:
+                    jugadores = await get_jugadores(self.partida)
+                jugadores_data = []
+                for j in jugadores:
+                    jugadores_data.append({
+                        'usuario': {
+                            'id': j.usuario.id,
+                            'nombre': j.usuario.nombre
+                        },
+                        'equipo': j.equipo,
+                        'cartas_json': j.cartas
+                    })
+                
+                estado = {
+                    'solo_amigos': self.partida.solo_amigos,
+                    'capacidad':self.capacidad,
+                    'partida': self.partida.estado_json,
+                    'jugadores': jugadores_data,
+                    'mazo': self.partida.mazo,
+                    'pozo': self.partida.estado_json.get('baza_actual', []),
+                    'turno_actual': self.partida.estado_json.get('turno_actual_id'),
+                    'estado': self.partida.estado,
+                    'puntos_equipo_1': self.partida.puntos_equipo_1,
+                    'puntos_equipo_2': self.partida.puntos_equipo_2
+                }
+                await send_debug_state(self, estado)
+            elif accion == 'debug_finalizar':
+                # Debug action to trigger finalizar_partida
+                await self.forzar_fin_partida()
+            elif accion == 'debug_set_score':
+                # Debug action to set scores for both teams
+                puntos_equipo1 = data.get('puntos_equipo1', 0)
+                puntos_equipo2 = data.get('puntos_equipo2', 0)
+                
+                self.partida.puntos_equipo_1 = puntos_equipo1
+                self.partida.puntos_equipo_2 = puntos_equipo2
+                if self.sala and self.sala.juego:
+                    self.sala.juego.puntos = [puntos_equipo1, puntos_equipo2]
+                    self.sala.registrar(PUNTOS, valor=empaquetar_puntos(self.sala.juego.puntos))
+                await self.guardar_partida('puntos_equipo_1', 'puntos_equipo_2')
+                
+                await self.enviar_al_grupo(MessageTypes.SCORE_UPDATE, data={
+                    'puntos_equipo_1': puntos_equipo1,
+                    'puntos_equipo_2': puntos_equipo2
                 })
-            
-            estado = {
-                'solo_amigos': self.partida.solo_amigos,
-                'capacidad':self.capacidad,
-                'partida': self.partida.estado_json,
-                'jugadores': jugadores_data,
-                'mazo': self.partida.estado_json.get('baraja', []),
-                'pozo': self.partida.estado_json.get('baza_actual', []),
-                'turno_actual': self.partida.estado_json.get('turno_actual_id'),
-                'estado': self.partida.estado,
-                'puntos_equipo_1': self.partida.puntos_equipo_1,
-                'puntos_equipo_2': self.partida.puntos_equipo_2
-            }
-            await send_debug_state(self, estado)
-        elif accion == 'debug_finalizar':
-            # Debug action to trigger finalizar_partida
-            await self.finalizar_partida()
-        elif accion == 'debug_set_score':
-            # Debug action to set scores for both teams
-            puntos_equipo1 = data.get('puntos_equipo1', 0)
-            puntos_equipo2 = data.get('puntos_equipo2', 0)
-            
-            self.partida.puntos_equipo_1 = puntos_equipo1
-            self.partida.puntos_equipo_2 = puntos_equipo2
-            await db_sync_to_async_save(self.partida)
-            
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.SCORE_UPDATE, data={
-                'puntos_equipo_1': puntos_equipo1,
-                'puntos_equipo_2': puntos_equipo2
-            })
+
+    #-----------------------------------------------------------------------------------#
+    # Estado en memoria de la partida (sala)                                            #
+    #-----------------------------------------------------------------------------------#
+
+    async def sincronizar_partida(self):
+        """
+        Toma la partida de la sala en memoria si está en curso. Si no hay sala
+        (la partida no ha empezado, está pausada o la lleva otro proceso) se
+        lee de la base de datos
+        """
+        self.sala = obtener_sala(self.partida.id)
+        if self.sala:
+            self.partida = self.sala.partida
+        else:
+            self.partida = await refresh(self.partida)
+            await self.cargar_sala_en_curso()
+        return self.partida
+
+    async def cargar_sala_en_curso(self):
+        """
+        Si la partida está en curso y su sala no está en memoria, la carga.
+        Solo lo consigue el proceso que tiene la concesión de la partida, o
+        cualquiera si la concesión ha vencido (propiedad.py)
+        """
+        if self.sala or self.partida.estado != 'jugando':
+            return
+        self.sala = await cargar_sala(self.partida.id)
+        if self.sala:
+            self.partida = self.sala.partida
+
+    def en_otro_proceso(self) -> bool:
+        """La partida está en curso y su sala la lleva otro proceso"""
+        return not self.sala and self.partida.estado == 'jugando'
+
+    def bloqueo(self):
+        """
+        Cerrojo de la sala: las acciones sobre una partida en curso se
+        ejecutan de una en una, vengan de la conexión que vengan
+        """
+        return self.sala.lock if self.sala else contextlib.nullcontext()
+
+    def obtener_jugador(self) -> JugadorPartida:
+        """
+        Devuelve el jugador de esta conexión sin consultar la base de datos: el
+        de la sala si la partida está en curso (y su asiento en <self.asiento>)
+        o el cargado al conectar
+        """
+        if not self.jugador or not self.sala:
+            return self.jugador
+        if self._sala_asiento is not self.sala:
+            en_sala = self.sala.jugadores_por_id.get(self.jugador.id)
+            if not en_sala:
+                return None
+            self._sala_asiento = self.sala
+            self.jugador = en_sala
+            self.asiento = self.sala.indice(en_sala.id)
+        return self.jugador
+
+    async def guardar_partida(self, *campos, mutar=None):
+        """
+        Guarda la partida. Si está en curso se marca en la sala y se vuelca en
+        segundo plano; si no, se escriben solo los <campos> con control de
+        versión (ver guardar_con_version para <mutar>)
+        """
+        if self.sala:
+            self.sala.marcar_partida()
+            self.sala.volcar()
+        else:
+            await guardar_con_version(self.partida, campos, mutar)
 
     #-----------------------------------------------------------------------------------#
     # Lógica de inicio de partida                                                       #
@@ -260,13 +563,23 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         """
         count_jugadores: int = await contar_jugadores(self.partida)
 
-        if count_jugadores == self.capacidad:
+        if count_jugadores != self.capacidad or \
+            self.partida.estado not in ['pausada', 'esperando']:
+                return
+
+        # A partir de aquí el estado de la partida vive en la sala
+        self.sala = await cargar_sala(self.partida.id)
+        if not self.sala:
+            return
+        self.partida = self.sala.partida
+
+        async with self.sala.lock:
             if self.partida.estado == 'pausada':
                 self.partida.jugadores_pausa = []
             
                 # Cambiar estado a 'jugando'
                 self.partida.estado = 'jugando'
-                await db_sync_to_async_save(self.partida)
+                await self.guardar_partida('estado', 'jugadores_pausa')
 
                 # Enviar estado de la partida a todos
                 await send_estado_jugadores(self, MessageTypes.START_GAME)
@@ -275,9 +588,12 @@ class PartidaConsumer(AsyncWebsocketConsumer):
                 await self.iniciar_siguiente_turno()
             
             elif self.partida.estado == 'esperando':
-                # Cambiar estado a 'jugando'
+                # Cambiar estado a 'jugando' (ya no admite más jugadores)
                 self.partida.estado = 'jugando'
-                await db_sync_to_async_save(self.partida)
+                emparejador.cerrar(self.partida.id)
+                invalidar_salas_en_espera()
+                await publicar_lobby(self.channel_layer, MessageTypes.ROOM_STARTED, self.partida,
+                                     usuarios=[j.usuario_id for j in self.sala.jugadores])
 
                 # Barajar y repartir
                 await self.iniciar_partida()
@@ -290,45 +606,11 @@ class PartidaConsumer(AsyncWebsocketConsumer):
 
     async def iniciar_partida(self):
         """
-        Baraja y reparte, define el palo que será el triunfo y
-        guarda el estado_json de la partida
+        Baraja y reparte en el motor y vuelca el estado inicial de la
+        partida (manos, triunfo, turno)
         """
-        
-        # Crear baraja, barajar y definir palo que será el triunfo
-        baraja = self.crear_baraja()
-        random.shuffle(baraja)
-        
-        carta_triunfo = baraja[0]
-        palo_triunfo: str = carta_triunfo['palo']
-
-        # Repartir cartas
-        num_cartas: int = 6
-        jugadores = await get_jugadores(self.partida)
-        for jugador in jugadores:
-            mano: list = []
-            for _ in range(num_cartas):
-                if baraja:
-                    mano.append(baraja.pop())
-            
-            jugador.cartas_json = mano
-            await db_sync_to_async_save(jugador)
-
-        # Guardar info en estado_json
-        self.partida.estado_json = {
-            'baraja': baraja,                   # Cartas restantes
-            'triunfo': palo_triunfo,            # Triunfo
-            'carta_triunfo': carta_triunfo,     # Carta triunfo
-            'fase_arrastre': False,             # Fase arrastre?
-            'baza_actual': [],                  # Cartas jugadas en la baza actual
-            'ultimo_ganador': None,             # Quién ganó la última baza
-            'turno_actual_id': jugadores[0].id  # Primer jugador en orden por ID
-        }
-        await db_sync_to_async_save(self.partida)
-
-    def crear_baraja(self):
-        """Crea baraja española de 40 cartas"""
-        valores = [1, 2, 3, 4, 5, 6, 7, 10, 11, 12]
-        return [{'palo': p, 'valor': v} for p in self.palos for v in valores]
+        self.sala.repartir()
+        self.sala.volcar()
             
     #-----------------------------------------------------------------------------------#
     # Lógica de turnos                                                                  #
@@ -336,47 +618,38 @@ class PartidaConsumer(AsyncWebsocketConsumer):
 
     async def iniciar_siguiente_turno(self):
         """Lógica para gestionar el turno del siguiente jugador"""
-        turno_id = self.partida.estado_json['turno_actual_id']
-        jugador_turno: JugadorPartida = await get_jugador_by_id(turno_id)
-
-        usuario: Usuario = await sync_to_async(lambda: jugador_turno.usuario)()
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.TURN_UPDATE, {
+        jugador_turno: JugadorPartida = self.sala.jugador_en(self.sala.juego.turno)
+        await self.enviar_al_grupo(MessageTypes.TURN_UPDATE, self.datos_turno())
+
+        # Cada turno reprograma el temporizador de la partida (el anterior se anula)
+        sala = self.sala
+        sala.turno += 1
+        turno = sala.turno
+        temporizadores.programar(self.partida.id, self.partida.tiempo_turno,
+            lambda: self.temporizador_turno(sala, turno, jugador_turno))
+
+    def datos_turno(self) -> dict:
+        """Contenido del mensaje TURN_UPDATE para el turno en curso de la sala"""
+        usuario: Usuario = self.sala.jugador_en(self.sala.juego.turno).usuario
+        return {
             'message': f'Es el turno de {usuario.nombre}.',
             'jugador': {
                 'nombre': usuario.nombre,
                 'id': usuario.id
             }
-        })
-
-        if self.timer_task and not self.timer_task.done():
-            self.timer_task.cancel()
-
-        self.timer_task = asyncio.create_task(self.temporizador_turno(jugador_turno))
+        }
 
-    async def temporizador_turno(self, jugador_turno: JugadorPartida):
+    async def temporizador_turno(self, sala: SalaPartida, turno: int, jugador_turno: JugadorPartida):
         """
-        Espera hasta que el jugador juegue (o acabe el tiempo de turno)
-        Si expira el tiempo, juega carta válida aleatoria
+        Vence el tiempo de turno: si el turno sigue siendo el mismo, juega una
+        carta válida aleatoria por el jugador
         """
-        inicio = datetime.now()
-        while(datetime.now() - inicio).total_seconds() < self.partida.tiempo_turno:
-            await asyncio.sleep(1)
-
-            try:
-                self.partida = await refresh(self.partida)
-            except Partida.DoesNotExist:
-                return
-
-            if self.partida.estado != 'jugando':
-                return
-
-            estado_json = self.partida.estado_json or {}
-
-            turno_actual_id = estado_json.get('turno_actual_id')
-            if turno_actual_id is None or turno_actual_id != jugador_turno.id:
-                return
-            
-        if self.partida.estado == 'jugando':
+        async with sala.lock:
+            if obtener_sala(sala.partida.id) is not sala or sala.turno != turno or \
+                sala.partida.estado != 'jugando':
+                    return
+            self.sala = sala
+            self.partida = sala.partida
             await self.jugar_carta_automatica(jugador_turno)
 
     async def jugar_carta_automatica(self, jugador: JugadorPartida):
@@ -384,420 +657,168 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         Si el tiempo del turno del jugador expirá, forzamos jugada válida
         aleatoria
         """
-        self.partida = await refresh(self.partida)
-        estado_json = self.partida.estado_json
-
-        jugador: JugadorPartida = await refresh(jugador)
-        mano = jugador.cartas_json
-
-        # Filtrar las cartas que son válidas
-        cartas_validas = await self.obtener_cartas_validas(estado_json, mano, jugador)
-        carta_a_jugar = random.choice(cartas_validas) if cartas_validas else mano[0]
-        await self.procesar_jugada(jugador, carta_a_jugar, automatica=True)
+        asiento = self.sala.indice(jugador.id)
+        cartas_validas = cartas_de(jugadas_posibles(self.sala.juego, asiento))
+        if not cartas_validas:
+            return
+        carta = random.choice(cartas_validas)
+        _, eventos = aplicar(self.sala.juego, (JUGAR, asiento, carta))
+        self.sala.registrar(AUTOMATICA, asiento, carta)
+        await self.procesar_eventos(eventos, automatica=True)
 
     async def jugar_carta(self, carta):
         """LLamado cuando el jugador envía una carta manualmente"""
-        estado_json = self.partida.estado_json
-        turno_actual_id = estado_json.get('turno_actual_id')
-
-        jugador_que_juega: JugadorPartida = await get_jugador(self.partida, self.usuario)
-
-        estado_json = self.partida.estado_json
-        ya_jugo = any(jugada['jugador_id'] == jugador_que_juega.id for jugada in estado_json.get('baza_actual', []))
-        if ya_jugo:
-            await send_error(self.send, "Ya has jugado en esta baza")
+        if not self.sala or not self.sala.juego or self.partida.estado != 'jugando':
+            await send_error(self.send, "La partida no está en curso")
             return
 
-        # ¿Es tu turno?
-        if turno_actual_id != jugador_que_juega.id:
-            await send_error(self.send, "No es tu turno")
+        if not self.obtener_jugador():
+            await send_error(self.send, "No estás en la partida")
             return
-        
-        # ¿Tienes la carta?
-        def cartas_son_iguales(c1, c2):
-            return c1.get('palo') == c2.get('palo') and int(c1.get('valor')) == int(c2.get('valor'))
 
-        if not any(cartas_son_iguales(carta, c) for c in jugador_que_juega.cartas_json):
-            await send_error(self.send, "No tiene esa carta en tu mano")
-            return
-        
-        # ¿La carta cumple con las reglas del guiñote?
-        cartas_validas = await self.obtener_cartas_validas(
-            estado_json, jugador_que_juega.cartas_json, jugador_que_juega)
-        if carta not in cartas_validas:
-            await send_error(self.send, "Carta inválida para la fase actual")
+        try:
+            codigo = carta_a_int(carta)
+        except (KeyError, TypeError, ValueError):
+            await send_error(self.send, "Carta inválida")
             return
-        
-        await self.procesar_jugada(jugador_que_juega, carta)
 
-    async def procesar_jugada(self, jugador: JugadorPartida, carta, automatica=False):
+        await self.aplicar_accion((JUGAR, self.asiento, codigo))
+
+    async def aplicar_accion(self, accion: tuple):
         """
-        Extrae la carta de la mano del jugador, la añade a la baza actual y
-        si la baza está completa, decide quién gana
+        Aplica en el motor una acción del jugador de esta conexión. Si las
+        reglas no la permiten, se le envía el motivo
         """
-        jugador.cartas_json.remove(carta)
-        await db_sync_to_async_save(jugador)
-
-        usuario: Usuario = await sync_to_async(lambda: jugador.usuario)()
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.CARD_PLAYER, data={
-            'jugador': {
-                'nombre': usuario.nombre,
-                'id': usuario.id
-            },
-            'automatica': automatica,
-            'carta': carta
-        })
-
-        # Añadir carta a baza actual
-        estado_json = self.partida.estado_json
-        baza_actual = estado_json.get('baza_actual', [])
-        baza_actual.append({
-            'jugador_id': jugador.id,
-            'carta': carta
-        })
-        estado_json['baza_actual'] = baza_actual
-        self.partida.estado_json = estado_json
-        await db_sync_to_async_save(self.partida)
-
-        if len(baza_actual) == self.capacidad:
-            # Fin de la baza: Calcular ganador de la baza
-            ganador_id, puntos = self.calcular_ganador(estado_json, baza_actual)
-            estado_json['ultimo_ganador'] = ganador_id
-            estado_json['baza_actual'] = []
-
-            # Las 10 últimas
-            jugadores = await get_jugadores(self.partida)
-            if not estado_json.get('baraja') and \
-                all(len(j.cartas_json) == 0 for j in jugadores):
-                    puntos += 10
-
-            # Actualizar puntuación
-            ganador = await get_jugador_by_id(ganador_id)
-            if ganador.equipo == 1:
-                self.partida.puntos_equipo_1 += puntos
-            else:
-                self.partida.puntos_equipo_2 += puntos
-
-            # En la siguiente baza empezará el ganador
-            estado_json['turno_actual_id'] = ganador_id
-            self.partida.estado_json = estado_json
-            await db_sync_to_async_save(self.partida)
-
-            usuario_ganador: Usuario = await sync_to_async(lambda: ganador.usuario)()
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.ROUND_RESULT, data={
-                'ganador': {
-                    'nombre': usuario_ganador.nombre,
-                    'id': usuario_ganador.id,
-                    'equipo': ganador.equipo
-                },
-                'puntos_baza': puntos,
-                'puntos_equipo_1': self.partida.puntos_equipo_1,
-                'puntos_equipo_2': self.partida.puntos_equipo_2
-            })
-
-            # Al final de la baza, todos roban una carta
-            await self.robar_cartas()
-
-            # Verificar arrastre o fin de partida
-            await self.verificar_fase_arrastre()
-            if await self.comprobar_fin_partida():
-                return
+        try:
+            _, eventos = aplicar(self.sala.juego, accion)
+        except JugadaInvalida as e:
+            await send_error(self.send, str(e))
+            return
+        self.sala.registrar(*accion)
+        await self.procesar_eventos(eventos)
+
+    async def procesar_eventos(self, eventos: list, automatica=False):
+        """Envía a los jugadores los mensajes que corresponden a los eventos del motor"""
+        sala = self.sala
+        juego = sala.juego
+
+        for evento in eventos:
+            tipo = evento[0]
+
+            if tipo == CARTA_JUGADA:
+                usuario: Usuario = sala.jugador_en(evento[1]).usuario
+                await self.enviar_al_grupo(MessageTypes.CARD_PLAYER, data={
+                    'jugador': {
+                        'nombre': usuario.nombre,
+                        'id': usuario.id
+                    },
+                    'automatica': automatica,
+                    'carta': int_a_carta(evento[2])
+                })
 
-            await self.iniciar_siguiente_turno()
-        else:
-            # Pasar turno al siguiente jugador
-            jugadores = await get_jugadores(self.partida)
-            orden = sorted(jugadores, key=lambda x: x.id)
-            ids = [j.id for j in orden]
-            actual_idx = ids.index(jugador.id)
-            siguiente_id = ids[(actual_idx + 1) % self.capacidad]
-            estado_json['turno_actual_id'] = siguiente_id
-            self.partida.estado_json = estado_json
-            await db_sync_to_async_save(self.partida)
+            elif tipo == BAZA_GANADA:
+                ganador: JugadorPartida = sala.jugador_en(evento[1])
+                usuario_ganador: Usuario = ganador.usuario
+                await self.enviar_al_grupo(MessageTypes.ROUND_RESULT, data={
+                    'ganador': {
+                        'nombre': usuario_ganador.nombre,
+                        'id': usuario_ganador.id,
+                        'equipo': ganador.equipo
+                    },
+                    'puntos_baza': evento[2],
+                    'puntos_equipo_1': juego.puntos[0],
+                    'puntos_equipo_2': juego.puntos[1]
+                })
 
-            await self.iniciar_siguiente_turno()
+                # Punto de control: se vuelca la baza en segundo plano
+                sala.volcar()
 
-    async def obtener_cartas_validas(self, estado_json, mano, jugador):
-        """
-        Determina qué cartas de la mano son válidas según el estado del
-        juego o si se está en arrastre o no
-        """
-        # Si no estamos en arrastre, cualquier carta es válida
-        if not estado_json.get('fase_arrastre') or not self.partida.reglas_arrastre:
-            return mano
-        
-        # Si la baza está vacía, puedes tirar lo que quieras
-        baza = estado_json.get('baza_actual', [])
-        if not baza:
-            return mano
-        
-        palo_inicial = baza[0]['carta']['palo']
-        palo_triunfo = estado_json['triunfo']
-
-        # Función para ver si una carta gana
-        def gana(carta_a, carta_b):
-            return self.comparar_cartas({'carta': carta_a}, {'carta': carta_b}, palo_inicial, palo_triunfo)
-
-        # Si mi compañero de equipo va ganando la baza puedo tirar cualquier carta
-        if self.capacidad == 4:
-            mejor_id = self.calcular_ganador(estado_json, baza)[0]
-            mejor_jugador = await get_jugador_by_id(mejor_id)
-            if mejor_jugador and mejor_jugador.equipo == jugador.equipo and mejor_jugador.id != jugador.id:
-                return mano
-                    
-        # Cartas del mismo palo
-        cartas_mismo_palo = [c for c in mano if c['palo'] == palo_inicial]
-        if cartas_mismo_palo:
-            mismas_en_baza = [j['carta'] for j in baza if j['carta']['palo'] == palo_inicial]
-            if mismas_en_baza:
-                mejor_en_baza = max(mismas_en_baza, key=lambda c: self.fuerza_carta(c['valor']))
-                ganadoras = [c for c in cartas_mismo_palo if gana(c, mejor_en_baza)]
-                return ganadoras if ganadoras else cartas_mismo_palo
-            return cartas_mismo_palo
-
-        # No tiene del mismo palo. Buscar triunfos
-        cartas_triunfo = [c for c in mano if c['palo'] == palo_triunfo]
-        if cartas_triunfo:
-            triunfo_en_baza = [j['carta'] for j in baza if j['carta']['palo'] == palo_triunfo]
-            if triunfo_en_baza:
-                mejor_triunfo_en_baza = max(triunfo_en_baza, key=lambda c: self.fuerza_carta(c['valor']))
-                ganadoras = [c for c in cartas_triunfo if gana(c, mejor_triunfo_en_baza)]
-                if ganadoras:
-                    return ganadoras
-            return cartas_triunfo
-        
-        return mano
+            elif tipo == CARTA_ROBADA:
+                jp: JugadorPartida = sala.jugador_en(evento[1])
+                await send_to_jugador(self.channel_layer, sala, jp,
+                    MessageTypes.CARD_DRAWN, {'carta': int_a_carta(evento[2])})
 
-    def calcular_ganador(self, estado_json, baza_actual):
-        """Devuelve (id_del_ganador, puntos_de_la_baza)"""
-        palo_inicial = baza_actual[0]['carta']['palo']
-        palo_triunfo = estado_json['triunfo']
+            elif tipo == ARRASTRE:
+                await self.enviar_al_grupo(MessageTypes.PHASE_UPDATE, data={
+                    'message': 'La partida entra en fase de arrastre'
+                })
 
-        puntos_totales = 0
-        for jugada in baza_actual:
-            puntos_totales += self.valor_carta(jugada['carta'])
+            elif tipo == CANTO:
+                jugador: JugadorPartida = sala.jugador_en(evento[1])
+                usuario: Usuario = jugador.usuario
+                await self.enviar_al_grupo(MessageTypes.CANTO, {
+                    'jugador': {
+                        'id': usuario.id,
+                        'nombre': usuario.nombre,
+                        'equipo': jugador.equipo
+                    },
+                    'cantos': [
+                        "40 (triunfo)" if valor == 40 else f"20 ({PALOS[palo]})"
+                        for valor, palo in evento[2]
+                    ],
+                    'puntos': evento[3],
+                    'puntos_equipo_1': juego.puntos[0],
+                    'puntos_equipo_2': juego.puntos[1]
+                })
 
-        mejor_jugada = baza_actual[0]
-        for jugada in baza_actual[1:]:
-            mejor_jugada = self.comparar_cartas(mejor_jugada, jugada, palo_inicial, palo_triunfo)
+            elif tipo == CAMBIO_SIETE:
+                jugador: JugadorPartida = sala.jugador_en(evento[1])
+                usuario: Usuario = jugador.usuario
+                await self.enviar_al_grupo(MessageTypes.CAMBIO_SIETE, {
+                    'jugador': {
+                        'id': usuario.id,
+                        'nombre': usuario.nombre,
+                        'equipo': jugador.equipo
+                    },
+                    'carta_robada': int_a_carta(evento[2])
+                })
 
-        return (mejor_jugada['jugador_id'], puntos_totales)
-    
-    def comparar_cartas(self, jugada_actual, jugada_nueva, palo_inicial, palo_triunfo):
-        """Compara dos jugadas y devuelve la ganadora según las reglas del guiñote"""
-        c_ganadora = jugada_actual['carta']
-        c_nueva = jugada_nueva['carta']
-
-        # Prioridad palo de triunfo
-        if c_ganadora['palo'] == palo_triunfo and c_nueva['palo'] != palo_triunfo:
-            return jugada_actual
-        elif c_nueva['palo'] == palo_triunfo and c_ganadora['palo'] != palo_triunfo:
-            return jugada_nueva
-        
-        # Prioridad palo inicial de la baza
-        if c_ganadora['palo'] == palo_inicial and c_nueva['palo'] != palo_inicial:
-            return jugada_actual
-        elif c_nueva['palo'] == palo_inicial and c_ganadora['palo'] != palo_inicial:
-            return jugada_nueva
-        
-        # Comparación entre cartas del mismo palo
-        if c_ganadora['palo'] == c_nueva['palo']:
-            fuerza_ganadora = self.fuerza_carta(c_ganadora['valor'])
-            fuerza_nueva = self.fuerza_carta(c_nueva['valor'])
-            return jugada_nueva if fuerza_nueva > fuerza_ganadora else jugada_actual
-
-        # Si las cartas son de diferente palo, devolvemos la carta que haya ganado
-        return jugada_actual
-        
-    def puntos_carta(self, valor: int) -> int:
-        """Puntos que aporta una carta según su valor."""
-        return {1: 11, 3: 10, 12: 4, 10: 3, 11: 2}.get(valor, 0)
+            elif tipo == REPARTO:
+                # Nadie ha ganado: se reparte de nuevo para jugar revueltas
+                sala.volcar()
+                await send_estado_jugadores(self, MessageTypes.START_GAME)
 
-    def fuerza_carta(self, valor: int) -> int:
-        """Fuerza relativa de una carta para decidir quién gana la baza."""
-        orden = [1, 3, 12, 10, 11, 7, 6, 5, 4, 2]
-        return len(orden) - orden.index(valor) if valor in orden else 0
+            elif tipo == TURNO:
+                await self.iniciar_siguiente_turno()
 
-    def valor_carta(self, carta) -> int:
-        """Devuelve el valor de la carta"""
-        return self.puntos_carta(carta['valor'])
+            elif tipo == FIN:
+                await self.finalizar_partida(evento[1])
 
     #-----------------------------------------------------------------------------------#
-    # Robar cartas y fase de arrastre                                                   #
+    # Fin partida                                                                       #
     #-----------------------------------------------------------------------------------#
 
-    async def robar_cartas(self):
-        """
-        Cada jugador roba una carta si hay mazo disponible y no 
-        estamos en fase de arrastre
-        """
-        estado_json = self.partida.estado_json
-        if not estado_json['fase_arrastre']:
-            baraja = estado_json.get('baraja', [])
-            if not baraja:
-                return
-            
-            # Orden de robo
-            ganador_id = estado_json.get("ultimo_ganador")
-            jugadores = await get_jugadores(self.partida)
-            orden_jugadores = sorted(jugadores, key=lambda x: x.id)
-            idx_ganador = await index_de_jugador(self.partida, ganador_id)
-            orden_jugadores = orden_jugadores[idx_ganador:] + orden_jugadores[:idx_ganador]
-
-            for jp in orden_jugadores:
-                if baraja:
-                    carta = baraja.pop()
-                    jp.cartas_json.append(carta)
-                    await db_sync_to_async_save(jp)
-
-                    if jp.channel_name:
-                        await self.channel_layer.send(jp.channel_name, {
-                            'type': 'private_message',
-                            'msg_type': MessageTypes.CARD_DRAWN,
-                            'data': {
-                                'carta': carta
-                            }
-                        })
-
-            estado_json['baraja'] = baraja
-            self.partida.estado_json = estado_json
-            await db_sync_to_async_save(self.partida)
-
-    async def verificar_fase_arrastre(self):
-        """Activa fase de arrastre si no quedan cartas en el mazo central y asigna la carta de triunfo al perdedor"""
-        if not self.partida.reglas_arrastre or self.partida.estado_json['fase_arrastre']:
+    async def forzar_fin_partida(self):
+        """Termina la mano en curso como si se hubieran acabado las cartas"""
+        if self.sala and self.sala.juego:
+            await self.procesar_eventos(fin_de_mano(self.sala.juego))
             return
 
-        estado_json = self.partida.estado_json
-        baraja = estado_json.get('baraja', [])
-
-        if len(baraja) == 0:
-            estado_json['fase_arrastre'] = True
-            self.partida.estado_json = estado_json
-            await db_sync_to_async_save(self.partida)
-
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.PHASE_UPDATE, data={
-                'message': 'La partida entra en fase de arrastre'
-            })
-
-    #-----------------------------------------------------------------------------------#
-    # Fin partida                                                                       #
-    #-----------------------------------------------------------------------------------#
-    async def comprobar_fin_partida(self):
-        """
-        Verifica las condiciones de fin de partida:
-        - Si estamos en revueltas, termina cuando un equipo supera los 100 puntos.
-        - Si estamos en partida normal, termina solo cuando se vacían las manos y el mazo,
-          y un équipo ha superado los 100 puntos.
-        """
-        try:
-            self.partida = await refresh(self.partida)
-        except Partida.DoesNotExist:
-            return False
-        estado_json = self.partida.estado_json
-
-        if self.partida.es_revueltas:
-            if self.partida.puntos_equipo_1 > 100 or self.partida.puntos_equipo_2 > 100:
-                await self.finalizar_partida()
-                return True
-            return False
-        
-        else:
-            if not estado_json.get('baraja'):
-                jugadores = await get_jugadores(self.partida)
-                manos_vacias = all(len(jp.cartas_json) == 0 for jp in jugadores)
-                if manos_vacias:
-                    await self.finalizar_partida()
-                    return True
-            return False
+        e1 = self.partida.puntos_equipo_1
+        e2 = self.partida.puntos_equipo_2
+        await self.finalizar_partida(1 if e1 > 100 else 2 if e2 > 100 else 0)
     
-    async def finalizar_partida(self):
+    async def finalizar_partida(self, ganador: int):
         """
-        Decide el equipo ganador según reglas:
-        - En partida normal, si ambos superan 100, gana quien hizo las 10 últimas.
-        - En revueltas, gana quien supera primero los 100.
+        Cierra la partida con el equipo ganador (0 si no gana nadie):
+        vuelca el estado, actualiza estadísticas y ELO y desconecta a los
+        jugadores
         """
-        try:
-            self.partida = await refresh(self.partida)
-        except Partida.DoesNotExist:
-            return
+        # Fin de partida: se vuelca el estado y se libera la sala
+        if self.sala:
+            await self.sala.cerrar()
 
         e1 = self.partida.puntos_equipo_1
         e2 = self.partida.puntos_equipo_2
 
-        if e1 > 100 and e2 > 100 and not self.partida.es_revueltas:
-            # Ambos equipos superan 100
-            # El que hizo las 10 últimas gana
-            ultimo_ganador_id = self.partida.estado_json.get('ultimo_ganador')
-            ganador = (await get_jugador_by_id(ultimo_ganador_id)).equipo if ultimo_ganador_id else 0
-        elif e1 > 100:
-            # Si un equipo supera 100, gana ese equipo
-            ganador = 1
-        elif e2 > 100:
-            # Si un equipo supera 100, gana ese equipo
-            ganador = 2
-        elif self.partida.permitir_revueltas:
-            await self.iniciar_revueltas()
+        # Una segunda llamada para la misma partida no vuelve a contar nada
+        jugadores = await liquidar_partida(self.partida, ganador)
+        if jugadores is None:
             return
-        else:
-            ganador = 0
-
-        jugadores = await get_jugadores(self.partida)
-        if not self.partida.es_personalizada:
-            await actualizar_estadisticas(self.partida, ganador)
-
-            # Get team players
-            equipo1 = [j for j in jugadores if j.equipo == 1]
-            equipo2 = [j for j in jugadores if j.equipo == 2]
-            
-            # Update ELOs
-            if self.capacidad == 2:
-                if not equipo1 or not equipo2:
-                    print("Error: Missing team members for 1v1 game")
-                    return
-                    
-                # 1v1 game
-                jugador1 = equipo1[0]
-                jugador2 = equipo2[0]
-                
-                # Get current ELOs
-                elo1 = await sync_to_async(lambda: jugador1.usuario.elo)()
-                elo2 = await sync_to_async(lambda: jugador2.usuario.elo)()
-                
-                # Calculate new ELOs
-                resultado = 1 if ganador == 1 else 0
-                nuevo_elo1, nuevo_elo2 = calcular_nuevo_elo(elo1, elo2, resultado)
-
-                # Update ELOs
-                await sync_to_async(lambda: setattr(jugador1.usuario, 'elo', nuevo_elo1))()
-                await sync_to_async(lambda: setattr(jugador2.usuario, 'elo', nuevo_elo2))()
-                await sync_to_async(lambda: jugador1.usuario.save())()
-                await sync_to_async(lambda: jugador2.usuario.save())()
-                
-                # Verify saved ELOs
-                saved_elo1 = await sync_to_async(lambda: jugador1.usuario.elo)()
-                saved_elo2 = await sync_to_async(lambda: jugador2.usuario.elo)()
-                
-            else:
-                # 2v2 game
-                elo_equipo1 = [await sync_to_async(lambda: j.usuario.elo_parejas)() for j in equipo1]
-                elo_equipo2 = [await sync_to_async(lambda: j.usuario.elo_parejas)() for j in equipo2]
-                
-                # Calculate new ELOs
-                resultado = 1 if ganador == 1 else 0
-                nuevo_elo1 = calcular_nuevo_elo_parejas(elo_equipo1, elo_equipo2, resultado)
-                nuevo_elo2 = calcular_nuevo_elo_parejas(elo_equipo2, elo_equipo1, 1 - resultado)
-                
-                # Update ELOs
-                for j, nuevo_elo in zip(equipo1, nuevo_elo1):
-                    await sync_to_async(lambda: setattr(j.usuario, 'elo_parejas', nuevo_elo))()
-                    await sync_to_async(lambda: j.usuario.save())()
-                
-                for j, nuevo_elo in zip(equipo2, nuevo_elo2):
-                    await sync_to_async(lambda: setattr(j.usuario, 'elo_parejas', nuevo_elo))()
-                    await sync_to_async(lambda: j.usuario.save())()
+        self.partida.estado = 'terminada'
+        self.partida.liquidada = True
 
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.GAME_OVER, {
+        await self.enviar_al_grupo(MessageTypes.GAME_OVER, {
             'message': "Fin de la partida.",
             'ganador_equipo': ganador,
             'puntos_equipo_1': e1,
@@ -805,56 +826,26 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         })
 
         for jugador in jugadores:
-            if jugador:
-                jugador.conectado = False
-                await db_sync_to_async_save(jugador)
-                if jugador.channel_name:
-                    await self.channel_layer.send(jugador.channel_name, {
-                        'type': 'close_connection'
-                    })
-
-        try:
-            await marcar_como_finalizada(self.partida)
-        except Partida.DoesNotExist:
-            return
-
-    async def iniciar_revueltas(self):
-        """Inicia la partida de revueltas"""
-        # Guardamos el ganador de la baza final, que será quien tenga el primer turno
-        # en revueltas
-        ultimo_ganador_id = self.partida.estado_json.get('ultimo_ganador')
-
-        self.partida.es_revueltas = True
-        self.partida.cantos_realizados = {}
-        await db_sync_to_async_save(self.partida)
-        await self.iniciar_partida()
-
-        # Restauramos último ganador
-        self.partida.estado_json['turno_actual_id'] = ultimo_ganador_id
-        await db_sync_to_async_save(self.partida)
-
-        await send_estado_jugadores(self, MessageTypes.START_GAME)
-        await self.iniciar_siguiente_turno()
+            if jugador.channel_name:
+                await self.channel_layer.send(jugador.channel_name, {
+                    'type': 'close_connection'
+                })
 
     #-----------------------------------------------------------------------------------#
     # Métodos auxiliares                                                                #
     #-----------------------------------------------------------------------------------#
 
     async def broadcast_message(self, event):
-        msg_type = event['msg_type']
-        data = event.get('data', {})
-        await self.send(text_data=json.dumps({
-            "type": msg_type,
-            "data": data
-        }))
+        # Mensaje del grupo ya codificado (send_to_group)
+        await self.private_message(event)
 
     async def private_message(self, event):
-        msg_type = event.get('msg_type')
-        data = event.get('data', {})
-        await self.send(text_data=json.dumps({
-            "type": msg_type,
-            "data": data
-        }))
+        # Mensaje ya codificado (send() lo pasa al protocolo compacto si hace
+        # falta); los eventos con msg_type y data se codifican aquí
+        if 'texto' in event:
+            await self.send(text_data=event['texto'])
+            return
+        await self.send(text_data=mensaje(event.get('msg_type'), event.get('data', {})))
 
     #-----------------------------------------------------------------------------------#
     # Lógica de cantos                                                                  #
@@ -862,93 +853,11 @@ class PartidaConsumer(AsyncWebsocketConsumer):
     
     async def procesar_canto(self):
         """Procesa la acción de cantar de un jugador"""
-        jugador: JugadorPartida = await get_jugador(self.partida, self.usuario)
-
-        # Validar que puede cantar
-        if not await self.puede_cantar(jugador):
+        if not self.sala or not self.sala.juego or not self.obtener_jugador():
             await send_error(self.send, "No puedes cantar ahora")
             return
-        
-        # Buscar cantos posibles
-        cantos = await self.detectar_cantos(jugador)
-        if not cantos:
-            await send_error(self.send, "No tienes cartas para cantar")
-            return
-        
-        # Aplicar cantos y sumar puntos
-        puntos = 0
-        canto_messages = []
-
-        for canto in cantos:
-            if canto['tipo'] == '20':
-                if canto['palo'] not in self.partida.cantos_realizados.get('20', []):
-                    if '20' not in self.partida.cantos_realizados:
-                        self.partida.cantos_realizados['20'] = []
-                    self.partida.cantos_realizados['20'].append(canto['palo'])
-                    puntos += 20
-                    canto_messages.append(f"20 ({canto['palo']})")
-            elif canto['tipo'] == '40':
-                if not self.partida.cantos_realizados.get('40', False):
-                    self.partida.cantos_realizados['40'] = True
-                    puntos += 40
-                    canto_messages.append("40 (triunfo)")
-
-        if puntos == 0:
-            await send_error(self.send, "No hay cantos válidos disponibles")
-            return
-        
-        # Sumar puntos al equipo
-        if jugador.equipo == 1:
-            self.partida.puntos_equipo_1 += puntos
-        else:
-            self.partida.puntos_equipo_2 += puntos
-        await db_sync_to_async_save(self.partida)
 
-        usuario = await sync_to_async(lambda: jugador.usuario)()
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.CANTO, {
-            'jugador': {
-                'id': usuario.id,
-                'nombre': usuario.nombre,
-                'equipo': jugador.equipo
-            },
-            'cantos': canto_messages,
-            'puntos': puntos,
-            'puntos_equipo_1': self.partida.puntos_equipo_1,
-            'puntos_equipo_2': self.partida.puntos_equipo_2
-        })
-
-    async def puede_cantar(self, jugador: JugadorPartida) -> bool:
-        """Determina si el jugador puede cantar"""
-        estado_json = self.partida.estado_json
-        
-        # Solo puede cantar si:
-        # 1. Su equipo ganó la última baza
-        # 2. No se ha tirado ninguna carta en la baza actual
-        ultimo_ganador = await get_jugador_by_id(estado_json.get('ultimo_ganador'))
-        
-        return (
-            ultimo_ganador and
-            ultimo_ganador.equipo == jugador.equipo and
-            len(estado_json.get('baza_actual', [])) == 0
-        )    
-
-    async def detectar_cantos(self, jugador: JugadorPartida) -> list:
-        """Detecta qué cantos puede hacer el jugador"""
-        cartas = jugador.cartas_json
-        palo_triunfo = self.partida.estado_json['triunfo']
-        cantos = []
-
-        for palo in self.palos:
-            tiene_rey = any(c['palo'] == palo and c['valor'] == 12 for c in cartas)
-            tiene_sota = any(c['palo'] == palo and c['valor'] == 10 for c in cartas)
-            
-            if tiene_rey and tiene_sota:
-                if palo == palo_triunfo:
-                    cantos.append({'tipo': '40', 'palo': palo})
-                else:
-                    cantos.append({'tipo': '20', 'palo': palo})
-        
-        return cantos
+        await self.aplicar_accion((CANTAR, self.asiento))
     
     #-----------------------------------------------------------------------------------#
     # Cambio del 7                                                                      #
@@ -956,57 +865,11 @@ class PartidaConsumer(AsyncWebsocketConsumer):
 
     async def procesar_cambio_siete(self):
         """Procesar la acción de cambiar el 7 de triunfo"""
-        estado_json = self.partida.estado_json
-        jugador: JugadorPartida = await get_jugador(self.partida, self.usuario)
-
-        # Validacion
-        if not await self.puede_cambiar_siete(jugador):
+        if not self.sala or not self.sala.juego or not self.obtener_jugador():
             await send_error(self.send, 'No puedes cambiar el 7 ahora')
             return
-        
-        palo_triunfo = estado_json['triunfo']
-        siete_triunfo = {'palo': palo_triunfo, 'valor': 7}
 
-        # Comprobar que tiene el 7 de triunfo
-        if siete_triunfo not in jugador.cartas_json:
-            await send_error(self.send, 'No tienes el 7 de triunfo')
-            return
-
-        # Intercambio
-        carta_triunfo_actual = estado_json['carta_triunfo']
-        jugador.cartas_json.remove(siete_triunfo)  
-        jugador.cartas_json.append(carta_triunfo_actual)
-        estado_json['carta_triunfo'] = siete_triunfo
-        estado_json['baraja'][0] = siete_triunfo
-        await db_sync_to_async_save(jugador)
-        await db_sync_to_async_save(self.partida)
-
-        usuario = await sync_to_async(lambda: jugador.usuario)()
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.CAMBIO_SIETE, {
-            'jugador': {
-                'id': usuario.id,
-                'nombre': usuario.nombre,
-                'equipo': jugador.equipo
-            },
-            'carta_robada': carta_triunfo_actual
-        })
-
-    async def puede_cambiar_siete(self, jugador: JugadorPartida) -> bool:
-        """Determina si el jugador puede cambiar el 7"""
-        estado_json = self.partida.estado_json
-        
-        # Solo puede cambiar si:
-        # 1. Su equipo ganó la última baza
-        # 2. No se ha tirado ninguna carta en la baza actual
-        # 3. No estamos en fase de arrastre
-        ultimo_ganador = await get_jugador_by_id(estado_json.get('ultimo_ganador'))
-        
-        return (
-            not estado_json.get('fase_arrastre', False) and
-            ultimo_ganador and
-            ultimo_ganador.equipo == jugador.equipo and
-            len(estado_json.get('baza_actual', [])) == 0
-        )
+        await self.aplicar_accion((CAMBIAR_SIETE, self.asiento))
     
     #-----------------------------------------------------------------------------------#
     # Pausar partida por acuerdo                                                                     #
@@ -1018,7 +881,7 @@ class PartidaConsumer(AsyncWebsocketConsumer):
             await send_error(self.send, 'Solo se puede pausar partidas en curso')
             return
         
-        jugador = await get_jugador(self.partida, self.usuario)
+        jugador = self.obtener_jugador()
         if not jugador:
             await send_error(self.send, 'No estás en la partida')
             return
@@ -1026,10 +889,12 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         # Añadir a lista de jugadores que han pedido pausa
         if str(jugador.id) not in self.partida.jugadores_pausa:
             self.partida.jugadores_pausa.append(str(jugador.id))
-            await db_sync_to_async_save(self.partida)
+            if self.sala:
+                self.sala.registrar(PAUSA, self.asiento)
+            await self.guardar_partida('jugadores_pausa', mutar=cambio_de_pausa(jugador.id, True))
             
-            usuario = await sync_to_async(lambda: jugador.usuario)()
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.PAUSE, {
+            usuario = self.usuario
+            await self.enviar_al_grupo(MessageTypes.PAUSE, {
                 'jugador': {
                     'id': usuario.id,
                     'nombre': usuario.nombre,
@@ -1048,7 +913,7 @@ class PartidaConsumer(AsyncWebsocketConsumer):
             await send_error(self.send, 'No hay pausa pendiente')
             return
         
-        jugador = await get_jugador(self.partida, self.usuario)
+        jugador = self.obtener_jugador()
         if not jugador:
             await send_error(self.send, 'No estás en esta partida')
             return
@@ -1056,10 +921,12 @@ class PartidaConsumer(AsyncWebsocketConsumer):
         # Quitar de la lista de jugadores que han pedido la pausa al jugador
         if str(jugador.id) in self.partida.jugadores_pausa:
             self.partida.jugadores_pausa.remove(str(jugador.id))
-            await db_sync_to_async_save(self.partida)
+            if self.sala:
+                self.sala.registrar(ANULAR_PAUSA, self.asiento)
+            await self.guardar_partida('jugadores_pausa', mutar=cambio_de_pausa(jugador.id, False))
 
-            usuario = await sync_to_async(lambda: jugador.usuario)()
-            await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.RESUME, {
+            usuario = self.usuario
+            await self.enviar_al_grupo(MessageTypes.RESUME, {
                 'jugador': {
                     'id': usuario.id,
                     'nombre': usuario.nombre,
@@ -1071,21 +938,26 @@ class PartidaConsumer(AsyncWebsocketConsumer):
     async def pausar_partida(self):
         """Pausa la partida y desconecta a todos los jugadores"""
         self.partida.estado = 'pausada'
-        await db_sync_to_async_save(self.partida)
-        
-        if self.timer_task and not self.timer_task.done():
-            self.timer_task.cancel()
 
-        await send_to_group(self.channel_layer, self.room_group_name, MessageTypes.ALL_PAUSE, {
+        # Punto de control: se vuelca el estado y se libera la sala
+        if self.sala:
+            self.sala.registrar(PAUSADA)
+            self.sala.marcar_partida()
+            jugadores = self.sala.jugadores
+            await self.sala.cerrar()
+        else:
+            await self.guardar_partida('estado')
+            jugadores = await get_jugadores(self.partida)
+
+        await self.enviar_al_grupo(MessageTypes.ALL_PAUSE, {
             'message': 'La partida ha sido pausada por acuerdo de todos los jugadores.'
         })
 
         # Desconectar a los jugadores
-        jugadores = await get_jugadores(self.partida)
         for jugador in jugadores:
             if jugador:
                 jugador.conectado = False
-                await db_sync_to_async_save(jugador)
+                await db_sync_to_async_save(jugador, update_fields=['conectado'])
                 if jugador.channel_name:
                     await self.channel_layer.send(jugador.channel_name, {
                         'type': 'close_connection'
@@ -1093,4 +965,5 @@ class PartidaConsumer(AsyncWebsocketConsumer):
 
     async def close_connection(self, event=None):
         """Cierra la conexión del websocket"""
-        await self.close()
\ No newline at end of file
+        await self.close()
+propiedad.al_recibir = PartidaConsumer.atender_remoto
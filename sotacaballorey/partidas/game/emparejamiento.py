@@ -0,0 +1,538 @@
+"""
+Emparejamiento de jugadores en salas en espera.
+
+Cada configuración de partida tiene su cola de salas abiertas (con hueco) en
+memoria. Los huecos se reservan sin esperas intermedias, así que dos
+conexiones simultáneas no pueden crear dos salas para la misma plaza ni
+llenar una sala por encima de su capacidad, y encontrar sala no consulta la
+base de datos: la partida se crea una sola vez, cuando llega su primer
+jugador, y sale de la cola en cuanto se llena.
+
+En las partidas clasificatorias (no personalizadas) las salas se ordenan por
+el Elo medio de sus jugadores y cada jugador entra en la sala de Elo más
+cercano, siempre que la diferencia quepa en la ventana de la sala: la
+ventana empieza en VENTANA_ELO_INICIAL y se ensancha con lo que lleva
+esperando, para que nadie se quede sin rival. Como la ventana crece aunque
+no llegue nadie, cada INTERVALO_REUNION segundos se reúnen las salas que
+ya caben en la ventana de otra: sus jugadores se pasan a la más antigua.
+
+Las colas son de cada proceso. Cuando un jugador no cabe en ninguna sala de
+su proceso, antes de abrir otra se adoptan las salas en espera de la base de
+datos que ha abierto otro proceso, y al arrancar se reconstruyen las colas
+con las que había (recuperacion.py). Como dos procesos pueden llevar la
+misma sala, la capacidad se vuelve a comprobar en la base de datos, con la
+partida bloqueada, al agregar al jugador (utils.agregar_jugador).
+"""
+from partidas.metricas import registrar_metricas, percentil
+from .utils import crear_partida, obtener_amigos_ids, obtener_elo, leer_salas_en_espera
+from channels.layers import get_channel_layer
+from typing import NamedTuple
+from collections import deque
+import itertools
+import asyncio
+import bisect
+import time
+
+# Diferencia de Elo admitida: inicial y lo que crece por segundo de espera
+VENTANA_ELO_INICIAL = 100
+VENTANA_ELO_POR_SEGUNDO = 20
+
+# Cada cuánto se reúnen las salas clasificatorias en espera (s)
+INTERVALO_REUNION = 5
+
+# Límites superiores de los histogramas (el último cubo es "más")
+CUBOS_ESPERA = (1, 5, 15, 30, 60, 120, 300)             # s
+CUBOS_PROFUNDIDAD = (0, 1, 2, 5, 10, 20, 50, 100)       # jugadores en cola
+
+class ConfigPartida(NamedTuple):
+    """Configuración que deben compartir los jugadores de una sala"""
+    capacidad: int = 2
+    es_personalizada: bool = False
+    tiempo_turno: int = 30
+    reglas_arrastre: bool = True
+    permitir_revueltas: bool = True
+    solo_amigos: bool = False
+
+def config_personalizada(params: dict) -> ConfigPartida:
+    """Leer parámetros de la URL de conexión a una partida personalizada"""
+    try:
+        capacidad_value = params.get('capacidad', 2)
+        if isinstance(capacidad_value, list):
+            capacidad_value = str(capacidad_value[0])
+        else:
+            capacidad_value = str(capacidad_value)
+        capacidad = 2 if int(capacidad_value) not in [2,4] else int(capacidad_value)
+    except Exception as e:
+        print(f"Error al obtener la capacidad: {e}")
+        capacidad = 2
+
+    try:
+        tiempo_turno_value = params.get('tiempo_turno', 30)
+        if isinstance(tiempo_turno_value, list):
+            tiempo_turno_value = str(tiempo_turno_value[0])
+        else:
+            tiempo_turno_value = str(tiempo_turno_value)
+        tiempo_turno = 30 if int(tiempo_turno_value) not in [15, 30, 60] else int(tiempo_turno_value)
+    except Exception as e:
+        print(f"Error al obtener el tiempo de turno: {e}")
+        tiempo_turno = 30
+
+    return ConfigPartida(
+        capacidad=capacidad,
+        es_personalizada=True,
+        tiempo_turno=tiempo_turno,
+        reglas_arrastre=params.get('reglas_arrastre', ['true'])[0].lower() == 'true',
+        permitir_revueltas=params.get('permitir_revueltas', ['true'])[0].lower() == 'true',
+        solo_amigos=params.get('solo_amigos', ['false'])[0].lower() == 'true'
+    )
+
+class SalaEnEspera:
+    """Sala abierta de la cola: jugadores que tiene reservados y su partida"""
+
+    def __init__(self, config: ConfigPartida, loop, ahora: float):
+        self.config = config
+        self.usuarios = {}                      # usuario_id -> (instante de reserva, Elo)
+        self.partida = loop.create_future()     # Partida cuando se haya creado
+        self.partida_id = None
+        self.creada = ahora
+        self.clave = None                       # Posición en el índice por Elo
+        self.secuencia = None                   # Orden de llegada a la cola (desempate)
+        self.reunidas = []                      # Partidas que se han reunido en esta
+
+    @property
+    def llena(self) -> bool:
+        return len(self.usuarios) >= self.config.capacidad
+
+    @property
+    def elo(self) -> float:
+        """Elo medio de los jugadores que tienen Elo conocido"""
+        elos = [elo for _, elo in self.usuarios.values() if elo is not None]
+        return sum(elos) / len(elos) if elos else None
+
+class ColaSalas:
+    """
+    Salas abiertas de una configuración. En orden de llegada y, si la cola es
+    clasificatoria, también en una lista ordenada por Elo medio donde se busca
+    con bisect: solo se miran las salas cuyo Elo cabe en la ventana más ancha
+    (la de la sala que más lleva esperando)
+    """
+
+    def __init__(self, por_elo: bool):
+        self.por_elo = por_elo
+        self.salas = {}         # sala -> None (diccionario como conjunto ordenado)
+        self.indice = []        # [(elo, secuencia, sala)] ordenado
+        self.jugadores = 0      # Jugadores esperando en las salas de la cola
+        self._secuencia = itertools.count()
+
+    def __len__(self):
+        return len(self.salas)
+
+    def añadir(self, sala: SalaEnEspera):
+        sala.secuencia = next(self._secuencia)
+        self.salas[sala] = None
+        self.jugadores += len(sala.usuarios)
+        self.indexar(sala)
+
+    def quitar(self, sala: SalaEnEspera):
+        if self.salas.pop(sala, False) is not False:
+            self.jugadores -= len(sala.usuarios)
+            self._desindexar(sala)
+
+    def indexar(self, sala: SalaEnEspera):
+        """(Re)coloca la sala en el índice por Elo tras cambiar sus jugadores"""
+        if not self.por_elo or sala not in self.salas:
+            return
+        self._desindexar(sala)
+        elo = sala.elo
+        if elo is not None:
+            sala.clave = (elo, sala.secuencia, sala)
+            bisect.insort(self.indice, sala.clave, key=lambda c: c[:2])
+
+    def _desindexar(self, sala: SalaEnEspera):
+        if sala.clave is None:
+            return
+        i = bisect.bisect_left(self.indice, sala.clave[:2], key=lambda c: c[:2])
+        if i < len(self.indice) and self.indice[i] is sala.clave:
+            del self.indice[i]
+        sala.clave = None
+
+    def buscar(self, usuario_id: int, elo, amigos: set, ahora: float):
+        """Sala en la que puede entrar el usuario (None si no hay)"""
+        if not self.por_elo or elo is None:
+            for sala in self.salas:
+                if usuario_id in sala.usuarios:
+                    continue
+                if amigos is not None and sala.usuarios and not (sala.usuarios.keys() & amigos):
+                    continue
+                return sala
+            return None
+
+        # Recorre el índice hacia los dos lados desde el Elo del jugador
+        # mientras la diferencia quepa en la ventana más ancha posible
+        limite = ventana_elo(ahora - next(iter(self.salas)).creada) if self.salas else 0
+        derecha = bisect.bisect_left(self.indice, elo, key=lambda c: c[0])
+        izquierda = derecha - 1
+        while izquierda >= 0 or derecha < len(self.indice):
+            dist_izq = elo - self.indice[izquierda][0] if izquierda >= 0 else None
+            dist_der = self.indice[derecha][0] - elo if derecha < len(self.indice) else None
+            if dist_der is None or (dist_izq is not None and dist_izq <= dist_der):
+                distancia, sala = dist_izq, self.indice[izquierda][2]
+                izquierda -= 1
+            else:
+                distancia, sala = dist_der, self.indice[derecha][2]
+                derecha += 1
+            if distancia > limite:
+                break
+            if usuario_id not in sala.usuarios and distancia <= ventana_elo(ahora - sala.creada):
+                return sala
+        return None
+
+    def reunibles(self, ahora: float) -> list:
+        """
+        Parejas (origen, destino) de salas con partida que caben juntas y cuyo
+        Elo cabe en la ventana del destino, la sala que más lleva esperando
+        """
+        if not self.por_elo:
+            return []
+        parejas = []
+        usadas = set()
+        salas = [s for s in self.salas if s.partida_id is not None and s.elo is not None]
+        for i, destino in enumerate(salas):
+            if destino in usadas:
+                continue
+            ventana = ventana_elo(ahora - destino.creada)
+            for origen in salas[i + 1:]:
+                if origen in usadas or \
+                    len(destino.usuarios) + len(origen.usuarios) > destino.config.capacidad or \
+                    destino.usuarios.keys() & origen.usuarios.keys():
+                        continue
+                if abs(origen.elo - destino.elo) <= ventana:
+                    parejas.append((origen, destino))
+                    usadas.update((origen, destino))
+                    break
+        return parejas
+
+def ventana_elo(espera: float) -> float:
+    """Diferencia de Elo que admite una sala que lleva <espera> segundos abierta"""
+    return VENTANA_ELO_INICIAL + VENTANA_ELO_POR_SEGUNDO * max(0.0, espera)
+
+def _histograma(cubos: tuple, unidad: str = '') -> dict:
+    return {**{f'<={c}{unidad}': 0 for c in cubos}, f'>{cubos[-1]}{unidad}': 0}
+
+def _contar(histograma: dict, cubos: tuple, valor: float, unidad: str = ''):
+    for c in cubos:
+        if valor <= c:
+            histograma[f'<={c}{unidad}'] += 1
+            return
+    histograma[f'>{cubos[-1]}{unidad}'] += 1
+
+def nombre_cola(config: ConfigPartida) -> str:
+    """Nombre legible de la cola de una configuración (para las métricas)"""
+    if not config.es_personalizada:
+        return f'{config.capacidad}-clasificatoria'
+    return (f'{config.capacidad}-personalizada-{config.tiempo_turno}s'
+            f'{"-arrastre" if config.reglas_arrastre else ""}'
+            f'{"-revueltas" if config.permitir_revueltas else ""}'
+            f'{"-amigos" if config.solo_amigos else ""}')
+
+class Emparejador:
+    """
+    Colas de salas en espera por configuración de partida. Las partidas que
+    ya están en curso o se han borrado no están en ninguna cola
+    """
+
+    def __init__(self, muestras: int = 1000, ventana: float = 60.0, reloj=time.monotonic):
+        self._colas = {}            # config -> ColaSalas con hueco
+        self._salas = {}            # partida_id -> sala (con partida creada)
+        self._reunidas = {}         # partida_id de origen -> sala en la que se ha reunido
+        self._reunion = None        # Llamada programada para reunir salas
+        self._loop = None
+        self.reloj = reloj
+
+        # Métricas
+        self.ventana = ventana
+        self.emparejados = 0
+        self.salas_creadas = 0
+        self.salas_llenas = 0
+        self.salas_adoptadas = 0
+        self.reuniones = 0
+        self._asignaciones = deque(maxlen=100000)   # instantes de asignación
+        self._llenados = deque(maxlen=muestras)     # s hasta llenar la sala
+        self._esperas = deque(maxlen=muestras)      # s de cada jugador hasta llenar su sala
+        self._diferencias = deque(maxlen=muestras)  # Elo entre el jugador y su sala
+        self.histograma_espera = _histograma(CUBOS_ESPERA, 's')
+        self.histograma_profundidad = _histograma(CUBOS_PROFUNDIDAD)
+
+    def _bucle(self):
+        """Bucle de eventos actual. Si ha cambiado, se descartan las colas viejas"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._colas = {}
+            self._salas = {}
+            self._reunidas = {}
+            self._reunion = None
+        return loop
+
+    def _cola(self, config: ConfigPartida) -> ColaSalas:
+        cola = self._colas.get(config)
+        if cola is None:
+            cola = self._colas[config] = ColaSalas(por_elo=not config.es_personalizada)
+        return cola
+
+    async def asignar(self, usuario, config: ConfigPartida, elo: float = None):
+        """
+        Reserva al usuario un hueco en una sala con la configuración dada y
+        devuelve su partida. Si no hay sala abierta se crea la partida. En las
+        clasificatorias se empareja por <elo> (si no se da, se lee el del
+        usuario: individual o de parejas según la capacidad)
+        """
+        loop = self._bucle()
+        amigos = await obtener_amigos_ids(usuario) if config.solo_amigos else None
+        if elo is None and not config.es_personalizada:
+            elo = await obtener_elo(usuario, config.capacidad)
+
+        # Sin esperas desde que se busca la sala hasta que se reserva el hueco
+        ahora = self.reloj()
+        cola = self._cola(config)
+        _contar(self.histograma_profundidad, CUBOS_PROFUNDIDAD, cola.jugadores)
+        sala = cola.buscar(usuario.id, elo, amigos, ahora)
+        if sala is None:
+            # Antes de abrir otra, las que otros procesos tengan abiertas
+            await self.sincronizar(config)
+            ahora = self.reloj()
+            cola = self._cola(config)
+            sala = cola.buscar(usuario.id, elo, amigos, ahora)
+        nueva = sala is None
+        if nueva:
+            sala = SalaEnEspera(config, loop, ahora)
+            cola.añadir(sala)
+            self.salas_creadas += 1
+        elif elo is not None and sala.elo is not None:
+            self._diferencias.append(abs(elo - sala.elo))
+        self._reservar(sala, usuario.id, elo)
+
+        if not nueva:
+            return await asyncio.shield(sala.partida)
+        try:
+            partida = await crear_partida(config._asdict())
+        except BaseException as e:
+            # También si se cancela la conexión que la crea: los que esperan
+            # en la sala reciben el error y la sala sale de la cola
+            self._descartar(sala)
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError('Se ha cancelado la creación de la partida')
+            sala.partida.set_exception(e)
+            raise
+        sala.partida_id = partida.id
+        self._salas[partida.id] = sala
+        sala.partida.set_result(partida)
+        if not sala.llena and not config.es_personalizada:
+            self._programar_reunion()
+        return partida
+
+    def _reservar(self, sala: SalaEnEspera, usuario_id: int, elo: float = None):
+        ahora = self.reloj()
+        sala.usuarios[usuario_id] = (ahora, elo)
+        cola = self._cola(sala.config)
+        if sala in cola.salas:
+            cola.jugadores += 1
+        self.emparejados += 1
+        self._asignaciones.append(ahora)
+        if sala.llena:
+            self._completar(sala, ahora)
+        else:
+            cola.indexar(sala)
+
+    def _completar(self, sala: SalaEnEspera, ahora: float):
+        """La sala se ha llenado: sale de la cola"""
+        self._descartar(sala)
+        self.salas_llenas += 1
+        self._llenados.append(ahora - sala.creada)
+        for reserva, _ in sala.usuarios.values():
+            self._esperas.append(ahora - reserva)
+            _contar(self.histograma_espera, CUBOS_ESPERA, ahora - reserva, 's')
+
+    #-----------------------------------------------------------------------------------#
+    # Reunión de salas en espera                                                        #
+    #-----------------------------------------------------------------------------------#
+
+    def reunir(self) -> list:
+        """
+        Pasa los jugadores de las salas que ya caben en la ventana de otra a
+        esta. Devuelve las parejas (partida de origen, partida de destino)
+        """
+        self._bucle()
+        ahora = self.reloj()
+        reunidas = []
+        for cola in list(self._colas.values()):
+            for origen, destino in cola.reunibles(ahora):
+                self._diferencias.append(abs(origen.elo - destino.elo))
+                cola.quitar(origen)
+                self._salas.pop(origen.partida_id, None)
+                destino.usuarios.update(origen.usuarios)
+                destino.reunidas.append(origen.partida_id)
+                self._reunidas[origen.partida_id] = destino
+                cola.jugadores += len(origen.usuarios)
+                self.reuniones += 1
+                if destino.llena:
+                    self._completar(destino, ahora)
+                else:
+                    cola.indexar(destino)
+                reunidas.append((origen.partida_id, destino.partida_id))
+        return reunidas
+
+    def reunida_en(self, partida_id):
+        """Partida en la que se ha reunido la sala de <partida_id> (None si no)"""
+        self._bucle()
+        destino = self._reunidas.get(partida_id)
+        return destino.partida_id if destino else None
+
+    def _programar_reunion(self):
+        if self._reunion is None:
+            self._reunion = self._loop.call_later(INTERVALO_REUNION,
+                lambda: asyncio.ensure_future(self._reunir_y_avisar()))
+
+    async def _reunir_y_avisar(self):
+        """
+        Reúne las salas y avisa a las conexiones de las de origen para que
+        se pasen a su destino. Se vuelve a programar mientras haya salas
+        clasificatorias que reunir
+        """
+        self._reunion = None
+        try:
+            channel_layer = get_channel_layer()
+            for origen, destino in self.reunir():
+                await channel_layer.group_send(f'partida_{origen}', {
+                    'type': 'cambiar_partida',
+                    'origen': origen,
+                    'destino': destino
+                })
+        except Exception as e:
+            print(f"Error al reunir salas en espera: {e}")
+        if any(cola.por_elo and len(cola) > 1 for cola in self._colas.values()):
+            self._programar_reunion()
+
+    def _descartar(self, sala: SalaEnEspera):
+        """Saca la sala de su cola (si estaba)"""
+        cola = self._colas.get(sala.config)
+        if cola is None:
+            return
+        cola.quitar(sala)
+        if not cola:
+            del self._colas[sala.config]
+
+    def ocupar(self, partida_id, usuario_id: int) -> bool:
+        """
+        Un usuario entra por id en una sala en espera: ocupa un hueco.
+        Devuelve False si la sala ya está llena. Si la sala no está en este
+        proceso el hueco se comprueba en la base de datos al agregar al jugador
+        """
+        self._bucle()
+        sala = self._salas.get(partida_id)
+        if sala is None or usuario_id in sala.usuarios:
+            return True
+        if sala.llena:
+            return False
+        self._reservar(sala, usuario_id)
+        return True
+
+    def liberar(self, partida_id, usuario_id: int):
+        """
+        Un usuario sale de una sala que no ha empezado: su hueco vuelve a estar
+        libre. Devuelve cuántos jugadores le quedan a la sala (None si la sala
+        no está en el emparejador)
+        """
+        self._bucle()
+        sala = self._salas.get(partida_id)
+        if sala is None:
+            return None
+        if usuario_id not in sala.usuarios:
+            return len(sala.usuarios)
+        estaba_llena = sala.llena
+        cola = self._cola(sala.config)
+        if sala in cola.salas:
+            cola.jugadores -= 1
+        del sala.usuarios[usuario_id]
+        if estaba_llena:
+            sala.creada = self.reloj()
+            cola.añadir(sala)
+        else:
+            cola.indexar(sala)
+        return len(sala.usuarios)
+
+    def cerrar(self, partida_id):
+        """La partida empieza o se borra: deja de admitir jugadores"""
+        self._bucle()
+        sala = self._salas.pop(partida_id, None)
+        if sala:
+            self._descartar(sala)
+            for origen in sala.reunidas:
+                self._reunidas.pop(origen, None)
+
+    async def sincronizar(self, config: ConfigPartida = None):
+        """
+        Pone al día las colas con las salas en espera de la base de datos (las
+        de <config> o, si no se da, todas): adopta las que tienen jugadores y
+        hueco y no están en este proceso, y descarta las que ya no están en
+        espera
+        """
+        self._bucle()
+        conocidas = set(self._salas)
+        salas = await leer_salas_en_espera(config._asdict() if config else {})
+        ahora = self.reloj()
+
+        en_espera = {partida.id for partida, _ in salas}
+        for partida_id in conocidas - en_espera:
+            sala = self._salas.get(partida_id)
+            if sala and (config is None or sala.config == config):
+                self.cerrar(partida_id)
+
+        for partida, elos in salas:
+            if partida.id in self._salas or partida.id in self._reunidas or \
+                not elos or len(elos) >= partida.capacidad:
+                    continue
+            config_sala = ConfigPartida(**{c: getattr(partida, c) for c in ConfigPartida._fields})
+            sala = SalaEnEspera(config_sala, self._loop, ahora)
+            sala.partida.set_result(partida)
+            sala.partida_id = partida.id
+            por_elo = not config_sala.es_personalizada
+            sala.usuarios = {u: (ahora, elo if por_elo else None) for u, elo in elos.items()}
+            self._salas[partida.id] = sala
+            self._cola(config_sala).añadir(sala)
+            self.salas_adoptadas += 1
+
+    def metricas(self) -> dict:
+        """
+        Salas abiertas, jugadores en espera (por cola), salas adoptadas de la
+        base de datos, salas reunidas, emparejamientos/s, tiempo de llenado
+        (ms), espera de los jugadores (s), diferencia de Elo al emparejar e
+        histogramas de espera y de profundidad de la cola
+        """
+        ahora = self.reloj()
+        recientes = sum(1 for t in self._asignaciones if ahora - t <= self.ventana)
+        llenados = [t * 1000 for t in self._llenados]
+        profundidad = {nombre_cola(config): cola.jugadores for config, cola in self._colas.items()}
+        return {
+            'salas_abiertas': sum(len(cola) for cola in self._colas.values()),
+            'jugadores_esperando': sum(profundidad.values()),
+            'profundidad': profundidad,
+            'emparejados': self.emparejados,
+            'salas_creadas': self.salas_creadas,
+            'salas_llenas': self.salas_llenas,
+            'salas_adoptadas': self.salas_adoptadas,
+            'reuniones': self.reuniones,
+            'emparejados_por_segundo': recientes / self.ventana,
+            'llenado_p50_ms': percentil(llenados, 50),
+            'llenado_p99_ms': percentil(llenados, 99),
+            'espera_p50_s': percentil(self._esperas, 50),
+            'espera_p99_s': percentil(self._esperas, 99),
+            'diferencia_elo_p50': percentil(self._diferencias, 50),
+            'diferencia_elo_p99': percentil(self._diferencias, 99),
+            'histograma_espera': dict(self.histograma_espera),
+            'histograma_profundidad': dict(self.histograma_profundidad),
+        }
+
+# Emparejador único del proceso
+emparejador = Emparejador()
+registrar_metricas('emparejamiento', emparejador.metricas)
@@ -0,0 +1,114 @@
+"""
+Canal del lobby (/ws/lobby/): al conectarse se recibe la lista de salas en
+espera y después solo los cambios (sala creada, jugador que entra o sale y
+partida que empieza), así que el coste del lobby depende de lo que cambian
+las salas y no de cada cuánto se consulta la lista.
+
+Cada cambio se publica en el grupo de su capacidad (si la sala no es solo
+de amigos) y en el grupo de cada jugador de la sala, al que se suscriben sus
+amigos. Cada mensaje lleva la sala completa (o null si ya no está en espera),
+así que recibir el mismo cambio por dos grupos no tiene efecto
+"""
+from partidas.lobby import salas_en_espera, sala_en_espera
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from .messages import MessageTypes, send_to_group, mensaje
+from .utils import obtener_amigos_ids
+import urllib.parse
+
+def grupo_capacidad(capacidad: int) -> str:
+    return f'lobby_{capacidad}'
+
+def grupo_jugador(usuario_id: int) -> str:
+    return f'lobby_jugador_{usuario_id}'
+
+class LobbyConsumer(AsyncWebsocketConsumer):
+    """
+    Lista de salas en espera en tiempo real
+    ├─ QueryParam opcional: capacidad (2|4). Sin ella, las de ambas capacidades
+    └─ QueryParam opcional: amigos=true para las salas con algún amigo dentro
+    """
+
+    async def connect(self):
+        self.usuario = self.scope.get('usuario', None)
+        if not self.usuario or isinstance(self.usuario, AnonymousUser):
+            await self.close()
+            return
+
+        params = urllib.parse.parse_qs(self.scope['query_string'].decode())
+        capacidad = params.get('capacidad', [None])[0]
+        self.amigos = params.get('amigos', ['false'])[0].lower() == 'true'
+
+        # Primero se entra en los grupos y después se lee la lista: un cambio
+        # que llegue mientras tanto se recibe después de la lista
+        if self.amigos:
+            self.ids_amigos = await obtener_amigos_ids(self.usuario)
+            self.grupos = [grupo_jugador(i) for i in self.ids_amigos]
+        else:
+            self.capacidades = [int(capacidad)] if capacidad in ('2', '4') else [2, 4]
+            self.grupos = [grupo_capacidad(c) for c in self.capacidades]
+        for grupo in self.grupos:
+            await self.channel_layer.group_add(grupo, self.channel_name)
+
+        await self.accept()
+        await self.send(text_data=mensaje(
+            MessageTypes.LOBBY_SNAPSHOT, {'salas': await self.lista_inicial()}))
+
+    @database_sync_to_async
+    def lista_inicial(self) -> list:
+        """Salas en espera que vería el usuario en los listados de /salas/"""
+        if self.amigos:
+            return [
+                sala for sala, usuarios, _ in salas_en_espera()
+                if self.usuario.id not in usuarios and self.ids_amigos.intersection(usuarios)
+            ]
+        return [
+            sala for sala, usuarios, solo_amigos in salas_en_espera()
+            if not solo_amigos and self.usuario.id not in usuarios and
+                sala['capacidad'] in self.capacidades
+        ]
+
+    async def disconnect(self, code):
+        for grupo in getattr(self, 'grupos', []):
+            await self.channel_layer.group_discard(grupo, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # El lobby solo envía; los mensajes del cliente se ignoran
+        pass
+
+    async def broadcast_message(self, event):
+        # Mensaje ya codificado por send_to_group
+        if 'texto' in event:
+            await self.send(text_data=event['texto'])
+            return
+        await self.send(text_data=mensaje(event['msg_type'], event.get('data', {})))
+
+#-----------------------------------------------------------------------------------#
+# Publicación de cambios                                                            #
+#-----------------------------------------------------------------------------------#
+
+async def publicar_lobby(channel_layer, msg_type: str, partida, usuario=None, usuarios=()):
+    """
+    Publica en el lobby un cambio de la sala de <partida>: la sala tal como
+    queda, el usuario que entra o sale y a quién afecta. <usuarios> son los
+    jugadores que había en la sala si ya no está en espera (empieza o se borra)
+    """
+    # Una partida que empieza aún puede figurar en espera en la base de datos
+    # hasta que la sala se vuelque, así que no se consulta
+    datos = None
+    if msg_type != MessageTypes.ROOM_STARTED:
+        datos = await database_sync_to_async(sala_en_espera)(partida.id)
+    sala, jugadores, solo_amigos = datos if datos else (None, [], partida.solo_amigos)
+
+    data = {'sala_id': partida.id, 'sala': sala}
+    if usuario:
+        data['usuario'] = {'id': usuario.id, 'nombre': usuario.nombre}
+
+    grupos = {grupo_jugador(i) for i in (*jugadores, *usuarios)}
+    if usuario:
+        grupos.add(grupo_jugador(usuario.id))
+    if not solo_amigos:
+        grupos.add(grupo_capacidad(partida.capacidad))
+    for grupo in grupos:
+        await send_to_group(channel_layer, grupo, msg_type, data)
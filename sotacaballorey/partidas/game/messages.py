@@ -1,6 +1,6 @@
-from asgiref.sync import sync_to_async
+from utils.serializacion import codificar
+from .cartas import int_a_carta, cartas_de
 from .utils import *
-import json
 
 class MessageTypes:
     START_GAME = 'start_game'
@@ -20,88 +20,115 @@ class MessageTypes:
     RESUME = "resume"
     DEBUG_STATE = "debug_state"
     SCORE_UPDATE = "score_update"
+    # Lobby
+    LOBBY_SNAPSHOT = "lobby_snapshot"
+    ROOM_CREATED = "room_created"
+    ROOM_STARTED = "room_started"
 
 #-----------------------------------------------------------------------------------#
 # Métodos para enviar mensajes al front-end                                         #
 #-----------------------------------------------------------------------------------#
 
-async def send_error(send, mensaje: str):
+def mensaje(msg_type: str, data, secuencia: int = None) -> str:
+    """Mensaje para el front-end ya codificado (con su número si es de una sala)"""
+    if secuencia is None:
+        return codificar({'type': msg_type, 'data': data})
+    return codificar({'type': msg_type, 'seq': secuencia, 'data': data})
+
+def evento(tipo: str, msg_type: str, data, secuencia: int = None) -> dict:
+    """
+    Evento de la capa de canales con el mensaje codificado una vez en JSON.
+    Las conexiones con el protocolo compacto lo convierten al enviarlo
+    """
+    return {'type': tipo, 'texto': mensaje(msg_type, data, secuencia)}
+
+def mensaje_privado(msg_type: str, data) -> dict:
+    """Evento para enviar por el canal de un jugador (private_message)"""
+    return evento('private_message', msg_type, data)
+
+async def send_error(send, texto: str):
     """Envía al jugador actual (self) un mensaje de error"""
-    await send(text_data=json.dumps({
-        'type': MessageTypes.ERROR,
-        'data': { 'message': mensaje } 
-    }))
+    await send(text_data=mensaje(MessageTypes.ERROR, {'message': texto}))
 
-async def send_to_group(channel_layer, room_group_name, msg_type: str, data):
-    """Envía un mensaje con msg_type a todos en el grupo"""
-    await channel_layer.group_send(
-        room_group_name,
-        {
-            'type': 'broadcast_message',
-            'msg_type': msg_type,
-            'data': data
-        }
-    )
+async def send_to_group(channel_layer, room_group_name, msg_type: str, data, sala=None):
+    """
+    Envía un mensaje con msg_type a todos en el grupo. Se codifica una vez y
+    cada miembro lo reenvía tal cual. Si la partida tiene <sala>, el mensaje
+    se numera y se guarda para quien se reconecte
+    """
+    secuencia = sala.numerar() if sala else None
+    contenido = evento('broadcast_message', msg_type, data, secuencia)
+    if sala:
+        sala.guardar_mensaje(secuencia, contenido)
+    await channel_layer.group_send(room_group_name, contenido)
 
-async def send_estado_jugadores(self, msg_type: str, solo_jugador: JugadorPartida = None):
-    estado_json = self.partida.estado_json
-    mazo = estado_json.get('baraja', [])
-    fase_arrastre = estado_json.get('fase_arrastre', False)
-    carta_triunfo = estado_json.get('carta_triunfo')
-    todos_jugadores = await get_jugadores(self.partida)
+async def send_to_jugador(channel_layer, sala, jp: JugadorPartida, msg_type: str, data):
+    """
+    Envía un mensaje numerado solo al jugador <jp> de la sala. Se guarda
+    aunque no esté conectado, para dárselo cuando se reconecte
+    """
+    secuencia = sala.numerar()
+    contenido = evento('private_message', msg_type, data, secuencia)
+    sala.guardar_mensaje(secuencia, contenido, jp.id)
+    if jp.channel_name:
+        await channel_layer.send(jp.channel_name, contenido)
 
-    baza_actual = estado_json.get('baza_actual', [])
-    cartas_jugadas = {b['jugador_id']: b['carta'] for b in baza_actual}
+async def send_estado_jugadores(self, msg_type: str, solo_jugador: JugadorPartida = None):
+    """
+    Envía a cada jugador (o solo a <solo_jugador>) el estado de la partida
+    con su mano. Se lee del motor de la sala, sin consultar la base de datos.
+    La parte común se prepara una vez y a cada jugador se le serializa con su
+    mano.
 
-    usuario = None
-    try:
-        turno_id = self.partida.estado_json.get('turno_actual_id')
-        if isinstance(turno_id, int):
-            jugador_turno = await get_jugador_by_id(turno_id)
-            if jugador_turno:
-                usuario = await sync_to_async(lambda: jugador_turno.usuario)()
-    except Exception as e:
-        print(f"Error: {e}")
+    El estado enviado a todos es un mensaje numerado más de la sala; el que
+    se envía solo a quien se reconecta lleva el número del último mensaje,
+    a partir del que puede pedir lo que le falte si se vuelve a cortar
+    """
+    sala = self.sala
+    juego = sala.juego
+    todos_jugadores = sala.jugadores
+    cartas_jugadas = {asiento: int_a_carta(carta) for asiento, carta in juego.baza}
+    usuario = sala.jugador_en(juego.turno).usuario
         
     players_info = []
-    for jp in todos_jugadores:
-        u = await sync_to_async(lambda: jp.usuario)()
-        carta_jugada = cartas_jugadas.get(jp.id, None)
+    for asiento, jp in enumerate(todos_jugadores):
+        u = jp.usuario
         players_info.append({
             'id': u.id,
             'nombre': u.nombre,
             'equipo': jp.equipo,
-            'num_cartas': len(jp.cartas_json),
-            'carta_jugada': carta_jugada
+            'num_cartas': juego.manos[asiento].bit_count(),
+            'carta_jugada': cartas_jugadas.get(asiento, None)
         })
 
-    chat_id = await obtener_chat_id(self.partida)
+    chat_id = self.partida.chat_id or await obtener_chat_id(self.partida)
+    data = {
+        'jugadores': players_info,
+        'mazo_restante': len(juego.baraja),
+        'fase_arrastre': juego.fase_arrastre,
+        'carta_triunfo': int_a_carta(juego.carta_triunfo),
+        'chat_id': chat_id,
+        'tiempo_turno': self.partida.tiempo_turno,
+        'puntos_equipo_1': juego.puntos[0],
+        'puntos_equipo_2': juego.puntos[1],
+        'pausados': len(self.partida.jugadores_pausa or []),
+        'turno': usuario.id,
+        'epoca': sala.epoca
+    }
+    secuencia = sala.secuencia if solo_jugador else sala.numerar()
 
     jugadores_a_enviar = [solo_jugador] if solo_jugador else todos_jugadores
     for jp in jugadores_a_enviar:
-        data_para_jugador = {
-            'jugadores': players_info,
-            'mazo_restante': len(mazo),
-            'fase_arrastre': fase_arrastre,
-            'mis_cartas': jp.cartas_json,
-            'carta_triunfo': carta_triunfo,
-            'chat_id': chat_id,
-            'tiempo_turno': self.partida.tiempo_turno,
-            'puntos_equipo_1': self.partida.puntos_equipo_1,
-            'puntos_equipo_2': self.partida.puntos_equipo_2,
-            'pausados': len(self.partida.jugadores_pausa or []),
-            'turno': usuario.id,
+        mano = cartas_de(juego.manos[sala.indice(jp.id)])
+        privado = {
+            'type': 'private_message',
+            'texto': mensaje(msg_type, {**data, 'mis_cartas': [int_a_carta(c) for c in mano]}, secuencia)
         }
+        if not solo_jugador:
+            sala.guardar_mensaje(secuencia, privado, jp.id)
         if jp.channel_name:
-            await self.channel_layer.send(jp.channel_name, {
-                'type': 'private_message',
-                'msg_type': msg_type,
-                'data': data_para_jugador
-            })
+            await self.channel_layer.send(jp.channel_name, privado)
 
 async def send_debug_state(consumer, estado_json):
     """Envía el estado actual de la partida para debugging"""
-    await consumer.send(text_data=json.dumps({
-        'type': MessageTypes.DEBUG_STATE,
-        'data': estado_json
-    }))
\ No newline at end of file
+    await consumer.send(text_data=mensaje(MessageTypes.DEBUG_STATE, estado_json))
\ No newline at end of file
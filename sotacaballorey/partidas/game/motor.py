@@ -0,0 +1,349 @@
+"""
+Motor de reglas del guiñote, puro y síncrono.
+
+No depende de Django ni de Channels: recibe un estado y una acción y devuelve
+el estado y la lista de eventos que ha producido. Los jugadores son asientos
+(0..n-1, en el orden de la mesa), las cartas enteros de cartas.py y las manos
+máscaras de bits. El consumer, los bots y el simulador traducen los eventos a
+mensajes, jugadas, etc.
+
+Acciones:
+    (JUGAR, asiento, carta)
+    (CANTAR, asiento)
+    (CAMBIAR_SIETE, asiento)
+
+Eventos:
+    (CARTA_JUGADA, asiento, carta)
+    (BAZA_GANADA, asiento, puntos)
+    (CARTA_ROBADA, asiento, carta)
+    (ARRASTRE,)
+    (CANTO, asiento, [(20|40, palo), ...], puntos)
+    (CAMBIO_SIETE, asiento, carta_robada)
+    (REPARTO,)
+    (TURNO, asiento)
+    (FIN, equipo_ganador)       # 0 si no gana nadie
+"""
+from .cartas import (
+    PALO, CANTE, SIETE, NUM_CARTAS,
+    resolver_baza, jugadas_validas, cartas_de
+)
+import random
+
+CARTAS_POR_MANO = 6
+
+# Acciones
+JUGAR = 'jugar_carta'
+CANTAR = 'cantar'
+CAMBIAR_SIETE = 'cambiar_siete'
+
+# Eventos
+CARTA_JUGADA = 'carta_jugada'
+BAZA_GANADA = 'baza_ganada'
+CARTA_ROBADA = 'carta_robada'
+ARRASTRE = 'arrastre'
+CANTO = 'canto'
+CAMBIO_SIETE = 'cambio_siete'
+REPARTO = 'reparto'
+TURNO = 'turno'
+FIN = 'fin'
+
+class JugadaInvalida(Exception):
+    """Acción no permitida por las reglas. El mensaje se envía al jugador"""
+    pass
+
+class EstadoJuego:
+    """Estado completo de una partida (equipos 1 y 2, puntos[0] es el equipo 1)"""
+
+    __slots__ = (
+        'equipos', 'manos', 'baraja', 'triunfo', 'carta_triunfo', 'fase_arrastre',
+        'baza', 'ultimo_ganador', 'turno', 'puntos', 'es_revueltas', 'cantos_20',
+        'canto_40', 'reglas_arrastre', 'permitir_revueltas', 'semilla', 'repartos',
+        'terminada', 'ganador'
+    )
+
+    def __init__(self, equipos, reglas_arrastre=True, permitir_revueltas=True, semilla=0):
+        self.equipos = tuple(equipos)           # Equipo (1 o 2) de cada asiento
+        self.manos = [0] * len(self.equipos)    # Máscara de cartas de cada asiento
+        self.baraja = []                        # Mazo; se roba del final, baraja[0] es el triunfo
+        self.triunfo = 0                        # Palo de triunfo
+        self.carta_triunfo = None
+        self.fase_arrastre = False
+        self.baza = []                          # [(asiento, carta), ...]
+        self.ultimo_ganador = None              # Asiento que ganó la última baza
+        self.turno = 0
+        self.puntos = [0, 0]
+        self.es_revueltas = False
+        self.cantos_20 = 0                      # Máscara de palos ya cantados
+        self.canto_40 = False
+        self.reglas_arrastre = reglas_arrastre
+        self.permitir_revueltas = permitir_revueltas
+        self.semilla = semilla
+        self.repartos = 0
+        self.terminada = False
+        self.ganador = None
+
+    @property
+    def jugadores(self) -> int:
+        return len(self.equipos)
+
+    def copia(self):
+        """Copia independiente del estado"""
+        nuevo = EstadoJuego.__new__(EstadoJuego)
+        for campo in EstadoJuego.__slots__:
+            setattr(nuevo, campo, getattr(self, campo))
+        nuevo.manos = list(self.manos)
+        nuevo.baraja = list(self.baraja)
+        nuevo.baza = list(self.baza)
+        nuevo.puntos = list(self.puntos)
+        return nuevo
+
+#-----------------------------------------------------------------------------------#
+# Reparto                                                                           #
+#-----------------------------------------------------------------------------------#
+
+def nueva_partida(equipos, reglas_arrastre=True, permitir_revueltas=True, semilla=None):
+    """Crea el estado de una partida y reparte"""
+    if semilla is None:
+        semilla = random.getrandbits(32)
+    estado = EstadoJuego(equipos, reglas_arrastre, permitir_revueltas, semilla)
+    repartir(estado)
+    return estado
+
+def repartir(estado: EstadoJuego) -> list:
+    """
+    Baraja y reparte. El barajado depende solo de la semilla y del número de
+    reparto, así que una partida se puede reproducir
+    """
+    rng = random.Random((estado.semilla << 16) + estado.repartos)
+    baraja = list(range(NUM_CARTAS))
+    rng.shuffle(baraja)
+
+    estado.carta_triunfo = baraja[0]
+    estado.triunfo = PALO[baraja[0]]
+    for asiento in range(estado.jugadores):
+        mano = 0
+        for _ in range(CARTAS_POR_MANO):
+            if baraja:
+                mano |= 1 << baraja.pop()
+        estado.manos[asiento] = mano
+
+    estado.baraja = baraja
+    estado.fase_arrastre = False
+    estado.baza = []
+    estado.ultimo_ganador = None
+    estado.turno = 0
+    estado.repartos += 1
+    return [(REPARTO,)]
+
+#-----------------------------------------------------------------------------------#
+# Consultas                                                                         #
+#-----------------------------------------------------------------------------------#
+
+def jugadas_posibles(estado: EstadoJuego, asiento: int) -> int:
+    """Máscara de las cartas que el asiento puede jugar ahora mismo"""
+    mano = estado.manos[asiento]
+    if not estado.fase_arrastre or not estado.reglas_arrastre or not estado.baza:
+        return mano
+
+    cartas = [c for _, c in estado.baza]
+
+    # Si el compañero va ganando la baza se puede tirar cualquier carta
+    companero_gana = False
+    if estado.jugadores == 4:
+        mejor = estado.baza[resolver_baza(cartas, estado.triunfo)[0]][0]
+        companero_gana = mejor != asiento and estado.equipos[mejor] == estado.equipos[asiento]
+
+    return jugadas_validas(mano, cartas, estado.triunfo, companero_gana)
+
+def gano_ultima_baza(estado: EstadoJuego, asiento: int) -> bool:
+    """El equipo del asiento ganó la última baza y no se ha empezado otra"""
+    return (
+        estado.ultimo_ganador is not None and
+        estado.equipos[estado.ultimo_ganador] == estado.equipos[asiento] and
+        not estado.baza
+    )
+
+def puede_cambiar_siete(estado: EstadoJuego, asiento: int) -> bool:
+    return not estado.fase_arrastre and bool(estado.baraja) and gano_ultima_baza(estado, asiento)
+
+def puede_cantar(estado: EstadoJuego, asiento: int) -> bool:
+    """El asiento tiene algún canto que todavía no se ha hecho y puede cantarlo"""
+    if not gano_ultima_baza(estado, asiento):
+        return False
+    mano = estado.manos[asiento]
+    for palo, cante in enumerate(CANTE):
+        if mano & cante == cante:
+            if palo == estado.triunfo and not estado.canto_40:
+                return True
+            if palo != estado.triunfo and not estado.cantos_20 >> palo & 1:
+                return True
+    return False
+
+def ganador_partida(estado: EstadoJuego):
+    """
+    Equipo ganador al acabar la mano (0 si no gana nadie) o None si se
+    juegan revueltas:
+    - En partida normal, si ambos superan 100, gana quien hizo las 10 últimas.
+    - Si solo un equipo supera 100, gana ese equipo.
+    """
+    e1, e2 = estado.puntos
+    if e1 > 100 and e2 > 100 and not estado.es_revueltas:
+        if estado.ultimo_ganador is None:
+            return 0
+        return estado.equipos[estado.ultimo_ganador]
+    if e1 > 100:
+        return 1
+    if e2 > 100:
+        return 2
+    if estado.permitir_revueltas:
+        return None
+    return 0
+
+#-----------------------------------------------------------------------------------#
+# Acciones                                                                          #
+#-----------------------------------------------------------------------------------#
+
+def aplicar(estado: EstadoJuego, accion: tuple):
+    """
+    Aplica la acción sobre el estado (lo modifica, usar copia() para
+    conservar el anterior) y devuelve (estado, eventos). Lanza JugadaInvalida
+    si las reglas no la permiten
+    """
+    if estado.terminada:
+        raise JugadaInvalida('La partida no está en curso')
+
+    tipo = accion[0]
+    if tipo == JUGAR:
+        eventos = _jugar(estado, accion[1], accion[2])
+    elif tipo == CANTAR:
+        eventos = _cantar(estado, accion[1])
+    elif tipo == CAMBIAR_SIETE:
+        eventos = _cambiar_siete(estado, accion[1])
+    else:
+        raise JugadaInvalida(f'Acción desconocida: {tipo}')
+    return estado, eventos
+
+def _jugar(estado: EstadoJuego, asiento: int, carta: int) -> list:
+    if any(a == asiento for a, _ in estado.baza):
+        raise JugadaInvalida('Ya has jugado en esta baza')
+    if estado.turno != asiento:
+        raise JugadaInvalida('No es tu turno')
+    if not estado.manos[asiento] >> carta & 1:
+        raise JugadaInvalida('No tiene esa carta en tu mano')
+    if not jugadas_posibles(estado, asiento) >> carta & 1:
+        raise JugadaInvalida('Carta inválida para la fase actual')
+
+    estado.manos[asiento] ^= 1 << carta
+    estado.baza.append((asiento, carta))
+    eventos = [(CARTA_JUGADA, asiento, carta)]
+
+    n = estado.jugadores
+    if len(estado.baza) < n:
+        estado.turno = (asiento + 1) % n
+        eventos.append((TURNO, estado.turno))
+        return eventos
+
+    # Fin de la baza
+    idx, puntos = resolver_baza([c for _, c in estado.baza], estado.triunfo)
+    ganador = estado.baza[idx][0]
+    estado.baza = []
+    estado.ultimo_ganador = ganador
+    estado.turno = ganador
+
+    # Las 10 últimas
+    if not estado.baraja and not any(estado.manos):
+        puntos += 10
+    estado.puntos[estado.equipos[ganador] - 1] += puntos
+    eventos.append((BAZA_GANADA, ganador, puntos))
+
+    # Todos roban, empezando por el ganador
+    if not estado.fase_arrastre and estado.baraja:
+        for k in range(n):
+            if not estado.baraja:
+                break
+            a = (ganador + k) % n
+            robada = estado.baraja.pop()
+            estado.manos[a] |= 1 << robada
+            eventos.append((CARTA_ROBADA, a, robada))
+
+    if estado.reglas_arrastre and not estado.fase_arrastre and not estado.baraja:
+        estado.fase_arrastre = True
+        eventos.append((ARRASTRE,))
+
+    # En revueltas se acaba al pasar de 100; si no, al quedarse sin cartas
+    if (estado.es_revueltas and max(estado.puntos) > 100) or \
+        (not estado.baraja and not any(estado.manos)):
+            eventos.extend(fin_de_mano(estado))
+            return eventos
+
+    eventos.append((TURNO, estado.turno))
+    return eventos
+
+def _cantar(estado: EstadoJuego, asiento: int) -> list:
+    if not gano_ultima_baza(estado, asiento):
+        raise JugadaInvalida('No puedes cantar ahora')
+
+    mano = estado.manos[asiento]
+    palos = [p for p, cante in enumerate(CANTE) if mano & cante == cante]
+    if not palos:
+        raise JugadaInvalida('No tienes cartas para cantar')
+
+    cantos = []
+    puntos = 0
+    for palo in palos:
+        if palo == estado.triunfo:
+            if not estado.canto_40:
+                estado.canto_40 = True
+                cantos.append((40, palo))
+                puntos += 40
+        elif not estado.cantos_20 >> palo & 1:
+            estado.cantos_20 |= 1 << palo
+            cantos.append((20, palo))
+            puntos += 20
+
+    if puntos == 0:
+        raise JugadaInvalida('No hay cantos válidos disponibles')
+
+    estado.puntos[estado.equipos[asiento] - 1] += puntos
+    return [(CANTO, asiento, cantos, puntos)]
+
+def _cambiar_siete(estado: EstadoJuego, asiento: int) -> list:
+    if not puede_cambiar_siete(estado, asiento):
+        raise JugadaInvalida('No puedes cambiar el 7 ahora')
+
+    siete = SIETE[estado.triunfo]
+    if not estado.manos[asiento] >> siete & 1:
+        raise JugadaInvalida('No tienes el 7 de triunfo')
+
+    robada = estado.carta_triunfo
+    estado.manos[asiento] ^= (1 << siete) | (1 << robada)
+    estado.carta_triunfo = siete
+    estado.baraja[0] = siete
+    return [(CAMBIO_SIETE, asiento, robada)]
+
+#-----------------------------------------------------------------------------------#
+# Fin de mano                                                                       #
+#-----------------------------------------------------------------------------------#
+
+def fin_de_mano(estado: EstadoJuego) -> list:
+    """Termina la partida o, si nadie ha ganado, reparte para jugar revueltas"""
+    ganador = ganador_partida(estado)
+    if ganador is not None:
+        estado.terminada = True
+        estado.ganador = ganador
+        return [(FIN, ganador)]
+
+    # Revueltas: empieza quien ganó la última baza
+    primero = estado.ultimo_ganador
+    estado.es_revueltas = True
+    estado.cantos_20 = 0
+    estado.canto_40 = False
+    eventos = repartir(estado)
+    if primero is not None:
+        estado.turno = primero
+    eventos.append((TURNO, estado.turno))
+    return eventos
+
+def cartas_en_mano(estado: EstadoJuego, asiento: int) -> list:
+    """Cartas (enteros) de la mano de un asiento"""
+    return cartas_de(estado.manos[asiento])
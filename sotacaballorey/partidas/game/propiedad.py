@@ -0,0 +1,227 @@
+"""
+Propiedad de las partidas en curso cuando hay varios procesos del servidor.
+
+Cada partida en 'jugando' la lleva un único proceso: el que tiene su
+concesión (PropiedadPartida) sin vencer. Solo ese proceso tiene la sala en
+memoria, aplica las acciones en el motor y programa el temporizador de turno.
+Las conexiones que caen en otro proceso le reenvían por la capa de canales
+las acciones, conexiones y desconexiones de sus jugadores (el canal del
+propietario está en la concesión); las respuestas vuelven al canal de cada
+conexión como mensajes privados.
+
+El propietario renueva todas sus concesiones de una vez cada RENOVACION
+segundos. Si un proceso cae, sus concesiones vencen a los DURACION_CONCESION
+segundos y el primer proceso que recibe una acción de la partida (o que busca
+partidas huérfanas, recuperacion.py) se queda con ella y la carga desde el
+último volcado. Si un proceso no ha podido renovar a tiempo y otro se ha
+quedado con la partida, descarta su sala sin volcarla.
+
+Con un único proceso todas las concesiones son suyas y solo cuestan una
+escritura al cargar y al cerrar cada sala
+"""
+from partidas.models import PropiedadPartida
+from partidas.metricas import registrar_metricas
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.utils import timezone
+from django.conf import settings
+from django.db.models import Q
+from datetime import timedelta
+import asyncio
+import socket
+import os
+
+DURACION_CONCESION = 15     # s
+RENOVACION = 5              # s
+
+#-----------------------------------------------------------------------------------#
+# Concesiones en la base de datos                                                   #
+#-----------------------------------------------------------------------------------#
+
+@database_sync_to_async
+def adquirir_concesiones(ids: list, propietario: str, canal: str) -> dict:
+    """
+    Se queda con las partidas que no tienen concesión, la tienen vencida o ya
+    eran suyas. Devuelve el dueño de cada partida: {id: (propietario, canal)}
+    """
+    ahora = timezone.now()
+    duenos = {
+        p: (pr, c) for p, pr, c, vence in PropiedadPartida.objects.filter(partida_id__in=ids)
+            .values_list('partida_id', 'propietario', 'canal', 'vence')
+        if vence >= ahora and pr != propietario
+    }
+    libres = [i for i in ids if i not in duenos]
+    if not libres:
+        return duenos
+
+    # La condición va en la propia actualización: si dos procesos compiten
+    # por una concesión vencida solo uno la consigue
+    vence = ahora + timedelta(seconds=DURACION_CONCESION)
+    actualizadas = PropiedadPartida.objects.filter(
+        Q(propietario=propietario) | Q(vence__lt=ahora), partida_id__in=libres
+    ).update(propietario=propietario, canal=canal, vence=vence)
+    if actualizadas == len(libres):
+        duenos.update({i: (propietario, canal) for i in libres})
+        return duenos
+
+    PropiedadPartida.objects.bulk_create([
+        PropiedadPartida(partida_id=i, propietario=propietario, canal=canal, vence=vence)
+        for i in libres
+    ], ignore_conflicts=True)
+    duenos.update({
+        p: (pr, c) for p, pr, c in PropiedadPartida.objects.filter(partida_id__in=libres)
+            .values_list('partida_id', 'propietario', 'canal')
+    })
+    return duenos
+
+@database_sync_to_async
+def renovar_concesiones(ids: list, propietario: str) -> set:
+    """Alarga las concesiones del propietario. Devuelve las que sigue teniendo"""
+    vence = timezone.now() + timedelta(seconds=DURACION_CONCESION)
+    concesiones = PropiedadPartida.objects.filter(partida_id__in=ids, propietario=propietario)
+    if concesiones.update(vence=vence) == len(ids):
+        return set(ids)
+    return set(concesiones.values_list('partida_id', flat=True))
+
+@database_sync_to_async
+def liberar_concesion(partida_id, propietario: str):
+    PropiedadPartida.objects.filter(partida_id=partida_id, propietario=propietario).delete()
+
+#-----------------------------------------------------------------------------------#
+# Servicio del proceso                                                              #
+#-----------------------------------------------------------------------------------#
+
+class ServicioPropiedad:
+    """
+    Concesiones de las partidas que lleva este proceso y canal por el que
+    recibe lo que le reenvían los demás.
+
+    <al_perder(partida_id)> se llama cuando otro proceso se ha quedado con una
+    partida (sala.py descarta la sala) y <al_recibir(channel_layer, mensaje)>
+    atiende los mensajes reenviados (consumers.py)
+    """
+
+    def __init__(self, propietario: str):
+        self.propietario = propietario
+        self.canal = None
+        self.propias = set()        # Partidas con concesión de este proceso
+        self.canales = {}           # Partida de otro proceso -> canal del propietario
+        self.al_perder = None
+        self.al_recibir = None
+        self._loop = None
+        self._arranque = None
+
+        # Métricas
+        self.adquiridas = 0
+        self.perdidas = 0
+        self.reenviados = 0
+        self.recibidos = 0
+
+    async def _arrancar(self):
+        """
+        Abre el canal del proceso y lanza la escucha y la renovación en el
+        bucle de eventos actual (una vez por bucle)
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self.propias = set()
+            self.canales = {}
+            self._arranque = loop.create_task(self._abrir_canal(loop))
+        await self._arranque
+
+    async def _abrir_canal(self, loop):
+        channel_layer = get_channel_layer()
+        self.canal = await channel_layer.new_channel('partidas.')
+        loop.create_task(self._escuchar(channel_layer, self.canal))
+        loop.create_task(self._renovar())
+
+    async def adquirir(self, partida_id) -> bool:
+        """Intenta quedarse con la partida. Devuelve si la lleva este proceso"""
+        return partida_id in await self.adquirir_varias([partida_id])
+
+    async def adquirir_varias(self, ids: list) -> set:
+        """Intenta quedarse con varias partidas. Devuelve las que lleva este proceso"""
+        await self._arrancar()
+        if not ids:
+            return set()
+        propias = set()
+        for partida_id, (propietario, canal) in (
+                await adquirir_concesiones(ids, self.propietario, self.canal)).items():
+            if propietario == self.propietario:
+                propias.add(partida_id)
+                self.canales.pop(partida_id, None)
+            else:
+                self.canales[partida_id] = canal
+        self.adquiridas += len(propias - self.propias)
+        self.propias |= propias
+        return propias
+
+    async def liberar(self, partida_id):
+        """Suelta la concesión de una partida cuya sala se cierra"""
+        if partida_id in self.propias:
+            self.propias.discard(partida_id)
+            await liberar_concesion(partida_id, self.propietario)
+
+    async def renovar(self):
+        """Renueva todas las concesiones y suelta las que ya tiene otro proceso"""
+        ids = list(self.propias)
+        if not ids:
+            return
+        for partida_id in set(ids) - await renovar_concesiones(ids, self.propietario):
+            self.propias.discard(partida_id)
+            self.perdidas += 1
+            if self.al_perder:
+                self.al_perder(partida_id)
+
+    async def _renovar(self):
+        while True:
+            await asyncio.sleep(RENOVACION)
+            try:
+                await self.renovar()
+            except Exception as e:
+                print(f"Error al renovar las concesiones de partidas: {e}")
+
+    #-----------------------------------------------------------------------------------#
+    # Reenvío entre procesos                                                            #
+    #-----------------------------------------------------------------------------------#
+
+    async def reenviar(self, partida_id, mensaje: dict) -> bool:
+        """
+        Envía el mensaje al proceso que lleva la partida. Devuelve False si
+        no se sabe cuál es
+        """
+        canal = self.canales.get(partida_id)
+        if not canal:
+            return False
+        await get_channel_layer().send(canal, mensaje)
+        self.reenviados += 1
+        return True
+
+    async def _escuchar(self, channel_layer, canal):
+        while True:
+            mensaje = await channel_layer.receive(canal)
+            self.recibidos += 1
+            asyncio.ensure_future(self._atender(channel_layer, mensaje))
+
+    async def _atender(self, channel_layer, mensaje):
+        try:
+            await self.al_recibir(channel_layer, mensaje)
+        except Exception as e:
+            print(f"Error al atender un mensaje reenviado de la partida {mensaje.get('partida_id')}: {e}")
+
+    def metricas(self) -> dict:
+        """Partidas que lleva el proceso y mensajes reenviados"""
+        return {
+            'propietario': self.propietario,
+            'partidas': len(self.propias),
+            'adquiridas': self.adquiridas,
+            'perdidas': self.perdidas,
+            'reenviados': self.reenviados,
+            'recibidos': self.recibidos,
+        }
+
+# Servicio único del proceso
+propiedad = ServicioPropiedad(
+    getattr(settings, 'PROCESO_PARTIDAS', '') or f'{socket.gethostname()}-{os.getpid()}')
+registrar_metricas('propiedad', propiedad.metricas)
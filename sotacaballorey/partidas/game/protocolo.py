@@ -0,0 +1,173 @@
+"""
+Protocolo compacto de /ws/partida/ para clientes con poca red.
+
+El cliente lo pide con el subprotocolo WebSocket SUBPROTOCOLO (si no lo
+pide, no está msgpack instalado o PROTOCOLO_COMPACTO está desactivado, la
+conexión usa JSON). Cada mensaje va en
+un frame binario MessagePack con la forma [tipo, datos] o, si el mensaje
+está numerado (sala.py), [tipo, datos, secuencia]:
+
+- tipo: posición del tipo en TIPOS (cubre todos los de MessageTypes)
+- datos: los mismos que en JSON con las claves de CLAVES acortadas y las
+  cartas de los campos de CARTAS como enteros (cartas.carta_a_int, 0-39);
+  las listas de cartas son listas de enteros
+- secuencia: el 'seq' de JSON
+
+Lo que envía el cliente también es MessagePack: el mismo diccionario que en
+JSON con las claves acortadas y la carta como entero, p. ej.
+{'a': 'jugar_carta', 'c': 12}. Un cambio incompatible del esquema cambia la
+versión del subprotocolo
+"""
+from .cartas import carta_a_int, int_a_carta
+from .messages import MessageTypes
+from utils.serializacion import decodificar
+from django.conf import settings
+import functools
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+VERSION = 1
+SUBPROTOCOLO = f'guinote.compacto.{VERSION}'
+
+# El orden es parte del esquema: los tipos nuevos se añaden al final
+TIPOS = (
+    MessageTypes.START_GAME,
+    MessageTypes.GAME_OVER,
+    MessageTypes.PLAYER_JOINED,
+    MessageTypes.PLAYER_LEFT,
+    MessageTypes.TURN_UPDATE,
+    MessageTypes.CARD_PLAYER,
+    MessageTypes.ROUND_RESULT,
+    MessageTypes.PHASE_UPDATE,
+    MessageTypes.CARD_DRAWN,
+    MessageTypes.ERROR,
+    MessageTypes.CANTO,
+    MessageTypes.CAMBIO_SIETE,
+    MessageTypes.PAUSE,
+    MessageTypes.ALL_PAUSE,
+    MessageTypes.RESUME,
+    MessageTypes.DEBUG_STATE,
+    MessageTypes.SCORE_UPDATE,
+    MessageTypes.LOBBY_SNAPSHOT,
+    MessageTypes.ROOM_CREATED,
+    MessageTypes.ROOM_STARTED,
+)
+CODIGO_TIPO = {tipo: codigo for codigo, tipo in enumerate(TIPOS)}
+
+CLAVES = {
+    'accion': 'a',
+    'automatica': 'au',
+    'cantos': 'ct',
+    'capacidad': 'cp',
+    'carta': 'c',
+    'carta_jugada': 'cj',
+    'carta_robada': 'cr',
+    'carta_triunfo': 'tr',
+    'chat_id': 'ch',
+    'epoca': 'ep',
+    'equipo': 'e',
+    'fase_arrastre': 'fa',
+    'ganador': 'g',
+    'ganador_equipo': 'ge',
+    'id': 'i',
+    'jugador': 'j',
+    'jugadores': 'js',
+    'mazo_restante': 'mr',
+    'message': 'm',
+    'mis_cartas': 'mc',
+    'nombre': 'n',
+    'num_cartas': 'nc',
+    'num_solicitudes_pausa': 'ns',
+    'partida_id': 'p',
+    'pausados': 'pa',
+    'puntos': 'pt',
+    'puntos_baza': 'pb',
+    'puntos_equipo_1': 'p1',
+    'puntos_equipo_2': 'p2',
+    'tiempo_turno': 'tt',
+    'turno': 't',
+    'usuario': 'u',
+}
+LARGAS = {corta: larga for larga, corta in CLAVES.items()}
+assert len(LARGAS) == len(CLAVES)
+
+# Campos cuyo valor es una carta o una lista de cartas
+CARTAS = {'carta', 'carta_jugada', 'carta_robada', 'carta_triunfo', 'mis_cartas', 'cartas_json', 'mazo'}
+
+# Los mensajes se codifican en JSON y solo se pasan a compacto al enviarlos a
+# una conexión que lo usa. Los últimos MENSAJES_MEMORIZADOS se recuerdan para
+# no convertir más de una vez el mismo mensaje de un grupo
+disponible = msgpack is not None and getattr(settings, 'PROTOCOLO_COMPACTO', True)
+MENSAJES_MEMORIZADOS = 256
+
+#-----------------------------------------------------------------------------------#
+# Conversión entre la forma JSON y la compacta                                      #
+#-----------------------------------------------------------------------------------#
+
+def _es_carta(valor) -> bool:
+    return type(valor) is dict and 'palo' in valor and 'valor' in valor
+
+def _compactar(valor, clave=None):
+    tipo = type(valor)
+    if tipo is dict:
+        if clave in CARTAS and 'palo' in valor and 'valor' in valor:
+            return carta_a_int(valor)
+        return {CLAVES.get(k, k): _compactar(v, k) for k, v in valor.items()}
+    if tipo is list:
+        if clave in CARTAS and all(map(_es_carta, valor)):
+            return [carta_a_int(c) for c in valor]
+        return [_compactar(v) for v in valor]
+    return valor
+
+def _expandir(valor, clave=None):
+    if clave in CARTAS:
+        if isinstance(valor, int):
+            return int_a_carta(valor)
+        if isinstance(valor, list) and all(isinstance(c, int) for c in valor):
+            return [int_a_carta(c) for c in valor]
+    if isinstance(valor, dict):
+        expandido = {}
+        for k, v in valor.items():
+            larga = LARGAS.get(k, k)
+            expandido[larga] = _expandir(v, larga)
+        return expandido
+    if isinstance(valor, list):
+        return [_expandir(v) for v in valor]
+    return valor
+
+def compactar(msg_type: str, data, secuencia: int = None) -> list:
+    """Mensaje [tipo, datos(, secuencia)] en la forma compacta, sin empaquetar"""
+    if secuencia is None:
+        return [CODIGO_TIPO[msg_type], _compactar(data)]
+    return [CODIGO_TIPO[msg_type], _compactar(data), secuencia]
+
+def empaquetar(compacto: list) -> bytes:
+    return msgpack.packb(compacto)
+
+def codificar_compacto(msg_type: str, data, secuencia: int = None) -> bytes:
+    """Mensaje para un cliente con el protocolo compacto"""
+    return empaquetar(compactar(msg_type, data, secuencia))
+
+@functools.lru_cache(maxsize=MENSAJES_MEMORIZADOS)
+def compacto_desde_texto(texto: str) -> bytes:
+    """Pasa al protocolo compacto un mensaje ya codificado en JSON"""
+    mensaje = decodificar(texto)
+    return codificar_compacto(mensaje['type'], mensaje.get('data', {}), mensaje.get('seq'))
+
+def decodificar_compacto(binario: bytes) -> dict:
+    """Mensaje del servidor en el protocolo compacto a su forma JSON"""
+    codigo, data, *secuencia = msgpack.unpackb(binario)
+    if secuencia:
+        return {'type': TIPOS[codigo], 'seq': secuencia[0], 'data': _expandir(data)}
+    return {'type': TIPOS[codigo], 'data': _expandir(data)}
+
+def accion_desde_compacto(binario: bytes) -> dict:
+    """Acción enviada por un cliente con el protocolo compacto, en su forma JSON"""
+    return _expandir(msgpack.unpackb(binario))
+
+def accion_a_compacto(accion: dict) -> bytes:
+    """Acción en el protocolo compacto (lo que envía el cliente)"""
+    return empaquetar(_compactar(accion))
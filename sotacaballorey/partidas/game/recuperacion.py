@@ -0,0 +1,156 @@
+"""
+Recuperación de las partidas en curso que no lleva ningún proceso.
+
+Los temporizadores de turno y las salas viven en memoria, así que si el
+servidor se reinicia (o cae uno de sus procesos) las partidas en 'jugando' se
+quedan paradas hasta que alguien juega. Al arrancar, y después cada
+RENOVACION segundos, cada proceso busca las partidas en curso sin concesión
+o con la concesión vencida (propiedad.py), se queda con las que puede, las
+lee de una vez con sus jugadores, vuelve a crear sus salas y el temporizador
+del turno en curso, y reenvía el turno. A quien vuelve a una partida
+recuperada se le indica de quién es el turno. Las partidas pausadas no
+necesitan nada: se reanudan como siempre cuando vuelven todos. Con la misma
+frecuencia se ponen al día las colas del emparejador con las salas en espera
+de la base de datos (al arrancar, las que había antes de reiniciarse)
+"""
+from partidas.models import Partida, JugadorPartida, EventoPartida
+from partidas.metricas import registrar_metricas
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .sala import SalaPartida, obtener_sala, registrar_sala
+from .propiedad import propiedad, RENOVACION
+from .consumers import PartidaConsumer
+from .emparejamiento import emparejador
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.conf import settings
+import asyncio
+import time
+import sys
+
+_ultima = {}
+_vigilancia = None     # Tarea de vigilar_partidas del proceso
+
+@database_sync_to_async
+def partidas_huerfanas(propietario: str) -> list:
+    """
+    Partidas en 'jugando' con cartas repartidas cuya concesión no tiene
+    nadie, ha vencido o es de este proceso
+    """
+    return list(Partida.objects.filter(estado='jugando', estado_json__has_key='triunfo')
+        .filter(Q(propiedad__isnull=True) | Q(propiedad__vence__lt=timezone.now()) |
+                Q(propiedad__propietario=propietario))
+        .order_by('id').values_list('id', flat=True))
+
+@database_sync_to_async
+def leer_partidas_en_curso(ids) -> list:
+    """
+    Devuelve las salas de las partidas en curso con esos ids (tres consultas
+    en total)
+    """
+    partidas = list(Partida.objects.filter(id__in=ids, estado='jugando').order_by('id'))
+    jugadores = {p.id: [] for p in partidas}
+    for jugador in JugadorPartida.objects.filter(partida_id__in=ids) \
+        .select_related('usuario').order_by('id'):
+            jugadores[jugador.partida_id].append(jugador)
+    num_eventos = dict(EventoPartida.objects.filter(partida_id__in=ids)
+        .values('partida').annotate(n=Max('numero')).values_list('partida', 'n'))
+
+    salas = [SalaPartida(p, jugadores[p.id], num_eventos.get(p.id, 0)) for p in partidas]
+    return [s for s in salas if s.juego and not s.juego.terminada]
+
+async def recuperar_partidas(channel_layer=None) -> dict:
+    """
+    Vuelve a poner en marcha las partidas en curso que no lleva ningún
+    proceso. Devuelve cuántas se han recuperado y cuánto ha tardado
+    """
+    inicio = time.perf_counter()
+    channel_layer = channel_layer or get_channel_layer()
+    recuperadas = 0
+
+    # Las que ya tienen sala en este proceso no hace falta tocarlas
+    candidatas = [i for i in await partidas_huerfanas(propiedad.propietario) if not obtener_sala(i)]
+    propias = await propiedad.adquirir_varias(candidatas)
+    for sala in await leer_partidas_en_curso(propias) if propias else []:
+        if registrar_sala(sala) is not sala:
+            continue
+        sala.recuperada = True
+        async with sala.lock:
+            # Sin conexiones: el turno y los temporizadores los lleva un consumer sin socket
+            consumer = PartidaConsumer.sin_conexion(sala, channel_layer)
+            await consumer.iniciar_siguiente_turno()
+        recuperadas += 1
+
+    segundos = time.perf_counter() - inicio
+    resultado = {
+        'partidas': recuperadas,
+        'segundos': segundos,
+        'ms_por_1000_partidas': 1e6 * segundos / recuperadas if recuperadas else None
+    }
+    if recuperadas or not _ultima:
+        _ultima.update(resultado)
+        print(f"Recuperadas {recuperadas} partidas en curso en {segundos:.3f} s", flush=True)
+    return resultado
+
+async def vigilar_partidas():
+    """
+    Recupera las partidas en curso al arrancar y después, periódicamente, las
+    que se quedan sin proceso porque ha vencido su concesión. También
+    reconstruye y pone al día las colas de salas en espera
+    """
+    while True:
+        try:
+            await recuperar_partidas()
+        except Exception as e:
+            print(f"Error al recuperar partidas en curso: {e}")
+        try:
+            await emparejador.sincronizar()
+        except Exception as e:
+            print(f"Error al leer las salas en espera: {e}")
+        await asyncio.sleep(RENOVACION)
+
+registrar_metricas('recuperacion', lambda: dict(_ultima))
+
+def arrancar():
+    """
+    Lanza la vigilancia de partidas en el bucle de eventos actual, una vez
+    por proceso. Devuelve su tarea (None si RECUPERAR_PARTIDAS está desactivado)
+    """
+    global _vigilancia
+    if _vigilancia is None and getattr(settings, 'RECUPERAR_PARTIDAS', True):
+        _vigilancia = asyncio.get_event_loop().create_task(vigilar_partidas())
+    return _vigilancia
+
+def arrancar_con_el_servidor():
+    """
+    Programa la vigilancia para cuando arranque el servidor, sin esperar a
+    ninguna conexión. Con daphne (que no envía 'lifespan') se lanza en cuanto
+    arranca su reactor; con otros servidores, RecuperarAlArrancar
+    """
+    if 'daphne.server' not in sys.modules:
+        return
+    from twisted.internet import reactor
+    reactor.callWhenRunning(arrancar)
+
+class RecuperarAlArrancar:
+    """
+    Middleware ASGI que lanza la vigilancia de partidas al arrancar si el
+    servidor envía 'lifespan' o, si no y aún no se ha lanzado, con la primera
+    conexión que recibe
+    """
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                mensaje = await receive()
+                if mensaje['type'] == 'lifespan.startup':
+                    arrancar()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif mensaje['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        arrancar()
+        return await self.inner(scope, receive, send)
@@ -0,0 +1,70 @@
+"""
+Registro de eventos de una partida y su reproducción.
+
+Cada acción aceptada se apunta en la sala como una fila compacta de
+EventoPartida (tipo, asiento y valor) y se escribe por lotes junto con el
+volcado de la sala. Como el motor es determinista y el barajado solo depende
+de la semilla, el reparto y las acciones bastan para reconstruir cualquier
+estado intermedio de la partida.
+
+Tipos:
+    (REPARTO, None, semilla)
+    (JUGAR, asiento, carta)
+    (AUTOMATICA, asiento, carta)   # carta jugada al vencer el tiempo de turno
+    (CANTAR, asiento, None)
+    (CAMBIAR_SIETE, asiento, None)
+    (PAUSA, asiento, None)          # petición de pausa
+    (ANULAR_PAUSA, asiento, None)
+    (PAUSADA, None, None)           # todos han pedido pausa
+    (PUNTOS, None, puntos)          # puntos fijados a mano (debug), empaquetados
+"""
+from partidas.models import Partida, JugadorPartida, EventoPartida
+from .motor import EstadoJuego, nueva_partida, aplicar, JUGAR, CANTAR, CAMBIAR_SIETE
+
+REPARTO = 'reparto'
+AUTOMATICA = 'automatica'
+PAUSA = 'pausa'
+ANULAR_PAUSA = 'anular_pausa'
+PAUSADA = 'pausada'
+PUNTOS = 'puntos'
+
+# Tipos que cambian el estado del motor (el resto son solo para auditoría)
+ACCIONES = {JUGAR: JUGAR, AUTOMATICA: JUGAR, CANTAR: CANTAR, CAMBIAR_SIETE: CAMBIAR_SIETE}
+
+def empaquetar_puntos(puntos: list) -> int:
+    return puntos[0] << 16 | puntos[1]
+
+def desempaquetar_puntos(valor: int) -> list:
+    return [valor >> 16, valor & 0xFFFF]
+
+def reproducir(equipos, eventos, reglas_arrastre=True, permitir_revueltas=True,
+               hasta: int = None) -> EstadoJuego:
+    """
+    Reconstruye el estado del motor aplicando los eventos (tuplas (numero,
+    tipo, asiento, valor) en orden) hasta el número <hasta> incluido. None si
+    todavía no se había repartido
+    """
+    juego = None
+    for numero, tipo, asiento, valor in eventos:
+        if hasta is not None and numero > hasta:
+            break
+        if tipo == REPARTO:
+            juego = nueva_partida(equipos, reglas_arrastre, permitir_revueltas, semilla=valor)
+        elif juego is None:
+            continue
+        elif tipo == PUNTOS:
+            juego.puntos = desempaquetar_puntos(valor)
+        elif tipo in ACCIONES:
+            accion = ACCIONES[tipo]
+            aplicar(juego, (accion, asiento, valor) if accion == JUGAR else (accion, asiento))
+    return juego
+
+def reproducir_partida(partida_id: int, hasta: int = None) -> EstadoJuego:
+    """Reconstruye el estado de una partida guardada a partir de su registro"""
+    partida = Partida.objects.get(id=partida_id)
+    equipos = JugadorPartida.objects.filter(
+        partida_id=partida_id).order_by('id').values_list('equipo', flat=True)
+    eventos = EventoPartida.objects.filter(partida_id=partida_id).order_by('numero') \
+        .values_list('numero', 'tipo', 'asiento', 'valor')
+    return reproducir(list(equipos), eventos, partida.reglas_arrastre,
+                      partida.permitir_revueltas, hasta)
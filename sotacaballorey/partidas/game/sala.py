@@ -0,0 +1,436 @@
+from partidas.models import Partida, JugadorPartida, EventoPartida
+from channels.db import database_sync_to_async
+from .cartas import carta_a_int, int_a_carta, palo_a_int, mascara, cartas_de, PALOS
+from .motor import EstadoJuego, nueva_partida
+from .temporizador import temporizadores
+from .propiedad import propiedad
+from .utils import anotar_conflicto, anotar_escritura, campos_cambiados
+from .registro import REPARTO
+from .bd import sin_contar
+from django.db.models import Max
+from django.db import transaction
+from django.conf import settings
+from collections import deque
+import asyncio
+import uuid
+
+# Campos de Partida cuyo valor autoritativo vive en la sala mientras se juega
+CAMPOS_PARTIDA = [
+    'estado', 'estado_json', 'baraja', 'puntos_equipo_1', 'puntos_equipo_2',
+    'es_revueltas', 'cantos_realizados', 'jugadores_pausa'
+]
+
+# Campos de JugadorPartida con la mano (uno u otro según el formato)
+CAMPOS_MANO = ['cartas_json', 'mano']
+
+# Eventos pendientes a partir de los que se vuelca aunque no haya punto de control
+LOTE_EVENTOS = 64
+
+# Mensajes recientes que guarda cada sala para reenviar a quien se reconecta
+MENSAJES_RECIENTES = 256
+
+# Salas cargadas en este proceso, indexadas por id de partida
+salas = {}
+
+class SalaPartida:
+    """
+    Estado autoritativo en memoria de una partida en curso.
+
+    Todas las conexiones de la partida comparten la misma sala: la instancia
+    de Partida (estado_json, puntos, cantos...) y los JugadorPartida (manos)
+    viven aquí. Los cambios se acumulan y se vuelcan a la base de datos en
+    segundo plano en los puntos de control (fin de baza, pausa, fin de partida),
+    de modo que jugar una carta no espera a la base de datos. Solo se
+    escriben las columnas y las manos que han cambiado desde el último volcado.
+
+    Mientras hay cartas repartidas, el estado de juego es <juego> (motor.py);
+    los asientos del motor son las posiciones en <jugadores>. Al volcar se
+    exporta al formato de estado_json y cartas_json de siempre o, con
+    ALMACENAMIENTO_COMPACTO, a las manos como máscaras de bits y al mazo como
+    bytes (Partida.baraja, JugadorPartida.mano). Se leen los dos formatos.
+
+    Las acciones aceptadas se apuntan en el registro de eventos (registro.py),
+    que se escribe con cada volcado.
+
+    Los mensajes a los jugadores llevan un número de secuencia de la sala y
+    los últimos MENSAJES_RECIENTES se guardan ya codificados: a quien se
+    reconecta diciendo cuál fue el último que recibió se le reenvían solo
+    los que le faltan. La época identifica la sala: si se vuelve a cargar
+    (otro proceso o un reinicio) la numeración empieza de nuevo.
+
+    Con varios procesos, la sala solo se carga en el que tiene la concesión
+    de la partida (propiedad.py). Cada volcado incrementa la versión de la
+    partida y solo se escribe si nadie más la ha cambiado; si no, la sala ha
+    dejado de ser la autoritativa y se descarta.
+    """
+
+    def __init__(self, partida: Partida, jugadores: list, num_eventos: int = 0):
+        self.partida = partida
+        self.jugadores = sorted(jugadores, key=lambda j: j.id)
+        self.jugadores_por_id = {j.id: j for j in self.jugadores}
+        self.juego: EstadoJuego = juego_desde_partida(partida, self.jugadores)
+        self.lock = asyncio.Lock()
+        self.turno = 0          # Contador de turnos (identifica cada temporizador)
+        self.loop = None
+        self._partida_sucia = False
+        self._jugadores_sucios = {}
+        self._guardados = {}            # Último valor escrito de cada campo de la partida
+        self._manos_guardadas = {}      # Último valor escrito de cada mano (id -> {campo: valor})
+        self._volcado = None
+        self.num_eventos = num_eventos      # Último número de evento registrado
+        self._eventos = []
+        self.recuperada = False             # Cargada al arrancar el proceso (recuperacion.py)
+        self.epoca = uuid.uuid4().hex[:12]
+        self.secuencia = 0                  # Último número de mensaje
+        self._mensajes = deque(maxlen=MENSAJES_RECIENTES)   # (secuencia, jugador_id o None, evento)
+
+    #-----------------------------------------------------------------------------------#
+    # Jugadores                                                                         #
+    #-----------------------------------------------------------------------------------#
+
+    def jugador(self, jugador_id) -> JugadorPartida:
+        """Devuelve el jugador de la sala con ese id (o None)"""
+        return self.jugadores_por_id.get(jugador_id)
+
+    def jugador_de_usuario(self, usuario_id) -> JugadorPartida:
+        """Devuelve el jugador de la sala asociado al usuario (o None)"""
+        for jugador in self.jugadores:
+            if jugador.usuario_id == usuario_id:
+                return jugador
+        return None
+
+    def indice(self, jugador_id) -> int:
+        """Posición del jugador en el orden de la mesa (orden por id)"""
+        for idx, jugador in enumerate(self.jugadores):
+            if jugador.id == jugador_id:
+                return idx
+        return 0
+
+    def siguiente(self, jugador_id) -> JugadorPartida:
+        """Jugador que se sienta a continuación del dado"""
+        idx = self.indice(jugador_id)
+        return self.jugadores[(idx + 1) % len(self.jugadores)]
+
+    def jugador_en(self, asiento: int) -> JugadorPartida:
+        """Jugador sentado en un asiento del motor"""
+        return self.jugadores[asiento]
+
+    def conectar_jugador(self, jugador: JugadorPartida) -> JugadorPartida:
+        """
+        Devuelve la instancia de la sala para el jugador que se acaba de
+        (re)conectar. Si no estaba en la sala, la añade
+        """
+        existente = self.jugadores_por_id.get(jugador.id)
+        if existente:
+            return existente
+        self.jugadores.append(jugador)
+        self.jugadores.sort(key=lambda j: j.id)
+        self.jugadores_por_id[jugador.id] = jugador
+        return jugador
+
+    #-----------------------------------------------------------------------------------#
+    # Mensajes numerados                                                                #
+    #-----------------------------------------------------------------------------------#
+
+    def numerar(self) -> int:
+        """Número de secuencia para el siguiente mensaje"""
+        self.secuencia += 1
+        return self.secuencia
+
+    def guardar_mensaje(self, secuencia: int, evento: dict, jugador_id=None):
+        """
+        Guarda el evento de un mensaje ya enviado, para todos o solo para el
+        jugador <jugador_id>
+        """
+        self._mensajes.append((secuencia, jugador_id, evento))
+
+    def mensajes_desde(self, secuencia: int, jugador_id) -> list:
+        """
+        Eventos de los mensajes posteriores a <secuencia> para el jugador, o
+        None si ya no se tienen todos (hay que enviarle el estado completo)
+        """
+        if secuencia > self.secuencia:
+            return None
+        # Si ya se ha descartado alguno, el más antiguo que queda no basta: puede
+        # compartir número con otro descartado (el estado enviado a cada jugador)
+        if len(self._mensajes) == self._mensajes.maxlen and self._mensajes[0][0] > secuencia:
+            return None
+        return [evento for s, destinatario, evento in self._mensajes
+                if s > secuencia and destinatario in (None, jugador_id)]
+
+    #-----------------------------------------------------------------------------------#
+    # Estado de juego                                                                   #
+    #-----------------------------------------------------------------------------------#
+
+    def repartir(self, semilla: int = None) -> EstadoJuego:
+        """Empieza una partida nueva en el motor con los jugadores de la sala"""
+        self.juego = nueva_partida(
+            [j.equipo for j in self.jugadores],
+            reglas_arrastre=self.partida.reglas_arrastre,
+            permitir_revueltas=self.partida.permitir_revueltas,
+            semilla=semilla
+        )
+        self.registrar(REPARTO, valor=self.juego.semilla)
+        return self.juego
+
+    def exportar(self):
+        """
+        Pasa el estado del motor a los campos de la partida (estado_json,
+        mazo, puntos, cantos) y a las manos de los jugadores
+        """
+        juego = self.juego
+        if not juego:
+            return
+        ids = [j.id for j in self.jugadores]
+        partida = self.partida
+        compacto = getattr(settings, 'ALMACENAMIENTO_COMPACTO', False)
+
+        partida.estado_json = {
+            'triunfo': PALOS[juego.triunfo],
+            'carta_triunfo': int_a_carta(juego.carta_triunfo),
+            'fase_arrastre': juego.fase_arrastre,
+            'baza_actual': [{'jugador_id': ids[a], 'carta': int_a_carta(c)} for a, c in juego.baza],
+            'ultimo_ganador': ids[juego.ultimo_ganador] if juego.ultimo_ganador is not None else None,
+            'turno_actual_id': ids[juego.turno],
+            'semilla': juego.semilla,
+            'repartos': juego.repartos
+        }
+        if compacto:
+            partida.baraja = bytes(juego.baraja)
+        else:
+            partida.baraja = None
+            partida.estado_json['baraja'] = [int_a_carta(c) for c in juego.baraja]
+        partida.puntos_equipo_1, partida.puntos_equipo_2 = juego.puntos
+        partida.es_revueltas = juego.es_revueltas
+
+        cantos = {}
+        if juego.cantos_20:
+            cantos['20'] = [PALOS[p] for p in cartas_de(juego.cantos_20)]
+        if juego.canto_40:
+            cantos['40'] = True
+        partida.cantos_realizados = cantos
+        self.marcar_partida()
+
+        for jugador, mano in zip(self.jugadores, juego.manos):
+            if compacto:
+                jugador.mano = mano
+                jugador.cartas_json = []
+            else:
+                jugador.mano = None
+                jugador.cartas_json = [int_a_carta(c) for c in cartas_de(mano)]
+            self.marcar_jugador(jugador)
+
+    #-----------------------------------------------------------------------------------#
+    # Persistencia diferida                                                             #
+    #-----------------------------------------------------------------------------------#
+
+    def registrar(self, tipo: str, asiento: int = None, valor: int = None):
+        """Apunta un evento en el registro de la partida (se escribe al volcar)"""
+        self.num_eventos += 1
+        self._eventos.append(EventoPartida(
+            partida_id=self.partida.id, numero=self.num_eventos,
+            tipo=tipo, asiento=asiento, valor=valor
+        ))
+        if len(self._eventos) >= LOTE_EVENTOS:
+            self.volcar()
+
+    def marcar_partida(self):
+        """Indica que la partida tiene cambios pendientes de volcar"""
+        self._partida_sucia = True
+
+    def marcar_jugador(self, jugador: JugadorPartida):
+        """Indica que la mano del jugador tiene cambios pendientes de volcar"""
+        self._jugadores_sucios[jugador.id] = jugador
+
+    def volcar(self) -> asyncio.Task:
+        """
+        Vuelca en segundo plano los cambios pendientes. Se toma una copia del
+        estado en este momento, así que se puede seguir jugando mientras se
+        escribe. Devuelve la tarea por si hay que esperar a que termine
+        """
+        self.exportar()
+        campos = None
+        if self._partida_sucia:
+            campos = campos_cambiados(self.partida, CAMPOS_PARTIDA, self._guardados)
+        manos = {}
+        for j_id, jugador in self._jugadores_sucios.items():
+            cambio = campos_cambiados(jugador, CAMPOS_MANO, self._manos_guardadas.setdefault(j_id, {}))
+            if cambio:
+                manos[j_id] = cambio
+        eventos = self._eventos
+        self._partida_sucia = False
+        self._jugadores_sucios = {}
+        self._eventos = []
+
+        # Los volcados se encadenan para que se escriban en orden
+        anterior = self._volcado
+        self._volcado = asyncio.ensure_future(
+            self._escribir(anterior, campos, manos, eventos))
+        return self._volcado
+
+    async def _escribir(self, anterior, campos, manos, eventos):
+        """
+        Escribe un volcado sobre la versión de la partida que hay en la base
+        de datos (la del último volcado que se escribió). La versión de la
+        sala solo avanza si se escribe
+        """
+        sin_contar()
+        if anterior:
+            await anterior
+        version = self.partida.version
+        try:
+            if not await escribir_cambios(self.partida.id, version, campos, manos, eventos):
+                anotar_conflicto()
+                descartar_sala(self.partida.id, self)
+                return
+            self.partida.version = version + 1
+        except Exception as e:
+            # La transacción no ha escrito nada: el siguiente volcado lo escribe
+            # todo, con los eventos de este delante de los que haya nuevos
+            self._guardados = {}
+            self._manos_guardadas = {}
+            self._partida_sucia = True
+            for j_id in manos:
+                self._jugadores_sucios.setdefault(j_id, self.jugadores_por_id[j_id])
+            self._eventos[:0] = eventos
+            print(f"Error al volcar la partida {self.partida.id}: {e}")
+
+    async def cerrar(self):
+        """
+        Vuelca los cambios pendientes, saca la sala de memoria y suelta la
+        concesión de la partida
+        """
+        temporizadores.cancelar(self.partida.id)
+        await self.volcar()
+        if salas.get(self.partida.id) is self:
+            del salas[self.partida.id]
+            await propiedad.liberar(self.partida.id)
+
+def juego_desde_partida(partida: Partida, jugadores: list) -> EstadoJuego:
+    """
+    Reconstruye el estado del motor a partir de lo guardado en la partida y
+    en las manos (None si todavía no se ha repartido)
+    """
+    estado_json = partida.estado_json or {}
+    if 'triunfo' not in estado_json:
+        return None
+
+    asientos = {j.id: i for i, j in enumerate(jugadores)}
+    juego = EstadoJuego(
+        [j.equipo for j in jugadores],
+        reglas_arrastre=partida.reglas_arrastre,
+        permitir_revueltas=partida.permitir_revueltas,
+        semilla=estado_json.get('semilla', 0)
+    )
+    juego.repartos = estado_json.get('repartos', 1)
+    juego.manos = [
+        j.mano if j.mano is not None else mascara(carta_a_int(c) for c in j.cartas_json or [])
+        for j in jugadores
+    ]
+    if partida.baraja is not None:
+        juego.baraja = list(bytes(partida.baraja))
+    else:
+        juego.baraja = [carta_a_int(c) for c in estado_json.get('baraja', [])]
+    juego.triunfo = palo_a_int(estado_json['triunfo'])
+    juego.carta_triunfo = carta_a_int(estado_json['carta_triunfo'])
+    juego.fase_arrastre = estado_json.get('fase_arrastre', False)
+    juego.baza = [
+        (asientos[b['jugador_id']], carta_a_int(b['carta']))
+        for b in estado_json.get('baza_actual', [])
+    ]
+    juego.ultimo_ganador = asientos.get(estado_json.get('ultimo_ganador'))
+    juego.turno = asientos.get(estado_json.get('turno_actual_id'), 0)
+    juego.puntos = [partida.puntos_equipo_1, partida.puntos_equipo_2]
+    juego.es_revueltas = partida.es_revueltas
+
+    cantos = partida.cantos_realizados or {}
+    juego.cantos_20 = mascara(palo_a_int(p) for p in cantos.get('20', []))
+    juego.canto_40 = bool(cantos.get('40', False))
+    return juego
+
+#-----------------------------------------------------------------------------------#
+# Registro de salas                                                                 #
+#-----------------------------------------------------------------------------------#
+
+def obtener_sala(partida_id) -> SalaPartida:
+    """Devuelve la sala en memoria de la partida, si existe"""
+    sala = salas.get(partida_id)
+    if sala and sala.loop and sala.loop.is_closed():
+        # La sala pertenecía a un bucle de eventos que ya no existe
+        del salas[partida_id]
+        return None
+    return sala
+
+async def cargar_sala(partida_id) -> SalaPartida:
+    """
+    Devuelve la sala de la partida. Si no está en memoria la carga de la base
+    de datos (partida y jugadores con sus usuarios) y la registra. Devuelve
+    None si la partida la lleva otro proceso
+    """
+    sala = obtener_sala(partida_id)
+    if sala:
+        return sala
+
+    if not await propiedad.adquirir(partida_id):
+        return None
+    nueva = await leer_sala(partida_id)
+    if not nueva:
+        return None
+    return registrar_sala(nueva)
+
+def registrar_sala(sala: SalaPartida) -> SalaPartida:
+    """
+    Registra una sala leída de la base de datos. Si otra conexión cargó la
+    sala mientras se leía, se devuelve esa
+    """
+    existente = obtener_sala(sala.partida.id)
+    if existente:
+        return existente
+    sala.loop = asyncio.get_running_loop()
+    salas[sala.partida.id] = sala
+    return sala
+
+def descartar_sala(partida_id, sala: SalaPartida = None):
+    """
+    Saca la sala (o la que haya de la partida) de memoria sin volcarla: otro
+    proceso se ha quedado con la partida y su estado ya no es el autoritativo
+    """
+    if sala is None:
+        sala = salas.get(partida_id)
+    if sala is not None and salas.get(partida_id) is sala:
+        temporizadores.cancelar(partida_id)
+        del salas[partida_id]
+        print(f"La partida {partida_id} la ha cambiado otro proceso: se descarta su sala")
+
+propiedad.al_perder = descartar_sala
+
+@database_sync_to_async
+def leer_sala(partida_id) -> SalaPartida:
+    """Lee de la base de datos todo lo que necesita la sala"""
+    try:
+        partida = Partida.objects.get(id=partida_id)
+    except Partida.DoesNotExist:
+        return None
+    jugadores = list(JugadorPartida.objects.filter(
+        partida_id=partida_id).select_related('usuario').order_by('id'))
+    num_eventos = EventoPartida.objects.filter(
+        partida_id=partida_id).aggregate(n=Max('numero'))['n'] or 0
+    return SalaPartida(partida, jugadores, num_eventos)
+
+@database_sync_to_async
+def escribir_cambios(partida_id, version: int, campos: dict, manos: dict, eventos: list = ()) -> bool:
+    """
+    Escribe en una transacción los campos de la partida, las manos
+    modificadas y los eventos nuevos del registro, solo si la partida sigue
+    en la <version> que conoce la sala. Devuelve si se ha escrito
+    """
+    with transaction.atomic():
+        if not Partida.objects.filter(id=partida_id, version=version).update(
+                version=version + 1, **(campos or {})):
+            return False
+        anotar_escritura(list((campos or {}).values()) + [v for m in manos.values() for v in m.values()])
+        if eventos:
+            EventoPartida.objects.bulk_create(eventos)
+        for jugador_id, mano in manos.items():
+            JugadorPartida.objects.filter(id=jugador_id).update(**mano)
+    return True
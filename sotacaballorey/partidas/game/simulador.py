@@ -0,0 +1,136 @@
+"""
+Simulador de partidas completas sobre el motor de reglas, sin base de datos ni
+websockets. Los bots juegan partidas 1v1 o 2v2 (reparto, robo, arrastre,
+cantos, cambio del 7 y revueltas) y se mide el coste de cada jugada.
+"""
+from .motor import (
+    nueva_partida, aplicar, jugadas_posibles, puede_cantar, puede_cambiar_siete,
+    JUGAR, CANTAR, CAMBIAR_SIETE, CANTO, CAMBIO_SIETE, ARRASTRE, REPARTO
+)
+from .cartas import cartas_de, resolver_baza, PALO, PUNTOS, FUERZA, SIETE
+from partidas.metricas import percentil
+import random
+import time
+
+#-----------------------------------------------------------------------------------#
+# Bots                                                                              #
+#-----------------------------------------------------------------------------------#
+
+def _puede_cambiar(estado, asiento: int) -> bool:
+    return puede_cambiar_siete(estado, asiento) and \
+        bool(estado.manos[asiento] >> SIETE[estado.triunfo] & 1)
+
+def bot_aleatorio(estado, asiento: int, rng: random.Random) -> tuple:
+    """Canta y cambia el 7 la mitad de las veces que puede; juega cualquier carta válida"""
+    if puede_cantar(estado, asiento) and rng.random() < 0.5:
+        return (CANTAR, asiento)
+    if _puede_cambiar(estado, asiento) and rng.random() < 0.5:
+        return (CAMBIAR_SIETE, asiento)
+    return (JUGAR, asiento, rng.choice(cartas_de(jugadas_posibles(estado, asiento))))
+
+def _barata(carta: int):
+    return (PUNTOS[carta], FUERZA[carta])
+
+def bot_codicioso(estado, asiento: int, rng: random.Random) -> tuple:
+    """
+    Canta y cambia el 7 siempre que puede. Si puede ganar la baza lo hace con
+    la carta más barata que gane; si no, tira la carta más barata
+    """
+    if puede_cantar(estado, asiento):
+        return (CANTAR, asiento)
+    if _puede_cambiar(estado, asiento):
+        return (CAMBIAR_SIETE, asiento)
+
+    validas = cartas_de(jugadas_posibles(estado, asiento))
+    if not estado.baza:
+        # Salir con lo más barato que no sea triunfo
+        sin_triunfo = [c for c in validas if PALO[c] != estado.triunfo]
+        return (JUGAR, asiento, min(sin_triunfo or validas, key=_barata))
+
+    cartas = [c for _, c in estado.baza]
+    mejor = estado.baza[resolver_baza(cartas, estado.triunfo)[0]][0]
+    if estado.equipos[mejor] != estado.equipos[asiento]:
+        ganadoras = [
+            c for c in validas
+            if resolver_baza(cartas + [c], estado.triunfo)[0] == len(cartas)
+        ]
+        if ganadoras:
+            return (JUGAR, asiento, min(ganadoras, key=_barata))
+    return (JUGAR, asiento, min(validas, key=_barata))
+
+BOTS = {
+    'aleatorio': bot_aleatorio,
+    'codicioso': bot_codicioso,
+}
+
+#-----------------------------------------------------------------------------------#
+# Simulación                                                                        #
+#-----------------------------------------------------------------------------------#
+
+def simular_partida(capacidad: int, bots: list, semilla: int, tiempos: list = None) -> dict:
+    """
+    Juega una partida completa. <bots> tiene un bot por asiento. Si se pasa
+    <tiempos> se añade el coste (ns) de cada acción aplicada
+    """
+    rng = random.Random(semilla)
+    equipos = [1, 2] * (capacidad // 2)
+    estado = nueva_partida(equipos, semilla=semilla)
+    contadores = {'acciones': 0, 'cantos': 0, 'cambios_siete': 0, 'arrastres': 0, 'revueltas': 0}
+    reloj = time.perf_counter_ns
+
+    while not estado.terminada:
+        asiento = estado.turno
+        accion = bots[asiento](estado, asiento, rng)
+        inicio = reloj()
+        _, eventos = aplicar(estado, accion)
+        if tiempos is not None:
+            tiempos.append(reloj() - inicio)
+
+        contadores['acciones'] += 1
+        for evento in eventos:
+            tipo = evento[0]
+            if tipo == CANTO:
+                contadores['cantos'] += 1
+            elif tipo == CAMBIO_SIETE:
+                contadores['cambios_siete'] += 1
+            elif tipo == ARRASTRE:
+                contadores['arrastres'] += 1
+            elif tipo == REPARTO:
+                contadores['revueltas'] += 1
+
+    contadores['ganador'] = estado.ganador
+    contadores['puntos'] = list(estado.puntos)
+    return contadores
+
+def simular(partidas: int, capacidad: int = 2, bot: str = 'aleatorio', semilla: int = 0) -> dict:
+    """
+    Juega <partidas> partidas con el mismo bot en todos los asientos y
+    devuelve el rendimiento (partidas/s, acciones/s, coste por acción en µs)
+    y cuántas veces se ha pasado por cada fase del juego
+    """
+    bots = [BOTS[bot]] * capacidad
+    tiempos = []
+    totales = {'acciones': 0, 'cantos': 0, 'cambios_siete': 0, 'arrastres': 0, 'revueltas': 0}
+    victorias = {0: 0, 1: 0, 2: 0}
+
+    inicio = time.perf_counter()
+    for i in range(partidas):
+        resultado = simular_partida(capacidad, bots, semilla + i, tiempos)
+        for clave in totales:
+            totales[clave] += resultado[clave]
+        victorias[resultado['ganador']] += 1
+    duracion = time.perf_counter() - inicio
+
+    tiempos_us = [t / 1000 for t in tiempos]
+    return {
+        'capacidad': capacidad,
+        'bot': bot,
+        'partidas': partidas,
+        'segundos': duracion,
+        'partidas_por_segundo': partidas / duracion if duracion else 0.0,
+        'acciones_por_segundo': totales['acciones'] / duracion if duracion else 0.0,
+        'accion_p50_us': percentil(tiempos_us, 50),
+        'accion_p99_us': percentil(tiempos_us, 99),
+        'victorias': victorias,
+        **totales,
+    }
@@ -0,0 +1,123 @@
+from partidas.metricas import registrar_metricas, percentil
+from collections import deque
+import itertools
+import asyncio
+import heapq
+
+class ServicioTemporizadores:
+    """
+    Temporizadores de turno dirigidos por eventos.
+
+    Los plazos se guardan en un montículo ordenado por vencimiento y el bucle de
+    eventos solo se despierta cuando vence el primero, sin consultar la base de
+    datos mientras se espera. Programar una clave que ya tenía plazo lo
+    sustituye y cancelar lo anula, así que cada plazo ejecuta su acción como
+    mucho una vez
+    """
+
+    def __init__(self, muestras_deriva: int = 1000):
+        self._monticulo = []        # (plazo, secuencia, clave)
+        self._pendientes = {}       # clave -> (plazo, secuencia, accion)
+        self._secuencia = itertools.count()
+        self._despertador = None    # Llamada programada para el primer plazo
+        self._loop = None
+
+        # Métricas
+        self.disparados = 0
+        self.cancelados = 0
+        self._derivas = deque(maxlen=muestras_deriva)
+
+    def _bucle(self):
+        """Bucle de eventos actual. Si ha cambiado, se descartan los plazos viejos"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._monticulo = []
+            self._pendientes = {}
+            self._despertador = None
+        return loop
+
+    def programar(self, clave, segundos: float, accion):
+        """
+        Programa <accion> (función asíncrona sin argumentos) para dentro de
+        <segundos>. Sustituye el plazo anterior de la misma clave
+        """
+        loop = self._bucle()
+        self.cancelar(clave)
+        plazo = loop.time() + segundos
+        secuencia = next(self._secuencia)
+        self._pendientes[clave] = (plazo, secuencia, accion)
+        heapq.heappush(self._monticulo, (plazo, secuencia, clave))
+        self._armar(loop)
+
+    def cancelar(self, clave) -> bool:
+        """Anula el plazo de la clave. Devuelve si había uno pendiente"""
+        if self._pendientes.pop(clave, None) is None:
+            return False
+        self.cancelados += 1
+
+        # Las entradas anuladas se quedan en el montículo hasta que salen por
+        # arriba; si se acumulan demasiadas se reconstruye
+        if len(self._monticulo) > 2 * len(self._pendientes) + 64:
+            self._monticulo = [
+                (p, s, c) for p, s, c in self._monticulo
+                if self._pendientes.get(c, (None, None))[1] == s
+            ]
+            heapq.heapify(self._monticulo)
+        return True
+
+    def plazo(self, clave):
+        """Segundos que faltan para que venza la clave (None si no tiene plazo)"""
+        pendiente = self._pendientes.get(clave)
+        if pendiente is None or self._loop is None:
+            return None
+        return max(0.0, pendiente[0] - self._loop.time())
+
+    def _armar(self, loop):
+        """Programa el despertar del bucle para el primer plazo del montículo"""
+        if not self._monticulo:
+            return
+        primero = self._monticulo[0][0]
+        if self._despertador and self._despertador.when() <= primero:
+            return
+        if self._despertador:
+            self._despertador.cancel()
+        self._despertador = loop.call_at(primero, self._vencer)
+
+    def _vencer(self):
+        """Ejecuta las acciones de todos los plazos vencidos"""
+        loop = self._loop
+        self._despertador = None
+        ahora = loop.time()
+        while self._monticulo and self._monticulo[0][0] <= ahora:
+            plazo, secuencia, clave = heapq.heappop(self._monticulo)
+            pendiente = self._pendientes.get(clave)
+            if pendiente is None or pendiente[1] != secuencia:
+                continue
+            del self._pendientes[clave]
+            self.disparados += 1
+            self._derivas.append(ahora - plazo)
+            loop.create_task(self._ejecutar(clave, pendiente[2]))
+        self._armar(loop)
+
+    async def _ejecutar(self, clave, accion):
+        try:
+            await accion()
+        except Exception as e:
+            print(f"Error en el temporizador {clave}: {e}")
+
+    def metricas(self) -> dict:
+        """Temporizadores pendientes, disparados, cancelados y deriva (ms)"""
+        derivas = [d * 1000 for d in self._derivas]
+        return {
+            'pendientes': len(self._pendientes),
+            'disparados': self.disparados,
+            'cancelados': self.cancelados,
+            'deriva_media_ms': sum(derivas) / len(derivas) if derivas else None,
+            'deriva_p99_ms': percentil(derivas, 99),
+            'deriva_max_ms': max(derivas) if derivas else None,
+        }
+
+# Servicio único del proceso para los turnos de todas las partidas
+temporizadores = ServicioTemporizadores()
+registrar_metricas('temporizadores', temporizadores.metricas)
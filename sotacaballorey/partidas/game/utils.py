@@ -1,23 +1,25 @@
+from partidas.elo import calcular_nuevo_elo, calcular_nuevo_elo_parejas
 from partidas.models import Partida, JugadorPartida
-from channels.db import database_sync_to_async
-from usuarios.models import Usuario
+from partidas.game.bd import consulta
+from partidas.metricas import registrar_metricas
+from usuarios.models import Usuario, rango_de_elo
+from utils.jwt_auth import olvidar_usuario
+from django.db.models import F
+from django.utils import timezone
+from django.db import transaction
+from collections import deque
+import copy
+import json
+import time
 
-@database_sync_to_async
-def obtener_o_crear_partida(usuario: Usuario, capacidad: int):
-    """
-    Obtiene una partida disponible (no llena) de capacidad
-    dada. Si no existe, la crea.
-    """
-    partidas_disponibles: Partida = Partida.objects.filter(
-        estado='esperando', capacidad=capacidad, es_personalizada=False
-    ).exclude(jugadores__usuario=usuario)
-    if partidas_disponibles:
-        return partidas_disponibles[0]
-    partida = Partida.objects.create(capacidad=capacidad)
+@consulta
+def crear_partida(config: dict):
+    """Crea una partida en espera con la configuración dada"""
+    partida = Partida(**config)
     partida.save()
     return partida
 
-@database_sync_to_async
+@consulta
 def obtener_partida_por_id(id_partida: str):
     """Obtiene una partida dado su id"""
     try:
@@ -25,46 +27,57 @@ def obtener_partida_por_id(id_partida: str):
     except Partida.DoesNotExist:
         return None
 
-@database_sync_to_async
+@consulta
 def agregar_jugador(partida: Partida, usuario: Usuario):
-    """Agrega el usuario a la partida"""
-    jugadores_existentes = JugadorPartida.objects.filter(partida=partida)
-
-    equipo = (jugadores_existentes.count() % 2) + 1
-    jugador, created = JugadorPartida.objects.get_or_create(
-        partida=partida,
-        usuario=usuario,
-        defaults={'equipo': equipo}
-    )
-    jugador.conectado = True
-    jugador.save()
+    """
+    Agrega el usuario a la partida. Con la partida bloqueada se comprueba que
+    aún está en espera y tiene hueco: otro proceso puede haberla llenado o
+    empezado. Devuelve (None, False) si el usuario no cabe
+    """
+    with transaction.atomic():
+        bloqueada = Partida.objects.select_for_update().filter(
+            id=partida.id).values_list('estado', 'capacidad').first()
+        jugadores_existentes = JugadorPartida.objects.filter(partida_id=partida.id)
+        jugador = jugadores_existentes.filter(usuario=usuario).first()
+        created = jugador is None
+        if created:
+            if bloqueada is None:
+                return (None, False)
+            estado, capacidad = bloqueada
+            num_jugadores = jugadores_existentes.count()
+            if estado != 'esperando' or num_jugadores >= capacidad:
+                return (None, False)
+            jugador = JugadorPartida.objects.create(partida=partida, usuario=usuario,
+                equipo=(num_jugadores % 2) + 1, conectado=True)
+    if not jugador.conectado:
+        jugador.conectado = True
+        jugador.save(update_fields=['conectado'])
     return (jugador, created)
 
-@database_sync_to_async
+@consulta
 def get_jugador(partida: Partida, usuario: Usuario):
     """Devuelve el jugador correspondiente al usuario asociado al consumidor"""
     try:
         return JugadorPartida.objects.get(partida=partida, usuario=usuario)
     except JugadorPartida.DoesNotExist:
         return None
-    
-@database_sync_to_async
+
+@consulta
 def get_jugadores(partida: Partida):
-    """Devuelve los jugadores de la partida"""
+    """Devuelve los jugadores de la partida (con su usuario ya cargado)"""
     return list(JugadorPartida.objects.filter(
-        partida=partida).order_by('id'))
+        partida=partida).select_related('usuario').order_by('id'))
 
-@database_sync_to_async
+@consulta
 def contar_jugadores(partida: Partida):
-    """Devuelve el número de jugadores en la partida"""
-    try:
-        partida.refresh_from_db()
-        if not partida.pk:
-            return 0
-        jugadores = JugadorPartida.objects.filter(partida=partida)
-        return jugadores.filter(conectado=True).count()
-    except Partida.DoesNotExist:
+    """
+    Devuelve el número de jugadores conectados a la partida. No refresca la
+    instancia: si la partida está en curso su estado vive en la sala en memoria
+    """
+    if not partida.pk:
         return 0
+    return JugadorPartida.objects.filter(
+        partida_id=partida.pk, conectado=True).count()
 
 def _tiene_amigos_en_partida(partida: Partida, usuario: Usuario) -> bool:
     """
@@ -75,11 +88,35 @@ def _tiene_amigos_en_partida(partida: Partida, usuario: Usuario) -> bool:
     amigos_ids = usuario.amigos.values_list('id', flat=True)
     return any(j in amigos_ids for j in jugadores_ids) or not jugadores_ids
 
-@database_sync_to_async
+@consulta
 def tiene_amigos_en_partida(partida: Partida, usuario: Usuario) -> bool:
     return _tiene_amigos_en_partida(partida, usuario)
 
-@database_sync_to_async
+@consulta
+def leer_salas_en_espera(config: dict) -> list:
+    """
+    Partidas en espera con la configuración dada (todas si está vacía) y, de
+    cada una, el Elo de sus jugadores: individual (1v1) o de parejas (2v2)
+    """
+    partidas = {p.id: (p, {}) for p in Partida.objects.filter(estado='esperando', **config)}
+    for jugador in JugadorPartida.objects.filter(partida_id__in=partidas) \
+        .select_related('usuario').order_by('id'):
+            partida, elos = partidas[jugador.partida_id]
+            elos[jugador.usuario_id] = jugador.usuario.elo if partida.capacidad == 2 \
+                else jugador.usuario.elo_parejas
+    return list(partidas.values())
+
+@consulta
+def obtener_amigos_ids(usuario: Usuario) -> set:
+    """Devuelve los ids de los amigos del usuario"""
+    return set(usuario.amigos.values_list('id', flat=True))
+
+@consulta
+def obtener_elo(usuario: Usuario, capacidad: int) -> int:
+    """Devuelve el Elo del usuario: individual (1v1) o de parejas (2v2)"""
+    return usuario.elo if capacidad == 2 else usuario.elo_parejas
+
+@consulta
 def get_jugador_by_id(jp_id):
     """Devuelve un jugado dado su id"""
     try:
@@ -87,22 +124,122 @@ def get_jugador_by_id(jp_id):
     except JugadorPartida.DoesNotExist:
         return None
 
-@database_sync_to_async
+@consulta
 def obtener_chat_id(partida: Partida):
     """Devuelve el chat asociado a la partida"""
     return partida.get_chat_id()
 
-@database_sync_to_async
-def db_sync_to_async_save(instance):
+@consulta
+def db_sync_to_async_save(instance, update_fields=None):
     """Modificar instancia de la base de datos"""
-    instance.save()
+    instance.save(update_fields=update_fields)
+
+#-----------------------------------------------------------------------------------#
+# Escrituras de la partida con control de versión                                   #
+#-----------------------------------------------------------------------------------#
+
+INTENTOS_VERSION = 5
+
+# Instantes (monotónicos) de los últimos conflictos de versión
+_conflictos = deque(maxlen=10000)
+_fallidos = 0
+
+def anotar_conflicto():
+    """Apunta que una escritura ha encontrado la partida cambiada por otro"""
+    _conflictos.append(time.monotonic())
+
+def metricas_versiones() -> dict:
+    """Conflictos de versión en el último minuto, en total y escrituras abandonadas"""
+    hace_un_minuto = time.monotonic() - 60
+    return {
+        'conflictos_por_minuto': sum(1 for t in _conflictos if t >= hace_un_minuto),
+        'conflictos': len(_conflictos),
+        'fallidos': _fallidos,
+    }
+
+registrar_metricas('versiones', metricas_versiones)
+
+@consulta
+def guardar_con_version(partida: Partida, campos: list, mutar=None) -> bool:
+    """
+    Escribe solo los <campos> de la partida si nadie la ha cambiado desde que
+    se leyó (UPDATE ... WHERE version = n). Si hay conflicto se relee, se
+    vuelve a aplicar el cambio con <mutar(partida)> (por defecto, los valores
+    que tenían los campos) y se reintenta. Devuelve si se ha escrito
+    """
+    global _fallidos
+    if mutar is None:
+        valores = {c: getattr(partida, c) for c in campos}
+        mutar = lambda p: [setattr(p, c, v) for c, v in valores.items()]
+
+    for _ in range(INTENTOS_VERSION):
+        version = partida.version
+        if Partida.objects.filter(id=partida.id, version=version).update(
+                version=version + 1, **{c: getattr(partida, c) for c in campos}):
+            partida.version = version + 1
+            return True
+        anotar_conflicto()
+        try:
+            partida.refresh_from_db()
+        except Partida.DoesNotExist:
+            return False
+        mutar(partida)
 
-@database_sync_to_async
+    _fallidos += 1
+    print(f"No se ha podido guardar la partida {partida.id}: cambia demasiado a menudo")
+    return False
+
+def cambio_de_pausa(jugador_id, pide: bool):
+    """
+    Cambio para guardar_con_version: añade (o quita) al jugador de los que
+    han pedido pausa en la lista que haya en ese momento
+    """
+    jugador_id = str(jugador_id)
+    def mutar(partida: Partida):
+        if pide and jugador_id not in partida.jugadores_pausa:
+            partida.jugadores_pausa.append(jugador_id)
+        elif not pide and jugador_id in partida.jugadores_pausa:
+            partida.jugadores_pausa.remove(jugador_id)
+    return mutar
+
+#-----------------------------------------------------------------------------------#
+# Escritura solo de lo que cambia                                                   #
+#-----------------------------------------------------------------------------------#
+
+# Totales de lo escrito por los volcados de las salas
+_escrituras = {'volcados': 0, 'columnas': 0, 'bytes': 0}
+
+def campos_cambiados(instancia, campos: list, guardados: dict) -> dict:
+    """
+    Devuelve una copia de los <campos> de la instancia que difieren de lo
+    último que se guardó (<guardados>, campo -> valor) y los apunta ahí como
+    guardados. Es lo único que hace falta escribir
+    """
+    cambiados = {}
+    for campo in campos:
+        valor = getattr(instancia, campo)
+        if campo not in guardados or guardados[campo] != valor:
+            cambiados[campo] = guardados[campo] = copy.deepcopy(valor)
+    return cambiados
+
+def anotar_escritura(valores: list):
+    """
+    Suma al total las columnas que escribe un volcado (bytes de los valores
+    en JSON, o tal cual si son binarios)
+    """
+    _escrituras['volcados'] += 1
+    _escrituras['columnas'] += len(valores)
+    _escrituras['bytes'] += sum(
+        len(v) if isinstance(v, bytes) else len(json.dumps(v)) for v in valores)
+
+registrar_metricas('escrituras', lambda: dict(_escrituras))
+
+@consulta
 def db_sync_to_async_delete(instance):
     """Eliminar instancia de la base de datos"""
     instance.delete()
 
-@database_sync_to_async
+@consulta
 def refresh(instance):
     """Refrescar instancia de la base de datos"""
     instance.refresh_from_db()
@@ -120,120 +257,75 @@ async def index_de_jugador(partida: Partida, jugador_id: int) -> int:
             return idx
     return 0
 
-@database_sync_to_async
-def actualizar_estadisticas(partida: Partida, ganador_equipo):
-    """Actualiza las estadísticas de los jugadores al terminar la partida"""
-    jugadores = list(partida.jugadores.all())
+CAMPOS_LIQUIDACION = ['victorias', 'derrotas', 'racha_victorias', 'mayor_racha_victorias',
+                      'elo', 'elo_parejas', 'elo_rank']
+
+@consulta
+def liquidar_partida(partida: Partida, ganador_equipo: int):
+    """
+    Cierra la partida con el equipo ganador (0 si no gana nadie) en una sola
+    transacción: marca la partida como terminada y, si no es personalizada,
+    actualiza estadísticas, ELO y rango de sus jugadores de una vez. Solo
+    liquida la primera llamada por partida: devuelve los jugadores de la
+    partida, o None si ya estaba liquidada (o no existe)
+    """
+    with transaction.atomic():
+        try:
+            partida = Partida.objects.select_for_update().get(id=partida.id)
+        except Partida.DoesNotExist:
+            return None
+        if partida.liquidada:
+            return None
+
+        jugadores = list(JugadorPartida.objects.filter(partida=partida).order_by('id'))
+        if not partida.es_personalizada:
+            # Se bloquean en orden de id para no cruzarse con otra liquidación
+            usuarios = Usuario.objects.select_for_update().filter(
+                id__in=[j.usuario_id for j in jugadores]).order_by('id') \
+                .only('id', 'equipped_skin', 'equipped_tapete', *CAMPOS_LIQUIDACION)
+            usuarios = {u.id: u for u in usuarios}
+            equipos = {1: [], 2: []}
+            for jugador in jugadores:
+                equipos[jugador.equipo].append(usuarios[jugador.usuario_id])
+
+            for jugador in jugadores:
+                usuario = usuarios[jugador.usuario_id]
+                if ganador_equipo == 0 or jugador.equipo == ganador_equipo:
+                    usuario.victorias += 1
+                    usuario.racha_victorias += 1
+                    if usuario.racha_victorias > usuario.mayor_racha_victorias:
+                        usuario.mayor_racha_victorias = usuario.racha_victorias
+                else:
+                    usuario.derrotas += 1
+                    usuario.racha_victorias = 0
+
+            resultado = 1 if ganador_equipo == 1 else 0
+            if not equipos[1] or not equipos[2]:
+                print("Error: Faltan jugadores en algún equipo, no se actualiza el ELO")
+            elif partida.capacidad == 2:
+                u1, u2 = equipos[1][0], equipos[2][0]
+                u1.elo, u2.elo = calcular_nuevo_elo(u1.elo, u2.elo, resultado)
+            else:
+                elo_equipo1 = [u.elo_parejas for u in equipos[1]]
+                elo_equipo2 = [u.elo_parejas for u in equipos[2]]
+                nuevo_elo1 = calcular_nuevo_elo_parejas(elo_equipo1, elo_equipo2, resultado)
+                nuevo_elo2 = calcular_nuevo_elo_parejas(elo_equipo2, elo_equipo1, 1 - resultado)
+                for u, elo in zip(equipos[1] + equipos[2], nuevo_elo1 + nuevo_elo2):
+                    u.elo_parejas = elo
+
+            # Solo los que cambian de rango pasan por los desbloqueos
+            campos = list(CAMPOS_LIQUIDACION)
+            for usuario in usuarios.values():
+                usuario.elo_rank = rango_de_elo(usuario.elo)
+                if usuario.elo_rank != usuario._rango_guardado and usuario.desbloquear_rango():
+                    campos = CAMPOS_LIQUIDACION + ['equipped_skin', 'equipped_tapete']
+            Usuario.objects.bulk_update(usuarios.values(), campos)
+
+        JugadorPartida.objects.filter(partida=partida).update(conectado=False)
+        Partida.objects.filter(id=partida.id).update(
+            estado='terminada', fecha_fin=timezone.now(), liquidada=True, version=F('version') + 1)
+
+    # bulk_update no lanza señales: se descartan los usuarios autenticados en caché
     for jugador in jugadores:
-        usuario = jugador.usuario
-        if ganador_equipo == 0 or jugador.equipo == ganador_equipo:
-            usuario.victorias += 1
-            usuario.racha_victorias += 1
-            if usuario.racha_victorias > usuario.mayor_racha_victorias:
-                usuario.mayor_racha_victorias = usuario.racha_victorias
-        else:
-            usuario.derrotas += 1
-            usuario.racha_victorias = 0
-        usuario.save()
-
-def _buscar_partida_personalizada(
-    usuario: Usuario,
-    capacidad: int,
-    solo_amigos: bool,
-    tiempo_turno: int,
-    permitir_revueltas: bool,
-    reglas_arrastre: bool
-):
-    """Busca una partida personalizada con la configuración dada"""
-    partidas = Partida.objects.filter(
-        es_personalizada=True,
-        capacidad=capacidad,
-        solo_amigos=solo_amigos,
-        tiempo_turno=tiempo_turno,
-        permitir_revueltas=permitir_revueltas,
-        reglas_arrastre=reglas_arrastre,
-        estado='esperando'
-    ).exclude(jugadores__usuario=usuario)
-    for partida in partidas:
-        num_jugadores = JugadorPartida.objects.filter(partida=partida, conectado=True).count()
-        if num_jugadores < partida.capacidad:
-            return partida
-    return None
-
-def _crear_partida_personalizada(
-    capacidad: int,
-    solo_amigos: bool,
-    tiempo_turno: int,
-    permitir_revueltas: bool,
-    reglas_arrastre: bool
-):
-    """Crea una partida personalizada con la configuración dada"""
-    partida = Partida(
-        es_personalizada=True,
-        capacidad=capacidad,
-        solo_amigos=solo_amigos,
-        tiempo_turno=tiempo_turno,
-        permitir_revueltas=permitir_revueltas,
-        reglas_arrastre=reglas_arrastre
-    )
-    if partida:
-        partida.save()
-        return partida
-    return None
-
-def _obtener_config_personalizada(params: dict):
-    """Leer parámetros de la URL de conexión a una partida personalizada"""
-    try:
-        capacidad_value = params.get('capacidad', 2)
-        if isinstance(capacidad_value, list):
-            capacidad_value = str(capacidad_value[0])
-        else:
-            capacidad_value = str(capacidad_value)
-        capacidad = 2 if int(capacidad_value) not in [2,4] else int(capacidad_value)
-    except Exception as e:
-        print(f"Error al obtener la capacidad: {e}")
-        capacidad = 2
-    
-    try:
-        tiempo_turno_value = params.get('tiempo_turno', 30)
-        if isinstance(tiempo_turno_value, list):
-            tiempo_turno_value = str(tiempo_turno_value[0])
-        else:
-            tiempo_turno_value = str(tiempo_turno_value)
-        tiempo_turno = 30 if int(tiempo_turno_value) not in [15, 30, 60] else int(tiempo_turno_value)
-    except Exception as e:
-        print(f"Error al obtener el tiempo de turno: {e}")
-        tiempo_turno = 30
-
-    solo_amigos = params.get('solo_amigos', ['false'])[0].lower() == 'true'
-    permitir_revueltas = params.get('permitir_revueltas', ['true'])[0].lower() == 'true'
-    reglas_arrastre = params.get('reglas_arrastre', ['true'])[0].lower() == 'true'
-
-    return capacidad, solo_amigos, tiempo_turno, permitir_revueltas, reglas_arrastre
-
-@database_sync_to_async
-def obtener_o_crear_partida_personalizada(
-    usuario: Usuario,
-    params: dict
-):
-    """
-    Obtiene una partida con la configuración dada. Si no la encuentra, en su defecto,
-    crea una nueva partida con dicha configuración
-    """
-
-    # Obtener y parsear parámetros de la url
-    capacidad, solo_amigos, tiempo_turno, permitir_revueltas, reglas_arrastre = \
-        _obtener_config_personalizada(params)
-    
-    # Buscar o crear partida
-    p: Partida = _buscar_partida_personalizada(
-        usuario, capacidad, solo_amigos, tiempo_turno, permitir_revueltas, reglas_arrastre)
-    if not p:
-        p = _crear_partida_personalizada(
-            capacidad, solo_amigos, tiempo_turno, permitir_revueltas, reglas_arrastre)
-    return p
-
-@database_sync_to_async
-def marcar_como_finalizada(partida: Partida):
-    """Marcar partida como finalizada"""
-    partida.marcar_como_finalizada()
\ No newline at end of file
+        olvidar_usuario(jugador.usuario_id)
+    return jugadores
\ No newline at end of file
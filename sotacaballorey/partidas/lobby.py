@@ -0,0 +1,156 @@
+"""
+Listados de salas del lobby.
+
+Las salas se leen con sus jugadores en dos consultas (partidas y jugadores
+con su nombre) sea cual sea el número de salas, y se paginan por id con un
+cursor. La lista de salas en espera es la misma para todos los usuarios, así
+que se guarda en la caché de Django durante TTL_SALAS_EN_ESPERA segundos y se
+invalida cuando un jugador entra o sale de una sala en espera o esta cambia
+(no con las escrituras de las partidas en curso). La caché es compartida
+(Redis, ver CACHES en settings.py) porque la invalidación se hace en el
+proceso que cambia la sala: con una caché local a cada proceso los demás
+servirían la lista vieja hasta que caducase
+"""
+from django.db.models.signals import post_save, post_delete
+from .models import Partida, JugadorPartida
+from django.db.models import Prefetch
+from django.dispatch import receiver
+from django.core.cache import cache
+
+CLAVE_SALAS_EN_ESPERA = 'lobby:salas_en_espera'
+TTL_SALAS_EN_ESPERA = 5     # s
+LIMITE_SALAS = 50
+LIMITE_MAXIMO_SALAS = 100
+
+def con_jugadores(partidas):
+    """Añade a la consulta de partidas sus jugadores con el nombre del usuario"""
+    return partidas.prefetch_related(Prefetch(
+        'jugadores',
+        queryset=JugadorPartida.objects.select_related('usuario')
+            .only('partida', 'usuario__nombre').order_by('id')
+    ))
+
+def construir_sala_json(partida: Partida):
+    """
+    Te devuelve la información de una sala en formato JSON
+    Añade información extra si la partida es personalizada.
+    Los jugadores deben venir precargados (con_jugadores)
+    """
+    jugadores = partida.jugadores.all()
+    nombre_jugadores = [j.usuario.nombre for j in jugadores]
+
+    sala = {
+        'id': partida.id,
+        'nombre': f'Sala {partida.id}',
+        'capacidad': partida.capacidad,
+        'num_jugadores': len(nombre_jugadores),
+        'jugadores': nombre_jugadores
+    }
+
+    if partida.es_personalizada:
+        sala['personalizacion'] = {
+            'tiempo_turno': partida.tiempo_turno,
+            'reglas_arrastre': partida.reglas_arrastre,
+            'permitir_revueltas': partida.permitir_revueltas,
+            'solo_amigos': partida.solo_amigos
+        }
+
+    return sala
+
+#-----------------------------------------------------------------------------------#
+# Paginación                                                                        #
+#-----------------------------------------------------------------------------------#
+
+def parametros_pagina(request) -> tuple:
+    """Lee <cursor> (id de la última sala recibida) y <limite> de la URL"""
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+    except ValueError:
+        cursor = 0
+    try:
+        limite = int(request.GET.get('limite', LIMITE_SALAS))
+    except ValueError:
+        limite = LIMITE_SALAS
+    return cursor, max(1, min(limite, LIMITE_MAXIMO_SALAS))
+
+def pagina_de_consulta(partidas, cursor: int, limite: int) -> tuple:
+    """
+    Página de una consulta de partidas a partir del cursor. Devuelve las salas
+    en JSON y el cursor de la página siguiente (None si es la última)
+    """
+    partidas = list(con_jugadores(partidas.filter(id__gt=cursor).order_by('id'))[:limite + 1])
+    return pagina_de_lista([construir_sala_json(p) for p in partidas], cursor, limite)
+
+def pagina_de_lista(salas: list, cursor: int, limite: int) -> tuple:
+    """Igual que pagina_de_consulta pero sobre una lista de salas ordenada por id"""
+    salas = [s for s in salas if s['id'] > cursor][:limite + 1]
+    if len(salas) > limite:
+        return salas[:limite], salas[limite - 1]['id']
+    return salas, None
+
+#-----------------------------------------------------------------------------------#
+# Salas en espera (caché compartida)                                                #
+#-----------------------------------------------------------------------------------#
+
+def salas_en_espera() -> list:
+    """
+    Todas las salas en espera ordenadas por id, como tuplas (sala en JSON,
+    ids de los usuarios que están dentro, solo_amigos)
+    """
+    salas = cache.get(CLAVE_SALAS_EN_ESPERA)
+    if salas is None:
+        partidas = con_jugadores(Partida.objects.filter(estado='esperando').order_by('id'))
+        salas = [
+            (construir_sala_json(p), [j.usuario_id for j in p.jugadores.all()], p.solo_amigos)
+            for p in partidas
+        ]
+        cache.set(CLAVE_SALAS_EN_ESPERA, salas, TTL_SALAS_EN_ESPERA)
+    return salas
+
+def sala_en_espera(partida_id):
+    """Una sala con el formato de salas_en_espera (None si ya no está en espera)"""
+    partida = con_jugadores(Partida.objects.filter(id=partida_id, estado='esperando')).first()
+    if partida is None:
+        return None
+    return (construir_sala_json(partida), [j.usuario_id for j in partida.jugadores.all()],
+            partida.solo_amigos)
+
+def invalidar_salas_en_espera():
+    """Descarta la lista de salas en espera (alguien entra, sale o empieza una partida)"""
+    cache.delete(CLAVE_SALAS_EN_ESPERA)
+
+# Columnas de la partida que se ven en el lobby
+CAMPOS_LOBBY = {'estado', 'capacidad', 'es_personalizada', 'tiempo_turno',
+                'reglas_arrastre', 'permitir_revueltas', 'solo_amigos'}
+
+def _en_espera(partida: Partida) -> bool:
+    """La partida está o estaba (al leerla o guardarla) en espera"""
+    return 'esperando' in (partida.estado, getattr(partida, '_estado_leido', None))
+
+@receiver(post_save, sender=Partida)
+def _partida_guardada(sender, instance, created, update_fields=None, **kwargs):
+    # Las escrituras de las partidas en curso no cambian el lobby
+    en_espera = _en_espera(instance)
+    instance._estado_leido = instance.estado
+    if en_espera and (created or update_fields is None or CAMPOS_LOBBY & set(update_fields)):
+        invalidar_salas_en_espera()
+
+@receiver(post_delete, sender=Partida)
+def _partida_borrada(sender, instance, **kwargs):
+    if _en_espera(instance):
+        invalidar_salas_en_espera()
+
+@receiver(post_save, sender=JugadorPartida)
+def _jugador_guardado(sender, instance, created, **kwargs):
+    # Conectarse o desconectarse no cambia la lista: solo quién está dentro
+    if created:
+        invalidar_salas_en_espera()
+
+@receiver(post_delete, sender=JugadorPartida)
+def _jugador_borrado(sender, instance, origin=None, **kwargs):
+    # Si se borra con su partida, ya invalida la partida (si estaba en espera)
+    if isinstance(origin, Partida):
+        return
+    if JugadorPartida.partida.is_cached(instance) and not _en_espera(instance.partida):
+        return
+    invalidar_salas_en_espera()
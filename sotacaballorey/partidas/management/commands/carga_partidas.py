@@ -0,0 +1,92 @@
+from partidas.carga import ejecutar_carga, ConexionLocal, ConexionRemota
+from partidas.metricas import obtener_metricas
+from django.core.management.base import BaseCommand, CommandError
+from aspecto_carta.models import CardSkin
+from utils.jwt_auth import generar_token
+from usuarios.models import Usuario
+from tapete.models import Tapete
+import asyncio
+
+class Command(BaseCommand):
+    help = ('Prueba de carga de /ws/partida/: conecta muchos jugadores simulados que se '
+            'emparejan y juegan partidas completas, y mide latencias y conexiones caídas')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jugadores', type=int, default=100,
+            help='Número de jugadores simulados (se crean usuarios <prefijo>_N si no existen)')
+        parser.add_argument('--capacidad', type=int, choices=[2, 4], default=2)
+        parser.add_argument('--intervalo', type=float, default=10,
+            help='Milisegundos entre el inicio de dos conexiones')
+        parser.add_argument('--timeout', type=float, default=60,
+            help='Segundos máximos de espera por mensaje antes de dar la conexión por caída')
+        parser.add_argument('--url', default=None,
+            help='Servidor real (p. ej. ws://localhost:8000). Sin URL se prueba dentro del proceso')
+        parser.add_argument('--prefijo', default='carga')
+        parser.add_argument('--semilla', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not CardSkin.objects.filter(name='Default').exists() or \
+            not Tapete.objects.filter(name='Default').exists():
+                raise CommandError('Faltan los aspectos por defecto: carga antes los fixtures '
+                                   'de aspecto_carta y tapete')
+
+        jugadores = []
+        for i in range(options['jugadores']):
+            nombre = f"{options['prefijo']}_{i}"
+            usuario, _ = Usuario.objects.get_or_create(nombre=nombre, defaults={
+                'correo': f'{nombre}@carga.local',
+                'contrasegna': nombre
+            })
+            jugadores.append((usuario.id, generar_token(usuario)))
+
+        if options['url']:
+            try:
+                import websockets
+            except ImportError:
+                raise CommandError('Para probar contra un servidor hace falta instalar websockets')
+            base = options['url'].rstrip('/')
+            crear_conexion = lambda ruta: ConexionRemota(base + ruta)
+        else:
+            from sotacaballorey.asgi import application
+            crear_conexion = lambda ruta: ConexionLocal(application, ruta)
+
+        escrituras = obtener_metricas()['escrituras']
+        metricas = asyncio.run(ejecutar_carga(
+            jugadores, options['capacidad'], crear_conexion,
+            intervalo=options['intervalo'] / 1000,
+            timeout=options['timeout'],
+            semilla=options['semilla']
+        ))
+
+        r = metricas.resumen()
+        def ms(valor):
+            return '-' if valor is None else f'{valor:.1f} ms'
+
+        self.stdout.write(
+            f"{options['jugadores']} jugadores ({options['capacidad']} por partida) en {r['duracion_s']:.1f} s | "
+            f"máximo {r['max_conectados']} conectados a la vez"
+        )
+        self.stdout.write(
+            f"Conexión: p50 {ms(r['conexion_p50_ms'])} | p99 {ms(r['conexion_p99_ms'])} | "
+            f"rechazadas {r['rechazadas']}"
+        )
+        self.stdout.write(
+            f"Jugadas: {r['jugadas']} | p50 {ms(r['jugada_p50_ms'])} | p95 {ms(r['jugada_p95_ms'])} | "
+            f"p99 {ms(r['jugada_p99_ms'])} | máx {ms(r['jugada_max_ms'])}"
+        )
+        self.stdout.write(
+            f"Mensajes: {r['mensajes']} ({r['mensajes_por_segundo']:.0f}/s) | errores {r['errores']}"
+        )
+        self.stdout.write(
+            f"Partida terminada: {r['terminadas']} | caídas: {r['caidas']} | sin partida: {r['sin_partida']}"
+        )
+
+        # Lo que escriben los volcados de las salas (solo se ve si se prueba dentro del proceso)
+        if not options['url'] and r['terminadas']:
+            despues = obtener_metricas()['escrituras']
+            partidas = r['terminadas'] / options['capacidad']
+            self.stdout.write(
+                f"Escrituras por partida: {(despues['volcados'] - escrituras['volcados']) / partidas:.1f} volcados | "
+                f"{(despues['columnas'] - escrituras['columnas']) / partidas:.1f} columnas | "
+                f"{(despues['bytes'] - escrituras['bytes']) / partidas / 1024:.1f} KB"
+            )
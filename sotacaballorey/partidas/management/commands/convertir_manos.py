@@ -0,0 +1,45 @@
+from partidas.game.cartas import carta_a_int, int_a_carta, mascara, cartas_de
+from django.core.management.base import BaseCommand
+from partidas.models import Partida, JugadorPartida
+from django.db import transaction
+from django.db.models import F
+
+class Command(BaseCommand):
+    help = ('Pasa las manos y el mazo de las partidas sin terminar al formato compacto '
+            '(máscaras de bits y bytes) o de vuelta a listas JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('formato', choices=['compacto', 'json'])
+
+    def handle(self, *args, **options):
+        compacto = options['formato'] == 'compacto'
+        repartidas = Partida.objects.exclude(estado='terminada').filter(estado_json__has_key='triunfo')
+
+        with transaction.atomic():
+            # Se cambia la versión: una sala cargada con el formato anterior no sobrescribe nada
+            partidas = repartidas.filter(baraja__isnull=compacto).only('id', 'estado_json', 'baraja')
+            num_partidas = 0
+            for partida in partidas:
+                estado_json = dict(partida.estado_json)
+                if compacto:
+                    baraja = bytes(carta_a_int(c) for c in estado_json.pop('baraja', []))
+                else:
+                    estado_json['baraja'] = [int_a_carta(c) for c in bytes(partida.baraja)]
+                    baraja = None
+                Partida.objects.filter(id=partida.id).update(
+                    estado_json=estado_json, baraja=baraja, version=F('version') + 1)
+                num_partidas += 1
+
+            jugadores = list(JugadorPartida.objects.filter(
+                partida__in=repartidas, mano__isnull=compacto).only('id', 'cartas_json', 'mano'))
+            for jugador in jugadores:
+                if compacto:
+                    jugador.mano = mascara(carta_a_int(c) for c in jugador.cartas_json or [])
+                    jugador.cartas_json = []
+                else:
+                    jugador.cartas_json = [int_a_carta(c) for c in cartas_de(jugador.mano)]
+                    jugador.mano = None
+            JugadorPartida.objects.bulk_update(jugadores, ['cartas_json', 'mano'], batch_size=500)
+
+        self.stdout.write(
+            f"Convertidas al formato {options['formato']} {num_partidas} partidas y {len(jugadores)} manos")
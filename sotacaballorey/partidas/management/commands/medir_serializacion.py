@@ -0,0 +1,86 @@
+from utils.serializacion import SERIALIZADORES, elegir_serializador
+from django.core.management.base import BaseCommand
+from partidas.game.cartas import int_a_carta
+from partidas.game.messages import MessageTypes
+from partidas.game import protocolo
+import time
+
+def mensajes_de_prueba(jugadores: int) -> dict:
+    """Mensajes START_GAME y CARD_PLAYED como los de una partida de <jugadores>"""
+    start_game = {
+        'type': MessageTypes.START_GAME,
+        'data': {
+            'jugadores': [{
+                'id': 1000 + i,
+                'nombre': f'Jugador número {i}',
+                'equipo': i % 2 + 1,
+                'num_cartas': 6,
+                'carta_jugada': int_a_carta(i) if i % 2 else None
+            } for i in range(jugadores)],
+            'mazo_restante': 40 - 6 * jugadores - 1,
+            'fase_arrastre': False,
+            'carta_triunfo': int_a_carta(37),
+            'chat_id': 1234,
+            'tiempo_turno': 30,
+            'puntos_equipo_1': 31,
+            'puntos_equipo_2': 24,
+            'pausados': 0,
+            'turno': 1000,
+            'mis_cartas': [int_a_carta(c) for c in range(10, 16)]
+        }
+    }
+    card_played = {
+        'type': MessageTypes.CARD_PLAYER,
+        'data': {
+            'jugador': {'nombre': 'Jugador número 0', 'id': 1000},
+            'automatica': False,
+            'carta': int_a_carta(12)
+        }
+    }
+    return {'start_game': start_game, 'card_played': card_played}
+
+def medir(funcion, argumento, veces: int, iteraciones: int) -> float:
+    """µs por envío al grupo llamando <veces> a la función con el mismo argumento"""
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        for _ in range(veces):
+            funcion(argumento)
+    return (time.perf_counter() - inicio) / iteraciones * 1e6
+
+class Command(BaseCommand):
+    help = ('Mide el coste de codificar los mensajes START_GAME y CARD_PLAYED para un grupo: '
+            'una vez por destinatario o una sola vez, con cada serializador disponible y con '
+            'el protocolo compacto; y lo que cuesta decodificarlos en el cliente')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iteraciones', type=int, default=20000)
+        parser.add_argument('--jugadores', type=int, choices=[2, 4], default=4)
+
+    def handle(self, *args, **options):
+        iteraciones = options['iteraciones']
+        jugadores = options['jugadores']
+
+        for nombre_mensaje, mensaje in mensajes_de_prueba(jugadores).items():
+            for nombre in SERIALIZADORES:
+                serializador = elegir_serializador(nombre)
+                por_destinatario = medir(serializador.codificar, mensaje, jugadores, iteraciones)
+                una_vez = medir(serializador.codificar, mensaje, 1, iteraciones)
+                texto = serializador.codificar(mensaje)
+                decodificar = medir(serializador.decodificar, texto, 1, iteraciones)
+                self.stdout.write(
+                    f"{nombre_mensaje:<12} {nombre:<8} {len(texto.encode()):>4} bytes | "
+                    f"por destinatario ({jugadores}) {por_destinatario:.2f} µs | "
+                    f"una vez {una_vez:.2f} µs | x{por_destinatario / una_vez:.1f} | "
+                    f"decodificar {decodificar:.2f} µs"
+                )
+
+            if protocolo.disponible:
+                codificar = lambda m: protocolo.codificar_compacto(m['type'], m['data'])
+                una_vez = medir(codificar, mensaje, 1, iteraciones)
+                binario = codificar(mensaje)
+                # El cliente usa directamente las claves cortas y las cartas como enteros
+                decodificar = medir(protocolo.msgpack.unpackb, binario, 1, iteraciones)
+                self.stdout.write(
+                    f"{nombre_mensaje:<12} {'compacto':<8} {len(binario):>4} bytes | "
+                    f"una vez {una_vez:.2f} µs | decodificar {decodificar:.2f} µs"
+                )
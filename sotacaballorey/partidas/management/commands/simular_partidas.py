@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from partidas.game.simulador import simular, BOTS
+
+class Command(BaseCommand):
+    help = 'Juega partidas completas entre bots sobre el motor de reglas y mide su rendimiento'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--partidas', type=int, default=1000,
+            help='Partidas a jugar por cada capacidad')
+        parser.add_argument('--capacidad', type=int, choices=[2, 4], action='append',
+            help='Capacidad (2 o 4). Se puede repetir; por defecto ambas')
+        parser.add_argument('--bot', choices=sorted(BOTS), default='aleatorio')
+        parser.add_argument('--semilla', type=int, default=0)
+        parser.add_argument('--min-acciones-por-segundo', type=float, default=None,
+            help='Falla si alguna capacidad no llega a este rendimiento')
+        parser.add_argument('--max-p99-us', type=float, default=None,
+            help='Falla si el p99 del coste por acción supera este valor (µs)')
+
+    def handle(self, *args, **options):
+        errores = []
+
+        for capacidad in options['capacidad'] or [2, 4]:
+            r = simular(options['partidas'], capacidad, options['bot'], options['semilla'])
+            self.stdout.write(
+                f"{capacidad} jugadores ({r['bot']}): {r['partidas']} partidas en {r['segundos']:.2f} s | "
+                f"{r['partidas_por_segundo']:.0f} partidas/s | {r['acciones_por_segundo']:.0f} acciones/s | "
+                f"p50 {r['accion_p50_us']:.1f} µs | p99 {r['accion_p99_us']:.1f} µs"
+            )
+            self.stdout.write(
+                f"    cantos {r['cantos']} | cambios del 7 {r['cambios_siete']} | "
+                f"arrastres {r['arrastres']} | revueltas {r['revueltas']} | victorias {r['victorias']}"
+            )
+
+            minimo = options['min_acciones_por_segundo']
+            if minimo is not None and r['acciones_por_segundo'] < minimo:
+                errores.append(f"{capacidad} jugadores: {r['acciones_por_segundo']:.0f} acciones/s < {minimo:.0f}")
+            maximo = options['max_p99_us']
+            if maximo is not None and r['accion_p99_us'] > maximo:
+                errores.append(f"{capacidad} jugadores: p99 {r['accion_p99_us']:.1f} µs > {maximo:.1f} µs")
+
+        if errores:
+            raise CommandError('Rendimiento por debajo del umbral: ' + '; '.join(errores))
@@ -0,0 +1,24 @@
+"""
+Registro de métricas del proceso. Cada servicio registra una función que
+devuelve un diccionario con sus métricas y la vista /salas/metricas/ las
+agrupa todas
+"""
+
+# Nombre del servicio -> función que devuelve sus métricas
+_fuentes = {}
+
+def registrar_metricas(nombre: str, funcion):
+    """Registra la función que devuelve las métricas del servicio <nombre>"""
+    _fuentes[nombre] = funcion
+
+def obtener_metricas() -> dict:
+    """Devuelve las métricas de todos los servicios registrados"""
+    return {nombre: funcion() for nombre, funcion in _fuentes.items()}
+
+def percentil(valores, p: float):
+    """Percentil <p> (0-100) de una lista de valores (None si está vacía)"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    idx = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[idx]
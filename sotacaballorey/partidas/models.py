@@ -1,4 +1,5 @@
 from django.core.validators import MinValueValidator, MaxValueValidator
+from partidas.game.cartas import int_a_carta, cartas_de
 from chat_partida.models import Chat_partida
 from usuarios.models import Usuario
 from django.utils import timezone
@@ -29,6 +30,9 @@ class Partida(models.Model):
         default=0, validators=[MinValueValidator(0)]
     )
     estado_json = models.JSONField(default=dict, blank=True)
+    # Mazo en formato compacto (un byte por carta, partidas.game.cartas). Si es
+    # None el mazo está en estado_json['baraja']
+    baraja = models.BinaryField(null=True, blank=True)
     es_revueltas = models.BooleanField(default=False)
     cantos_realizados = models.JSONField(default=dict)
     jugadores_pausa = models.JSONField(default=list)
@@ -43,16 +47,35 @@ class Partida(models.Model):
     es_personalizada = models.BooleanField(default=False)
     # Info eliminación
     fecha_fin = models.DateTimeField(null=True, blank=True)
+    # Estadísticas y ELO de los jugadores ya actualizados (partidas.game.utils.liquidar_partida)
+    liquidada = models.BooleanField(default=False)
+    # Se incrementa con cada escritura del juego (partidas.game.utils.guardar_con_version)
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'Partida {self.id} - {self.capacidad} jugadores ({self.estado})'
+
+    @property
+    def mazo(self) -> list:
+        """Cartas del mazo en JSON, esté guardado como esté"""
+        if self.baraja is not None:
+            return [int_a_carta(c) for c in bytes(self.baraja)]
+        return (self.estado_json or {}).get('baraja', [])
     
     def get_chat_id(self):
-        if not self.chat:
+        # Se usa la clave ajena directamente para no cargar el chat
+        if not self.chat_id:
             chat = Chat_partida.objects.create()
             self.chat = chat
-            self.save()
-        return self.chat.id
+            Partida.objects.filter(id=self.id).update(chat=chat)
+        return self.chat_id
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Recuerda el estado leído (el lobby solo cambia con las salas que estaban en espera)"""
+        partida = super().from_db(db, field_names, values)
+        partida._estado_leido = partida.__dict__.get('estado')
+        return partida
 
     def save(self, *args, **kwargs):
         """Sobreescribir <save> para crear chat cuando se cree nueva partida"""
@@ -85,8 +108,57 @@ class JugadorPartida(models.Model):
         default=1, validators=[MinValueValidator(1), MaxValueValidator(2)]
     )
     cartas_json = models.JSONField(default=list, blank=True)
+    # Mano en formato compacto (máscara de bits, partidas.game.cartas). Si es
+    # None la mano está en cartas_json
+    mano = models.BigIntegerField(null=True, blank=True)
     conectado = models.BooleanField(default=True)
     channel_name = models.CharField(max_length=128, blank=True, null=True)
 
     def __str__(self):
-        return f'Jugador {self.usuario.nombre} en partida {self.partida.id}'
\ No newline at end of file
+        return f'Jugador {self.usuario.nombre} en partida {self.partida.id}'
+
+    @property
+    def cartas(self) -> list:
+        """Cartas de la mano en JSON, esté guardada como esté"""
+        if self.mano is not None:
+            return [int_a_carta(c) for c in cartas_de(self.mano)]
+        return self.cartas_json or []
+
+class EventoPartida(models.Model):
+    """
+    Registro de solo escritura de las acciones aceptadas en una partida
+    (partidas.game.registro). <valor> es la carta jugada, o la semilla en un
+    reparto
+    """
+    partida = models.ForeignKey(
+        Partida, on_delete=models.CASCADE, related_name='eventos'
+    )
+    numero = models.PositiveIntegerField()
+    tipo = models.CharField(max_length=16)
+    asiento = models.SmallIntegerField(null=True, blank=True)
+    valor = models.BigIntegerField(null=True, blank=True)
+    fecha = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('partida', 'numero')
+        ordering = ['partida', 'numero']
+
+    def __str__(self):
+        return f'Evento {self.numero} de partida {self.partida_id}: {self.tipo}'
+
+class PropiedadPartida(models.Model):
+    """
+    Concesión de una partida en curso a un proceso del servidor
+    (partidas.game.propiedad). Mientras no vence, solo ese proceso lleva la
+    sala y el temporizador de la partida; el resto le reenvía las acciones
+    por <canal>
+    """
+    partida = models.OneToOneField(
+        Partida, on_delete=models.CASCADE, primary_key=True, related_name='propiedad'
+    )
+    propietario = models.CharField(max_length=64)
+    canal = models.CharField(max_length=255)
+    vence = models.DateTimeField()
+
+    def __str__(self):
+        return f'Partida {self.partida_id} en {self.propietario} hasta {self.vence}'
@@ -1,6 +1,8 @@
 from partidas.game.consumers import PartidaConsumer
+from partidas.game.lobby import LobbyConsumer
 from django.urls import path
 
 websocket_urlpatterns = [
     path('ws/partida/', PartidaConsumer.as_asgi()),
+    path('ws/lobby/', LobbyConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,117 @@
+from partidas.game.utils import get_jugador, get_jugadores, contar_jugadores, refresh, obtener_partida_por_id
+from partidas.models import Partida, JugadorPartida
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from partidas.metricas import obtener_metricas
+from sotacaballorey.asgi import application
+from utils.jwt_auth import generar_token
+from partidas.game.sala import obtener_sala
+from partidas.game.bd import contar_consultas
+from utils.jwt_auth import usuario_existe_async
+from asgiref.sync import async_to_sync, sync_to_async
+from usuarios.models import Usuario
+from django.db import connection
+import json
+import time
+
+class BaseDeDatosTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.partida = Partida.objects.create(capacidad=2)
+        self.usuarios = []
+        for i in (1, 2):
+            usuario = Usuario.objects.create(
+                nombre=f'Usuario {i}', correo=f'user{i}@gmail.com', contrasegna='123')
+            JugadorPartida.objects.create(partida=self.partida, usuario=usuario,
+                                          equipo=i, conectado=(i == 1))
+            self.usuarios.append(usuario)
+
+    def test_consultas_y_metricas(self):
+        """Las consultas de los consumidores pasan por el hilo de la base de datos y quedan medidas"""
+        antes = obtener_metricas()['base_de_datos']
+
+        async def inner():
+            jugador = await get_jugador(self.partida, self.usuarios[0])
+            self.assertEqual(jugador.usuario_id, self.usuarios[0].id)
+            jugadores = await get_jugadores(self.partida)
+            self.assertEqual([j.usuario.nombre for j in jugadores], ['Usuario 1', 'Usuario 2'])
+            self.assertEqual(await contar_jugadores(self.partida), 1)
+
+            await Partida.objects.filter(id=self.partida.id).aupdate(estado='jugando')
+            self.assertEqual((await refresh(self.partida)).estado, 'jugando')
+            self.assertIsNotNone(await obtener_partida_por_id(self.partida.id))
+
+            # Se cuentan las sentencias SQL, también las que no pasan por bd.py
+            with contar_consultas('prueba') as consultas:
+                await get_jugadores(self.partida)
+                await usuario_existe_async(self.usuarios[0])
+            self.assertEqual(consultas[0], 2)
+
+            # Una conexión vencida se cierra antes de la siguiente consulta
+            def vencer():
+                connection.ensure_connection()
+                connection.close_at = time.monotonic() - 1
+                return connection.connection
+            vencida = await sync_to_async(vencer)()
+            await get_jugadores(self.partida)
+            self.assertIsNot(await sync_to_async(lambda: connection.connection)(), vencida)
+
+        async_to_sync(inner)()
+        despues = obtener_metricas()['base_de_datos']
+        self.assertEqual(despues['llamadas'], antes['llamadas'] + 7)
+        self.assertEqual(despues['en_curso'], 0)
+        self.assertIsNotNone(despues['espera_p99_ms'])
+
+    def test_jugada_sin_consultas(self):
+        """Jugar una carta o pedir la pausa no vuelve a buscar al jugador en la base de datos"""
+        async def recibir_hasta(comm, tipo):
+            while True:
+                msg = json.loads(await comm.receive_from(timeout=5))
+                if msg['type'] == tipo:
+                    return msg
+
+        def consultas(accion):
+            por_accion = obtener_metricas()['base_de_datos']['consultas_por_accion']
+            return por_accion.get(accion, {'veces': 0, 'consultas': 0})
+        antes = {accion: consultas(accion) for accion in ('jugar_carta', 'pausa')}
+
+        async def inner():
+            comms = {}
+            for usuario in self.usuarios:
+                token = generar_token(usuario)
+                comm = WebsocketCommunicator(application, f'/ws/partida/?token={token}&id_partida={self.partida.id}')
+                conectado, _ = await comm.connect()
+                self.assertTrue(conectado)
+                comms[usuario.id] = comm
+
+            inicio = {u: await recibir_hasta(c, 'start_game') for u, c in comms.items()}
+            turno = (await recibir_hasta(comms[self.usuarios[0].id], 'turn_update'))['data']['jugador']['id']
+            await recibir_hasta(comms[self.usuarios[1].id], 'turn_update')
+
+            carta = inicio[turno]['data']['mis_cartas'][0]
+            await comms[turno].send_to(text_data=json.dumps({'accion': 'jugar_carta', 'carta': carta}))
+            for comm in comms.values():
+                await recibir_hasta(comm, 'card_played')
+
+            await comms[turno].send_to(text_data=json.dumps({'accion': 'pausa'}))
+            await recibir_hasta(comms[turno], 'pause')
+
+            # Al irse los dos la partida queda pausada y se cierra la sala
+            for comm in comms.values():
+                await comm.disconnect()
+            self.assertIsNone(obtener_sala(self.partida.id))
+
+        async_to_sync(inner)()
+        for accion, previas in antes.items():
+            self.assertEqual(consultas(accion)['veces'], previas['veces'] + 1)
+            self.assertEqual(consultas(accion)['consultas'], previas['consultas'])
@@ -0,0 +1,23 @@
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from partidas.models import Partida
+from io import StringIO
+
+class CargaPartidasTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def test_carga_una_partida(self):
+        """Dos jugadores simulados se emparejan y juegan una partida completa"""
+        salida = StringIO()
+        call_command('carga_partidas', jugadores=2, intervalo=100, timeout=10, stdout=salida)
+
+        self.assertIn('Partida terminada: 2 | caídas: 0 | sin partida: 0', salida.getvalue())
+        self.assertEqual(Partida.objects.get().estado, 'terminada')
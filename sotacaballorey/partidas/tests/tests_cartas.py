@@ -0,0 +1,53 @@
+from partidas.game.cartas import (
+    carta_a_int, int_a_carta, palo_a_int, mascara, cartas_de,
+    resolver_baza, jugadas_validas, FUERZA, PUNTOS, NUM_CARTAS
+)
+from django.test import SimpleTestCase
+
+def c(palo, valor):
+    return carta_a_int({'palo': palo, 'valor': valor})
+
+class CartasTests(SimpleTestCase):
+
+    def test_codificacion_ida_y_vuelta(self):
+        """Las 40 cartas se convierten a entero y de vuelta sin pérdidas"""
+        for n in range(NUM_CARTAS):
+            self.assertEqual(carta_a_int(int_a_carta(n)), n)
+        self.assertEqual(carta_a_int({'palo': 'Copas', 'valor': '12'}), c('Copas', 12))
+        self.assertEqual(cartas_de(mascara([5, 0, 39])), [0, 5, 39])
+
+    def test_tablas(self):
+        """El as es la carta más fuerte y el dos la más débil; la baraja suma 120"""
+        self.assertEqual(max(range(10), key=FUERZA.__getitem__), c('Oros', 1))
+        self.assertEqual(min(range(10), key=FUERZA.__getitem__), c('Oros', 2))
+        self.assertGreater(FUERZA[c('Oros', 3)], FUERZA[c('Oros', 12)])
+        self.assertEqual(sum(PUNTOS), 120)
+
+    def test_resolver_baza(self):
+        """Gana el triunfo más alto; si no hay, la carta más alta del palo de salida"""
+        oros = palo_a_int('Oros')
+        baza = [c('Copas', 3), c('Copas', 1), c('Espadas', 1)]
+        self.assertEqual(resolver_baza(baza, oros), (1, 32))
+
+        baza = [c('Copas', 1), c('Oros', 2), c('Copas', 3), c('Oros', 4)]
+        self.assertEqual(resolver_baza(baza, oros), (3, 21))
+
+    def test_jugadas_validas(self):
+        """En arrastre hay que asistir y superar, o fallar con triunfo"""
+        oros = palo_a_int('Oros')
+        mano = mascara([c('Copas', 2), c('Copas', 1), c('Oros', 5), c('Bastos', 7)])
+
+        # Asistir superando
+        validas = jugadas_validas(mano, [c('Copas', 3)], oros)
+        self.assertEqual(cartas_de(validas), [c('Copas', 1)])
+
+        # Asistir sin poder superar
+        validas = jugadas_validas(mascara([c('Copas', 2), c('Oros', 5)]), [c('Copas', 3)], oros)
+        self.assertEqual(cartas_de(validas), [c('Copas', 2)])
+
+        # Sin palo: fallar con triunfo
+        validas = jugadas_validas(mano, [c('Espadas', 3)], oros)
+        self.assertEqual(cartas_de(validas), [c('Oros', 5)])
+
+        # Va ganando el compañero: cualquier carta
+        self.assertEqual(jugadas_validas(mano, [c('Copas', 3)], oros, companero_gana=True), mano)
@@ -3,10 +3,10 @@ from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
 from django.test import TransactionTestCase
 from sotacaballorey.asgi import application
-from utils.jwt_auth import generar_token
+from utils.jwt_auth import generar_token, _usuarios
 from asgiref.sync import async_to_sync
 from usuarios.models import Usuario
-from partidas.models import Partida
+from partidas.models import Partida, JugadorPartida
 import json
 from django.core.management import call_command
 
@@ -189,4 +189,36 @@ class PartidaConsumerTest(TransactionTestCase):
             await comm1.disconnect()
             await comm2.disconnect()
 
-        async_to_sync(inner)()
\ No newline at end of file
+        async_to_sync(inner)()
+
+    def test_nombre_cambiado_despues_del_token(self):
+        """La partida anuncia el nombre actual del usuario, no el que lleva su token"""
+        Usuario.objects.filter(id=self.user1.id).update(nombre='Nombre nuevo')
+        _usuarios.pop(self.user1.id, None)
+
+        async def inner():
+            comm = WebsocketCommunicator(application, f'/ws/partida/?token={self.token1}&capacidad=2')
+            conectado, _ = await comm.connect()
+            self.assertTrue(conectado)
+            data = json.loads(await comm.receive_from(timeout=5))
+            self.assertEqual(data['type'], 'player_joined')
+            self.assertEqual(data['data']['usuario']['nombre'], 'Nombre nuevo')
+            await comm.disconnect()
+
+        async_to_sync(inner)()
+
+    def test_usuario_borrado_en_otro_proceso(self):
+        """El token de un usuario borrado no sirve para entrar en una partida"""
+        partida = Partida.objects.create(capacidad=2)
+        Usuario.objects.filter(id=self.user1.id).delete()
+        # Como si se hubiera borrado en otro proceso: aquí no consta
+        _usuarios.pop(self.user1.id, None)
+
+        async def inner():
+            url = f'/ws/partida/?token={self.token1}&id_partida={partida.id}&capacidad=2'
+            comm = WebsocketCommunicator(application, url)
+            conectado, _ = await comm.connect()
+            self.assertFalse(conectado)
+
+        async_to_sync(inner)()
+        self.assertFalse(JugadorPartida.objects.filter(partida=partida).exists())
@@ -5,7 +5,7 @@ from sotacaballorey.asgi import application
 from utils.jwt_auth import generar_token
 from usuarios.models import Usuario
 from partidas.models import Partida, JugadorPartida
-from partidas.game.utils import db_sync_to_async_save
+from partidas.game.utils import db_sync_to_async_save, liquidar_partida
 import json
 from django.core.management import call_command
 
@@ -362,3 +362,35 @@ class TestEloUpdates(TransactionTestCase):
             self.assertEqual(count_below, 2)
 
         async_to_sync(inner)()
+
+    def test_liquidacion_unica(self):
+        """La liquidación escribe todo de una vez y una segunda llamada no cuenta nada"""
+        self.user1.racha_victorias = 3
+        self.user1.mayor_racha_victorias = 3
+        self.user1.elo = 2095
+        self.user1.save()
+        self.user2.elo = 2100
+        self.user2.save()
+        partida = Partida.objects.create(capacidad=2, estado='jugando')
+        JugadorPartida.objects.create(partida=partida, usuario=self.user1, equipo=1)
+        JugadorPartida.objects.create(partida=partida, usuario=self.user2, equipo=2)
+
+        jugadores = async_to_sync(liquidar_partida)(partida, 1)
+        self.assertEqual(len(jugadores), 2)
+        self.assertIsNone(async_to_sync(liquidar_partida)(partida, 1))
+
+        u1 = Usuario.objects.get(id=self.user1.id)
+        u2 = Usuario.objects.get(id=self.user2.id)
+        self.assertEqual((u1.victorias, u1.racha_victorias, u1.mayor_racha_victorias), (1, 4, 4))
+        self.assertEqual((u2.derrotas, u2.racha_victorias), (1, 0))
+        self.assertGreater(u1.elo, 2100)
+        self.assertLess(u2.elo, 2100)
+
+        # Los cambios de rango desbloquean lo suyo
+        self.assertEqual((u1.elo_rank, u2.elo_rank), ('octogenario', 'parroquiano'))
+        self.assertTrue(u1.unlocked_tapetes.filter(name='Azul-plata').exists())
+
+        partida.refresh_from_db()
+        self.assertEqual(partida.estado, 'terminada')
+        self.assertTrue(partida.liquidada)
+        self.assertFalse(JugadorPartida.objects.filter(partida=partida, conectado=True).exists())
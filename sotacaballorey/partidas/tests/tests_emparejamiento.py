@@ -0,0 +1,243 @@
+from partidas.game.emparejamiento import Emparejador, ConfigPartida, config_personalizada, emparejador
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from sotacaballorey.asgi import application
+from partidas.game.messages import MessageTypes
+from partidas.game.utils import agregar_jugador
+from partidas.game import emparejamiento
+from utils.jwt_auth import generar_token
+from asgiref.sync import async_to_sync
+from partidas.models import Partida
+from usuarios.models import Usuario
+from io import StringIO
+import asyncio
+import json
+
+class EmparejamientoTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.usuarios = [
+            Usuario.objects.create(nombre=f'u{i}', correo=f'u{i}@gmail.com', contrasegna='123')
+            for i in range(6)
+        ]
+
+    def test_conexiones_simultaneas(self):
+        """Conexiones a la vez llenan las salas sin crear de más ni pasarse de capacidad"""
+        emparejador = Emparejador()
+
+        async def inner():
+            config = ConfigPartida(capacidad=2)
+            return await asyncio.gather(*[emparejador.asignar(u, config) for u in self.usuarios])
+
+        partidas = async_to_sync(inner)()
+        self.assertEqual(Partida.objects.count(), 3)
+        self.assertEqual([p.id for p in partidas], [1, 1, 2, 2, 3, 3])
+        r = emparejador.metricas()
+        self.assertEqual((r['salas_creadas'], r['salas_llenas'], r['salas_abiertas']), (3, 3, 0))
+        self.assertEqual(r['emparejados'], 6)
+
+    def test_configuracion_y_huecos(self):
+        """Cada configuración tiene su cola y un hueco liberado se vuelve a ocupar"""
+        emparejador = Emparejador()
+        u0, u1, u2, u3 = self.usuarios[:4]
+        self.assertEqual(config_personalizada({'capacidad': ['4'], 'tiempo_turno': ['15']}),
+                         ConfigPartida(4, True, 15, True, True, False))
+
+        async def inner():
+            config = ConfigPartida(capacidad=4)
+            p1 = await emparejador.asignar(u0, config)
+            p2 = await emparejador.asignar(u1, ConfigPartida(capacidad=4, tiempo_turno=60))
+            self.assertNotEqual(p1.id, p2.id)
+
+            # El mismo usuario no se empareja consigo mismo
+            p3 = await emparejador.asignar(u0, config)
+            self.assertNotEqual(p1.id, p3.id)
+
+            # Se llena la primera sala por id y por la cola
+            self.assertTrue(emparejador.ocupar(p1.id, u1.id))
+            self.assertTrue(emparejador.ocupar(p1.id, u2.id))
+            self.assertEqual((await emparejador.asignar(u3, config)).id, p1.id)
+            self.assertFalse(emparejador.ocupar(p1.id, self.usuarios[4].id))
+
+            # Sale uno: la sala vuelve al final de la cola
+            self.assertEqual(emparejador.liberar(p1.id, u2.id), 3)
+            self.assertEqual((await emparejador.asignar(self.usuarios[5], config)).id, p3.id)
+            emparejador.cerrar(p3.id)
+            self.assertEqual((await emparejador.asignar(u2, config)).id, p1.id)
+
+        async_to_sync(inner)()
+
+    def test_solo_amigos(self):
+        """En las salas solo de amigos se entra con un amigo o se abre otra"""
+        emparejador = Emparejador()
+        u0, u1, u2 = self.usuarios[:3]
+        u0.amigos.add(u2)
+        config = ConfigPartida(capacidad=4, es_personalizada=True, solo_amigos=True)
+
+        async def inner():
+            p1 = await emparejador.asignar(u0, config)
+            self.assertNotEqual((await emparejador.asignar(u1, config)).id, p1.id)
+            self.assertEqual((await emparejador.asignar(u2, config)).id, p1.id)
+
+        async_to_sync(inner)()
+
+    def test_elo(self):
+        """Se entra en la sala de Elo más cercano y la ventana se ensancha con la espera"""
+        reloj = [0.0]
+        emparejador = Emparejador(reloj=lambda: reloj[0])
+        u = self.usuarios
+        config = ConfigPartida(capacidad=2)
+
+        async def inner():
+            a = await emparejador.asignar(u[0], config, elo=1200)
+            b = await emparejador.asignar(u[1], config, elo=1500)
+            self.assertNotEqual(a.id, b.id)
+            self.assertEqual((await emparejador.asignar(u[2], config, elo=1450)).id, b.id)
+
+            # 200 puntos no caben en la ventana inicial...
+            c = await emparejador.asignar(u[3], config, elo=1000)
+            self.assertNotEqual(c.id, a.id)
+
+            # ...pero tras 10 s de espera sí: se elige la sala más cercana
+            reloj[0] = 10.0
+            self.assertEqual((await emparejador.asignar(u[4], config, elo=1350)).id, a.id)
+            return a, c
+
+        a, c = async_to_sync(inner)()
+        r = emparejador.metricas()
+        self.assertEqual(r['profundidad'], {'2-clasificatoria': 1})
+        self.assertEqual(r['histograma_espera']['<=1s'], 3)
+        self.assertEqual(r['histograma_espera']['<=15s'], 1)
+        self.assertEqual(r['diferencia_elo_p99'], 150)
+
+        # El Elo se lee del usuario si no se da: individual en 1v1, de parejas en 2v2
+        self.usuarios[5].elo_parejas = 1700
+        self.usuarios[5].save()
+        async def parejas():
+            return await emparejador.asignar(self.usuarios[5], ConfigPartida(capacidad=4))
+        sala = async_to_sync(parejas)()
+        self.assertEqual(emparejador._salas[sala.id].elo, 1700)
+
+    def test_creacion_cancelada(self):
+        """Si se cancela quien crea la partida, los que esperan en su sala no se quedan colgados"""
+        emparejador = Emparejador()
+        config = ConfigPartida(capacidad=4, es_personalizada=True)
+        crear_partida = emparejamiento.crear_partida
+
+        async def sin_terminar(datos):
+            await asyncio.Event().wait()
+
+        async def inner():
+            creador = asyncio.ensure_future(emparejador.asignar(self.usuarios[0], config))
+            while not emparejador.metricas()['salas_abiertas']:
+                await asyncio.sleep(0.01)
+            otro = asyncio.ensure_future(emparejador.asignar(self.usuarios[1], config))
+            await asyncio.sleep(0)
+            creador.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await creador
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(otro, timeout=1)
+            self.assertEqual(emparejador.metricas()['salas_abiertas'], 0)
+
+        emparejamiento.crear_partida = sin_terminar
+        try:
+            async_to_sync(inner)()
+        finally:
+            emparejamiento.crear_partida = crear_partida
+
+    def test_salas_de_otro_proceso(self):
+        """
+        Un proceso adopta las salas en espera que ha abierto otro, reconstruye
+        las colas al arrancar y la base de datos no deja pasarse de capacidad
+        """
+        uno, otro = Emparejador(), Emparejador()
+        u = self.usuarios
+        config = ConfigPartida(capacidad=2)
+
+        async def inner():
+            # Cada uno entra por un proceso distinto y acaban en la misma sala
+            partida = await uno.asignar(u[0], config)
+            await agregar_jugador(partida, u[0])
+            self.assertEqual((await otro.asignar(u[1], config)).id, partida.id)
+            self.assertEqual(otro.metricas()['salas_adoptadas'], 1)
+            self.assertTrue((await agregar_jugador(partida, u[1]))[1])
+
+            # El primer proceso no sabe que se ha llenado, pero no cabe nadie más
+            self.assertTrue(uno.ocupar(partida.id, u[2].id))
+            self.assertEqual(await agregar_jugador(partida, u[2]), (None, False))
+
+            # Al arrancar se reconstruye la cola con las salas que esperan
+            espera = await uno.asignar(u[3], ConfigPartida(capacidad=4, es_personalizada=True))
+            await agregar_jugador(espera, u[3])
+            nuevo = Emparejador()
+            await nuevo.sincronizar()
+            self.assertEqual(nuevo.metricas()['salas_abiertas'], 1)
+            self.assertEqual((await nuevo.asignar(
+                u[4], ConfigPartida(capacidad=4, es_personalizada=True))).id, espera.id)
+
+            # Las que ya no están en espera salen de la cola
+            await Partida.objects.filter(id=espera.id).aupdate(estado='jugando')
+            await nuevo.sincronizar()
+            self.assertEqual(nuevo.metricas()['salas_abiertas'], 0)
+
+        async_to_sync(inner)()
+
+    def test_reunion_de_salas_en_espera(self):
+        """Dos jugadores que esperan en salas distintas se reúnen cuando la ventana los cubre"""
+        u0, u1 = self.usuarios[:2]
+        u0.elo, u1.elo = 1000, 1600
+        u0.save()
+        u1.save()
+        reloj = emparejador.reloj
+
+        async def recibir_hasta(comm, tipo):
+            while True:
+                msg = json.loads(await comm.receive_from(timeout=5))
+                if msg['type'] == tipo:
+                    return msg['data']
+
+        async def inner():
+            comms = []
+            for u in (u0, u1):
+                comm = WebsocketCommunicator(application, f'/ws/partida/?token={generar_token(u)}&capacidad=2')
+                conectado, _ = await comm.connect()
+                self.assertTrue(conectado)
+                comms.append(comm)
+            salas = [(await recibir_hasta(c, MessageTypes.PLAYER_JOINED))['partida_id'] for c in comms]
+            self.assertNotEqual(salas[0], salas[1])
+
+            # 600 puntos no caben en la ventana hasta que pasa el tiempo
+            self.assertEqual(emparejador.reunir(), [])
+            emparejador.reloj = lambda: reloj() + 30
+            await emparejador._reunir_y_avisar()
+
+            inicio = [await recibir_hasta(c, MessageTypes.START_GAME) for c in comms]
+            self.assertEqual({j['id'] for j in inicio[0]['jugadores']}, {u0.id, u1.id})
+            self.assertEqual(emparejador.metricas()['profundidad'], {})
+            for comm in comms:
+                await comm.disconnect()
+            return salas
+
+        try:
+            salas = async_to_sync(inner)()
+        finally:
+            emparejador.reloj = reloj
+        self.assertEqual(Partida.objects.filter(id__in=salas).count(), 1)
+
+    def test_carga_a_rafagas(self):
+        """Jugadores que se conectan todos a la vez empiezan y terminan sus partidas"""
+        salida = StringIO()
+        call_command('carga_partidas', jugadores=8, capacidad=4, intervalo=0, timeout=10, stdout=salida)
+        self.assertIn('Partida terminada: 8 | caídas: 0 | sin partida: 0', salida.getvalue())
+        self.assertEqual(Partida.objects.filter(estado='terminada').count(), 2)
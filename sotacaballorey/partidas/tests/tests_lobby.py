@@ -0,0 +1,107 @@
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from sotacaballorey.asgi import application
+from utils.jwt_auth import generar_token
+from asgiref.sync import async_to_sync
+from usuarios.models import Usuario
+import json
+
+class LobbyConsumerTest(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.usuarios = [
+            Usuario.objects.create(nombre=f'u{i}', correo=f'u{i}@gmail.com', contrasegna='123')
+            for i in range(3)
+        ]
+        self.tokens = [generar_token(u) for u in self.usuarios]
+
+    async def conectar(self, ruta, token):
+        comm = WebsocketCommunicator(application, f'{ruta}&token={token}')
+        conectado, _ = await comm.connect()
+        self.assertTrue(conectado)
+        return comm
+
+    async def recibir(self, comm) -> dict:
+        return json.loads(await comm.receive_from(timeout=5))
+
+    def test_cambios_de_salas(self):
+        """El lobby recibe la lista inicial y después cada cambio de las salas"""
+        u0, u1, u2 = self.usuarios
+
+        async def inner():
+            lobby = await self.conectar('/ws/lobby/?capacidad=2', self.tokens[2])
+            lobby_4 = await self.conectar('/ws/lobby/?capacidad=4', self.tokens[2])
+            for comm in (lobby, lobby_4):
+                msg = await self.recibir(comm)
+                self.assertEqual(msg, {'type': 'lobby_snapshot', 'data': {'salas': []}})
+
+            # Se crea una sala y se anuncia en su capacidad
+            j0 = await self.conectar('/ws/partida/?capacidad=2', self.tokens[0])
+            msg = await self.recibir(lobby)
+            self.assertEqual(msg['type'], 'room_created')
+            self.assertEqual(msg['data']['sala']['jugadores'], ['u0'])
+            self.assertEqual(msg['data']['usuario'], {'id': u0.id, 'nombre': 'u0'})
+            sala_id = msg['data']['sala_id']
+
+            # Quien se conecta después la recibe en la lista inicial
+            tarde = await self.conectar('/ws/lobby/?capacidad=2', self.tokens[1])
+            msg = await self.recibir(tarde)
+            self.assertEqual([s['id'] for s in msg['data']['salas']], [sala_id])
+
+            # Entra otro jugador: la sala se llena y empieza
+            j1 = await self.conectar(f'/ws/partida/?capacidad=2&id_partida={sala_id}', self.tokens[1])
+            for comm in (lobby, tarde):
+                msg = await self.recibir(comm)
+                self.assertEqual(msg['type'], 'player_joined')
+                self.assertEqual(msg['data']['sala']['num_jugadores'], 2)
+                msg = await self.recibir(comm)
+                self.assertEqual(msg['type'], 'room_started')
+                self.assertEqual(msg['data'], {'sala_id': sala_id, 'sala': None})
+
+            # Las salas de otra capacidad no llegan
+            self.assertTrue(await lobby_4.receive_nothing())
+
+            for comm in (j0, j1, lobby, lobby_4, tarde):
+                await comm.disconnect()
+
+        async_to_sync(inner)()
+
+    def test_salas_de_amigos(self):
+        """Con amigos=true llegan las salas de los amigos, aunque sean solo de amigos"""
+        u0, u1, u2 = self.usuarios
+        u2.amigos.add(u0)
+
+        async def inner():
+            amigos = await self.conectar('/ws/lobby/?amigos=true', self.tokens[2])
+            todas = await self.conectar('/ws/lobby/?capacidad=4', self.tokens[1])
+            await self.recibir(amigos)
+            await self.recibir(todas)
+
+            j0 = await self.conectar('/ws/partida/?capacidad=4&es_personalizada=true&solo_amigos=true',
+                                     self.tokens[0])
+            msg = await self.recibir(amigos)
+            self.assertEqual(msg['type'], 'room_created')
+            self.assertTrue(msg['data']['sala']['personalizacion']['solo_amigos'])
+
+            # Al salir el único jugador la sala desaparece
+            await j0.disconnect()
+            msg = await self.recibir(amigos)
+            self.assertEqual(msg['type'], 'player_left')
+            self.assertIsNone(msg['data']['sala'])
+
+            # Una sala solo de amigos no se anuncia a todos
+            self.assertTrue(await todas.receive_nothing())
+            await amigos.disconnect()
+            await todas.disconnect()
+
+        async_to_sync(inner)()
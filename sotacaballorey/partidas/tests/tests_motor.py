@@ -0,0 +1,127 @@
+from partidas.game.motor import (
+    EstadoJuego, JugadaInvalida, nueva_partida, aplicar, jugadas_posibles,
+    JUGAR, CANTAR, CAMBIAR_SIETE, FIN, REPARTO, TURNO, CANTO, CAMBIO_SIETE
+)
+from partidas.game.cartas import carta_a_int, cartas_de, mascara, SIETE
+from partidas.game.sala import SalaPartida, juego_desde_partida
+from partidas.models import Partida, JugadorPartida
+from django.test import SimpleTestCase
+import random
+
+def c(palo, valor):
+    return carta_a_int({'palo': palo, 'valor': valor})
+
+def jugar_hasta_el_final(estado, rng):
+    """Juega cartas válidas aleatorias hasta que acaba la partida"""
+    eventos = []
+    while not estado.terminada:
+        validas = cartas_de(jugadas_posibles(estado, estado.turno))
+        _, nuevos = aplicar(estado, (JUGAR, estado.turno, rng.choice(validas)))
+        eventos.extend(nuevos)
+    return eventos
+
+class MotorTests(SimpleTestCase):
+
+    def test_partida_completa(self):
+        """
+        Partidas 1v1 y 2v2 jugadas hasta el final: las cartas se conservan y
+        la partida acaba con un único evento FIN
+        """
+        for equipos in ([1, 2], [1, 2, 1, 2]):
+            for semilla in range(20):
+                estado = nueva_partida(equipos, permitir_revueltas=False, semilla=semilla)
+                total = sum(m.bit_count() for m in estado.manos) + len(estado.baraja)
+                self.assertEqual(total, 40)
+
+                eventos = jugar_hasta_el_final(estado, random.Random(semilla))
+                fines = [e for e in eventos if e[0] == FIN]
+                self.assertEqual(len(fines), 1)
+                self.assertEqual(sum(estado.puntos), 130)
+                self.assertFalse(any(estado.manos))
+
+                with self.assertRaises(JugadaInvalida):
+                    aplicar(estado, (JUGAR, 0, 0))
+
+    def test_misma_semilla_misma_partida(self):
+        """El reparto depende solo de la semilla"""
+        a = nueva_partida([1, 2], semilla=7)
+        b = nueva_partida([1, 2], semilla=7)
+        self.assertEqual(a.manos, b.manos)
+        self.assertEqual(a.baraja, b.baraja)
+
+        copia = a.copia()
+        jugar_hasta_el_final(a, random.Random(1))
+        self.assertEqual(copia.manos, b.manos)
+
+    def test_revueltas(self):
+        """Si nadie pasa de 100 se reparte de nuevo y se juegan revueltas"""
+        estado = nueva_partida([1, 2], semilla=3)
+        eventos = []
+        rng = random.Random(3)
+        while not any(e[0] == REPARTO for e in eventos):
+            validas = cartas_de(jugadas_posibles(estado, estado.turno))
+            eventos.extend(aplicar(estado, (JUGAR, estado.turno, rng.choice(validas)))[1])
+            if estado.terminada:
+                self.skipTest('La semilla acaba la partida sin revueltas')
+
+        self.assertTrue(estado.es_revueltas)
+        self.assertEqual(eventos[-1][0], TURNO)
+        self.assertEqual(sum(m.bit_count() for m in estado.manos), 12)
+        jugar_hasta_el_final(estado, rng)
+        self.assertGreater(max(estado.puntos), 100)
+
+    def test_errores(self):
+        """Las jugadas no permitidas se rechazan sin tocar el estado"""
+        estado = nueva_partida([1, 2], semilla=1)
+        otra = cartas_de(estado.manos[1])[0]
+        with self.assertRaisesMessage(JugadaInvalida, 'No es tu turno'):
+            aplicar(estado, (JUGAR, 1, otra))
+        with self.assertRaisesMessage(JugadaInvalida, 'No tiene esa carta en tu mano'):
+            aplicar(estado, (JUGAR, 0, otra))
+        with self.assertRaisesMessage(JugadaInvalida, 'No puedes cantar ahora'):
+            aplicar(estado, (CANTAR, 0))
+
+        propia = cartas_de(estado.manos[0])[0]
+        aplicar(estado, (JUGAR, 0, propia))
+        with self.assertRaisesMessage(JugadaInvalida, 'Ya has jugado en esta baza'):
+            aplicar(estado, (JUGAR, 0, cartas_de(estado.manos[0])[0]))
+
+    def test_canto_y_cambio_siete(self):
+        """Tras ganar una baza se puede cantar y cambiar el 7 de triunfo"""
+        estado = EstadoJuego([1, 2])
+        estado.triunfo = 0
+        estado.carta_triunfo = c('Oros', 1)
+        estado.baraja = [c('Oros', 1), c('Bastos', 2)]
+        estado.manos = [
+            mascara([c('Oros', 12), c('Oros', 10), c('Copas', 12), c('Copas', 10), SIETE[0]]),
+            mascara([c('Espadas', 4)])
+        ]
+        estado.ultimo_ganador = 0
+
+        _, eventos = aplicar(estado, (CANTAR, 0))
+        self.assertEqual(eventos, [(CANTO, 0, [(40, 0), (20, 1)], 60)])
+        self.assertEqual(estado.puntos, [60, 0])
+        with self.assertRaisesMessage(JugadaInvalida, 'No hay cantos válidos disponibles'):
+            aplicar(estado, (CANTAR, 0))
+
+        _, eventos = aplicar(estado, (CAMBIAR_SIETE, 0))
+        self.assertEqual(eventos, [(CAMBIO_SIETE, 0, c('Oros', 1))])
+        self.assertEqual(estado.baraja[0], SIETE[0])
+        self.assertTrue(estado.manos[0] >> c('Oros', 1) & 1)
+
+    def test_exportar_e_importar(self):
+        """El estado del motor sobrevive al paso por estado_json y cartas_json"""
+        partida = Partida(id=1, capacidad=2, estado='jugando')
+        jugadores = [
+            JugadorPartida(id=1, partida=partida, equipo=1),
+            JugadorPartida(id=2, partida=partida, equipo=2)
+        ]
+        sala = SalaPartida(partida, jugadores)
+        juego = sala.repartir(semilla=5)
+        aplicar(juego, (JUGAR, 0, cartas_de(juego.manos[0])[0]))
+        sala.exportar()
+
+        importado = juego_desde_partida(partida, jugadores)
+        for campo in EstadoJuego.__slots__:
+            self.assertEqual(getattr(importado, campo), getattr(juego, campo), campo)
+        self.assertEqual(partida.estado_json['turno_actual_id'], 2)
@@ -0,0 +1,110 @@
+from partidas.game.propiedad import propiedad, adquirir_concesiones, renovar_concesiones
+from partidas.models import Partida, JugadorPartida, PropiedadPartida
+from partidas.game.sala import cargar_sala, obtener_sala
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+from django.core.management import call_command
+from channels.layers import get_channel_layer
+from sotacaballorey.asgi import application
+from asgiref.sync import async_to_sync, sync_to_async
+from utils.jwt_auth import generar_token
+from django.utils import timezone
+from usuarios.models import Usuario
+from datetime import timedelta
+import json
+
+@override_settings(RECUPERAR_PARTIDAS=False)
+class PropiedadTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.user1 = Usuario.objects.create(
+            nombre='Usuario 1', correo='user1@gmail.com', contrasegna='123')
+        self.user2 = Usuario.objects.create(
+            nombre='Usuario 2', correo='user2@gmail.com', contrasegna='123')
+        self.partida = Partida.objects.create(capacidad=2, estado='jugando')
+        for usuario, equipo in ((self.user1, 1), (self.user2, 2)):
+            JugadorPartida.objects.create(partida=self.partida, usuario=usuario, equipo=equipo)
+
+        async def repartir():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=3)
+            await sala.cerrar()
+        async_to_sync(repartir)()
+
+    def test_concesiones(self):
+        """Una partida solo tiene un propietario hasta que vence su concesión"""
+        ids = [self.partida.id]
+        adquirir = async_to_sync(adquirir_concesiones)
+        renovar = async_to_sync(renovar_concesiones)
+
+        self.assertEqual(adquirir(ids, 'A', 'canal_a'), {self.partida.id: ('A', 'canal_a')})
+        self.assertEqual(adquirir(ids, 'B', 'canal_b'), {self.partida.id: ('A', 'canal_a')})
+        self.assertEqual(renovar(ids, 'A'), {self.partida.id})
+
+        # A no renueva a tiempo: B se queda con la partida y A la pierde
+        PropiedadPartida.objects.update(vence=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(adquirir(ids, 'B', 'canal_b'), {self.partida.id: ('B', 'canal_b')})
+        self.assertEqual(renovar(ids, 'A'), set())
+
+    def test_reenvio_y_relevo(self):
+        """
+        Mientras otro proceso lleva la partida se le reenvía todo; cuando su
+        concesión vence, este proceso se queda con la partida
+        """
+        PropiedadPartida.objects.create(partida=self.partida, propietario='otro',
+            canal='partidas.otro!1', vence=timezone.now() + timedelta(seconds=60))
+        debug = json.dumps({'accion': 'debug_state'})
+
+        async def inner():
+            layer = get_channel_layer()
+            token = generar_token(self.user1)
+            comm = WebsocketCommunicator(application, f'/ws/partida/?token={token}&id_partida={self.partida.id}')
+            conectado, _ = await comm.connect()
+            self.assertTrue(conectado)
+            msg = json.loads(await comm.receive_from(timeout=5))
+            self.assertEqual(msg['type'], 'player_joined')
+
+            # La conexión y las acciones van al propietario
+            reenviado = await layer.receive('partidas.otro!1')
+            self.assertEqual(reenviado['type'], 'partida.conexion')
+            self.assertEqual(reenviado['usuario_id'], self.user1.id)
+            await comm.send_to(text_data=debug)
+            reenviado = await layer.receive('partidas.otro!1')
+            self.assertEqual(reenviado['type'], 'partida.accion')
+            self.assertEqual(reenviado['texto'], debug)
+            self.assertIsNone(obtener_sala(self.partida.id))
+            self.assertTrue(await comm.receive_nothing())
+
+            # Vence la concesión: la siguiente acción carga aquí la sala
+            await sync_to_async(PropiedadPartida.objects.update)(
+                vence=timezone.now() - timedelta(seconds=1))
+            await comm.send_to(text_data=debug)
+            msg = json.loads(await comm.receive_from(timeout=5))
+            self.assertEqual(msg['type'], 'debug_state')
+            self.assertIsNotNone(obtener_sala(self.partida.id))
+            self.assertIn(self.partida.id, propiedad.propias)
+
+            # Lo que reenvía otro proceso se atiende aquí y la respuesta va a su conexión
+            canal = await layer.new_channel()
+            await layer.send(propiedad.canal, {
+                'type': 'partida.accion', 'partida_id': self.partida.id,
+                'usuario_id': self.user2.id, 'canal': canal, 'texto': debug
+            })
+            respuesta = await layer.receive(canal)
+            self.assertEqual(respuesta['type'], 'private_message')
+            self.assertEqual(json.loads(respuesta['texto'])['type'], 'debug_state')
+
+            await comm.disconnect()
+            await obtener_sala(self.partida.id).cerrar()
+
+        async_to_sync(inner)()
+        self.assertFalse(PropiedadPartida.objects.exists())
@@ -0,0 +1,112 @@
+from partidas.management.commands.medir_serializacion import mensajes_de_prueba
+from partidas.game.messages import MessageTypes
+from partidas.models import Partida
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from sotacaballorey.asgi import application
+from utils.jwt_auth import generar_token
+from partidas.game.cartas import int_a_carta, carta_a_int
+from asgiref.sync import async_to_sync
+from usuarios.models import Usuario
+from partidas.game import protocolo
+import json
+
+class ProtocoloTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.partida = Partida.objects.create(capacidad=2)
+        self.usuarios = [Usuario.objects.create(
+            nombre=f'Usuario {i}', correo=f'user{i}@gmail.com', contrasegna='123') for i in (1, 2)]
+
+    def test_esquema(self):
+        """Todos los tipos de mensaje tienen código y la conversión no pierde nada"""
+        tipos = {v for k, v in vars(MessageTypes).items() if not k.startswith('_')}
+        self.assertEqual(set(protocolo.TIPOS), tipos)
+
+        for mensaje in mensajes_de_prueba(4).values():
+            binario = protocolo.codificar_compacto(mensaje['type'], mensaje['data'])
+            self.assertLess(len(binario), len(json.dumps(mensaje)) / 2)
+            self.assertEqual(protocolo.decodificar_compacto(binario), mensaje)
+
+            # Un mismo mensaje de grupo se convierte una vez para todas las conexiones
+            texto = json.dumps(mensaje)
+            self.assertEqual(protocolo.compacto_desde_texto(texto), binario)
+            aciertos = protocolo.compacto_desde_texto.cache_info().hits
+            self.assertEqual(protocolo.compacto_desde_texto(texto), binario)
+            self.assertEqual(protocolo.compacto_desde_texto.cache_info().hits, aciertos + 1)
+
+        accion = {'accion': 'jugar_carta', 'carta': int_a_carta(12)}
+        self.assertEqual(protocolo.msgpack.unpackb(protocolo.accion_a_compacto(accion)), {'a': 'jugar_carta', 'c': 12})
+        self.assertEqual(protocolo.accion_desde_compacto(protocolo.accion_a_compacto(accion)), accion)
+
+    def test_partida_con_protocolo_compacto(self):
+        """Un cliente compacto y otro JSON juegan la misma partida"""
+        async def recibir_hasta(comm, tipo, compacto):
+            while True:
+                if compacto:
+                    salida = await comm.receive_output(timeout=5)
+                    self.assertIsNone(salida.get('text'))
+                    msg = protocolo.msgpack.unpackb(salida['bytes'])
+                    if msg[0] == protocolo.CODIGO_TIPO[tipo]:
+                        return msg[1]
+                else:
+                    msg = json.loads(await comm.receive_from(timeout=5))
+                    if msg['type'] == tipo:
+                        return msg['data']
+
+        async def inner():
+            compacto, normal = self.usuarios
+            url = f'/ws/partida/?token={generar_token(compacto)}&id_partida={self.partida.id}'
+            comm_c = WebsocketCommunicator(application, url, subprotocols=[protocolo.SUBPROTOCOLO])
+            conectado, subprotocolo = await comm_c.connect()
+            self.assertTrue(conectado)
+            self.assertEqual(subprotocolo, protocolo.SUBPROTOCOLO)
+
+            url = f'/ws/partida/?token={generar_token(normal)}&id_partida={self.partida.id}'
+            comm_n = WebsocketCommunicator(application, url)
+            conectado, subprotocolo = await comm_n.connect()
+            self.assertTrue(conectado)
+            self.assertIsNone(subprotocolo)
+
+            inicio_c = await recibir_hasta(comm_c, MessageTypes.START_GAME, True)
+            inicio_n = await recibir_hasta(comm_n, MessageTypes.START_GAME, False)
+            self.assertEqual(len(inicio_c['mc']), 6)
+            self.assertTrue(all(isinstance(c, int) for c in inicio_c['mc']))
+            self.assertEqual(int_a_carta(inicio_c['tr']), inicio_n['carta_triunfo'])
+
+            turno = (await recibir_hasta(comm_n, MessageTypes.TURN_UPDATE, False))['jugador']['id']
+            await recibir_hasta(comm_c, MessageTypes.TURN_UPDATE, True)
+
+            if turno == compacto.id:
+                carta = inicio_c['mc'][0]
+                await comm_c.send_to(bytes_data=protocolo.accion_a_compacto(
+                    {'accion': 'jugar_carta', 'carta': int_a_carta(carta)}))
+            else:
+                carta = inicio_n['mis_cartas'][0]
+                await comm_n.send_to(text_data=json.dumps({'accion': 'jugar_carta', 'carta': carta}))
+                carta = carta_a_int(carta)
+
+            jugada_c = await recibir_hasta(comm_c, MessageTypes.CARD_PLAYER, True)
+            jugada_n = await recibir_hasta(comm_n, MessageTypes.CARD_PLAYER, False)
+            self.assertEqual(jugada_c, {'j': {'n': jugada_n['jugador']['nombre'], 'i': turno}, 'au': False, 'c': carta})
+            self.assertEqual(int_a_carta(carta), jugada_n['carta'])
+
+            # Los errores que se envían directamente también van en compacto
+            await comm_c.send_to(bytes_data=protocolo.accion_a_compacto({'accion': 'jugar_carta', 'carta': None}))
+            error = await recibir_hasta(comm_c, MessageTypes.ERROR, True)
+            self.assertIn('m', error)
+
+            await comm_c.disconnect()
+            await comm_n.disconnect()
+
+        async_to_sync(inner)()
@@ -0,0 +1,158 @@
+from partidas.game.sala import cargar_sala, obtener_sala, MENSAJES_RECIENTES
+from partidas.game.messages import MessageTypes, evento
+from partidas.models import Partida, JugadorPartida
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from sotacaballorey.asgi import application
+from utils.jwt_auth import generar_token
+from asgiref.sync import async_to_sync
+from usuarios.models import Usuario
+import json
+
+class ReconexionTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.partida = Partida.objects.create(capacidad=2)
+        self.usuarios = [Usuario.objects.create(
+            nombre=f'Usuario {i}', correo=f'user{i}@gmail.com', contrasegna='123') for i in (1, 2)]
+
+    def test_mensajes_guardados(self):
+        """La sala devuelve los mensajes posteriores de cada jugador o None si ya no los tiene"""
+        partida = Partida.objects.create(capacidad=2, estado='jugando')
+        j1 = JugadorPartida.objects.create(partida=partida, usuario=self.usuarios[0], equipo=1)
+        j2 = JugadorPartida.objects.create(partida=partida, usuario=self.usuarios[1], equipo=2)
+        sala = async_to_sync(cargar_sala)(partida.id)
+
+        for i in range(3):
+            sala.guardar_mensaje(sala.numerar(), {'texto': f'grupo {i}'})
+        sala.guardar_mensaje(sala.numerar(), {'texto': 'privado'}, j1.id)
+
+        self.assertEqual(sala.mensajes_desde(1, j1.id),
+            [{'texto': 'grupo 1'}, {'texto': 'grupo 2'}, {'texto': 'privado'}])
+        self.assertEqual(sala.mensajes_desde(1, j2.id), [{'texto': 'grupo 1'}, {'texto': 'grupo 2'}])
+        self.assertEqual(sala.mensajes_desde(4, j2.id), [])
+        self.assertIsNone(sala.mensajes_desde(5, j2.id))
+
+        for i in range(MENSAJES_RECIENTES):
+            sala.guardar_mensaje(sala.numerar(), {'texto': f'más {i}'})
+        self.assertIsNone(sala.mensajes_desde(1, j1.id))
+        self.assertEqual(len(sala.mensajes_desde(sala.secuencia - 10, j1.id)), 10)
+        async_to_sync(sala.cerrar)()
+
+    def test_reconexion_con_muchos_perdidos(self):
+        """
+        Los mensajes perdidos se reenvían aunque sean más de los que caben en
+        el canal de la conexión
+        """
+        async def conectar(usuario, extra=''):
+            url = f'/ws/partida/?token={generar_token(usuario)}&id_partida={self.partida.id}{extra}'
+            comm = WebsocketCommunicator(application, url)
+            conectado, _ = await comm.connect()
+            self.assertTrue(conectado)
+            return comm
+
+        async def recibir_hasta(comm, tipo):
+            while True:
+                msg = json.loads(await comm.receive_from(timeout=5))
+                if msg['type'] == tipo:
+                    return msg
+
+        async def inner():
+            presente, ausente = self.usuarios
+            comm_p = await conectar(presente)
+            comm_a = await conectar(ausente)
+            inicio = await recibir_hasta(comm_a, MessageTypes.START_GAME)
+            await recibir_hasta(comm_a, MessageTypes.TURN_UPDATE)
+            await comm_a.disconnect()
+
+            sala = obtener_sala(self.partida.id)
+            ultimo = sala.secuencia
+            for i in range(150):
+                secuencia = sala.numerar()
+                sala.guardar_mensaje(secuencia, evento(
+                    'broadcast_message', MessageTypes.PHASE_UPDATE, {'message': str(i)}, secuencia))
+
+            comm_a = await conectar(ausente, f"&seq={ultimo}&epoca={inicio['data']['epoca']}")
+            recibidos = []
+            while len(recibidos) < 150:
+                msg = json.loads(await comm_a.receive_from(timeout=5))
+                if msg['type'] == MessageTypes.PHASE_UPDATE:
+                    recibidos.append(msg['data']['message'])
+            self.assertEqual(recibidos, [str(i) for i in range(150)])
+
+            await comm_a.disconnect()
+            await comm_p.disconnect()
+
+        async_to_sync(inner)()
+
+    def test_reconexion_solo_con_lo_perdido(self):
+        """
+        Quien se reconecta con el último número recibido solo recibe los
+        mensajes que se ha perdido; con otra época, el estado completo
+        """
+        async def recibir_todo(comm):
+            mensajes = []
+            while not await comm.receive_nothing(timeout=0.5):
+                mensajes.append(json.loads(await comm.receive_from()))
+            return mensajes
+
+        async def conectar(usuario, extra=''):
+            url = f'/ws/partida/?token={generar_token(usuario)}&id_partida={self.partida.id}{extra}'
+            comm = WebsocketCommunicator(application, url)
+            conectado, _ = await comm.connect()
+            self.assertTrue(conectado)
+            return comm
+
+        async def inner():
+            comms = {u.id: await conectar(u) for u in self.usuarios}
+            recibidos = {u: await recibir_todo(c) for u, c in comms.items()}
+
+            inicio = {u: next(m for m in ms if m['type'] == MessageTypes.START_GAME)
+                      for u, ms in recibidos.items()}
+            # El estado inicial tiene el mismo número para todos y las manos son privadas
+            self.assertEqual(len({m['seq'] for m in inicio.values()}), 1)
+            turno = [m for m in recibidos[self.usuarios[0].id] if m['type'] == MessageTypes.TURN_UPDATE][-1]
+            turno = turno['data']['jugador']['id']
+            otro = next(u for u in comms if u != turno)
+            epoca = inicio[otro]['data']['epoca']
+            ultimo = max(m['seq'] for m in recibidos[otro] if 'seq' in m)
+
+            # El que no tiene el turno se desconecta y el otro juega
+            await comms[otro].disconnect()
+            await comms[turno].send_to(text_data=json.dumps(
+                {'accion': 'jugar_carta', 'carta': inicio[turno]['data']['mis_cartas'][0]}))
+            jugados = await recibir_todo(comms[turno])
+            self.assertIn(MessageTypes.CARD_PLAYER, [m['type'] for m in jugados])
+
+            usuario = next(u for u in self.usuarios if u.id == otro)
+            comms[otro] = await conectar(usuario, f'&seq={ultimo}&epoca={epoca}')
+            perdidos = await recibir_todo(comms[otro])
+            tipos = [m['type'] for m in perdidos]
+            self.assertNotIn(MessageTypes.START_GAME, tipos)
+            self.assertIn(MessageTypes.CARD_PLAYER, tipos)
+            self.assertIn(MessageTypes.TURN_UPDATE, tipos)
+            self.assertTrue(all(m['seq'] > ultimo for m in perdidos))
+            vistos = {m['seq'] for m in jugados if 'seq' in m}
+            self.assertTrue(vistos <= {m['seq'] for m in perdidos})
+
+            # Con una época que no es la de la sala se envía el estado completo
+            await comms[otro].disconnect()
+            comms[otro] = await conectar(usuario, f'&seq={ultimo}&epoca=otra')
+            tipos = [m['type'] for m in await recibir_todo(comms[otro])]
+            self.assertIn(MessageTypes.START_GAME, tipos)
+            self.assertNotIn(MessageTypes.CARD_PLAYER, tipos)
+
+            for comm in comms.values():
+                await comm.disconnect()
+
+        async_to_sync(inner)()
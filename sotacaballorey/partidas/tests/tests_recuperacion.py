@@ -0,0 +1,120 @@
+from partidas.game.recuperacion import recuperar_partidas
+from partidas.game import recuperacion
+from partidas.game.sala import cargar_sala, obtener_sala
+from partidas.models import Partida, JugadorPartida, PropiedadPartida
+from partidas.game.temporizador import temporizadores
+from partidas.game.propiedad import propiedad
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+from django.core.management import call_command
+from sotacaballorey.asgi import application
+from utils.jwt_auth import generar_token
+from asgiref.sync import async_to_sync, sync_to_async
+from usuarios.models import Usuario
+import asyncio
+import json
+
+@override_settings(RECUPERAR_PARTIDAS=False)
+class RecuperacionTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.user1 = Usuario.objects.create(
+            nombre='Usuario 1', correo='user1@gmail.com', contrasegna='123')
+        self.user2 = Usuario.objects.create(
+            nombre='Usuario 2', correo='user2@gmail.com', contrasegna='123')
+        self.partida = Partida.objects.create(capacidad=2, estado='jugando', tiempo_turno=1)
+        for usuario, equipo in ((self.user1, 1), (self.user2, 2)):
+            JugadorPartida.objects.create(partida=self.partida, usuario=usuario,
+                                          equipo=equipo, channel_name=f'antiguo_{equipo}')
+
+        # Partida repartida y volcada; después el proceso "se reinicia"
+        async def repartir():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=5)
+            await sala.cerrar()
+        async_to_sync(repartir)()
+
+        # Otras partidas que no hay que tocar
+        Partida.objects.create(capacidad=2, estado='jugando')
+        Partida.objects.create(capacidad=2, estado='pausada')
+
+    def test_recuperar_y_reconectar(self):
+        """
+        Las partidas en curso vuelven a tener sala y temporizador, y quien
+        se reconecta recibe el estado y el turno
+        """
+        async def inner():
+            r = await recuperar_partidas()
+            self.assertEqual(r['partidas'], 1)
+            sala = obtener_sala(self.partida.id)
+            self.assertTrue(sala.recuperada)
+            self.assertIsNotNone(temporizadores.plazo(self.partida.id))
+            self.assertTrue(await sync_to_async(PropiedadPartida.objects.filter(
+                partida=self.partida, propietario=propiedad.propietario).exists)())
+
+            # Una segunda pasada no vuelve a recuperarla
+            self.assertEqual((await recuperar_partidas())['partidas'], 0)
+            turno = sala.jugador_en(sala.juego.turno).usuario_id
+
+            token = generar_token(self.user1)
+            comm = WebsocketCommunicator(application, f'/ws/partida/?token={token}&id_partida={self.partida.id}')
+            conectado, _ = await comm.connect()
+            self.assertTrue(conectado)
+
+            tipos = []
+            while 'turn_update' not in tipos:
+                msg = json.loads(await comm.receive_from(timeout=5))
+                tipos.append(msg['type'])
+            self.assertEqual(tipos, ['player_joined', 'start_game', 'turn_update'])
+            self.assertEqual(msg['data']['jugador']['id'], turno)
+
+            # El temporizador recuperado juega por quien tiene el turno
+            while msg['type'] != 'card_played':
+                msg = json.loads(await comm.receive_from(timeout=5))
+            self.assertTrue(msg['data']['automatica'])
+            self.assertEqual(msg['data']['jugador']['id'], turno)
+            await comm.disconnect()
+
+        async_to_sync(inner)()
+
+    def test_recuperar_al_arrancar_sin_conexiones(self):
+        """
+        Al arrancar el proceso la partida en curso se recupera y su temporizador
+        juega sin que llegue ninguna conexión
+        """
+        async def inner():
+            tarea = recuperacion.arrancar()
+            try:
+                for _ in range(100):
+                    if obtener_sala(self.partida.id):
+                        break
+                    await asyncio.sleep(0.05)
+                sala = obtener_sala(self.partida.id)
+                self.assertTrue(sala and sala.recuperada)
+                self.assertIsNotNone(temporizadores.plazo(self.partida.id))
+                # Sin nadie conectado, el temporizador (1 s) juega el turno
+                turno = sala.juego.turno
+                for _ in range(60):
+                    if sala.juego.turno != turno:
+                        break
+                    await asyncio.sleep(0.05)
+                self.assertNotEqual(sala.juego.turno, turno)
+            finally:
+                tarea.cancel()
+
+        vigilancia = recuperacion._vigilancia
+        recuperacion._vigilancia = None
+        try:
+            with self.settings(RECUPERAR_PARTIDAS=True):
+                async_to_sync(inner)()
+        finally:
+            recuperacion._vigilancia = vigilancia
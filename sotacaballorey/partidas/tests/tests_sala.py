@@ -0,0 +1,213 @@
+from partidas.game.messages import send_estado_jugadores, MessageTypes
+from partidas.game.registro import reproducir_partida, AUTOMATICA, PAUSA
+from partidas.game.sala import cargar_sala, obtener_sala
+from partidas.game.simulador import bot_aleatorio
+from partidas.game.motor import aplicar, JUGAR
+from django.test.utils import CaptureQueriesContext
+from partidas.models import Partida, JugadorPartida, EventoPartida
+from django.test import TransactionTestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from usuarios.models import Usuario
+from django.core.management import call_command
+from django.db import connection
+from types import SimpleNamespace
+import random
+import json
+import io
+
+class SalaPartidaTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.user1 = Usuario.objects.create(
+            nombre='Usuario 1', correo='user1@gmail.com', contrasegna='123')
+        self.user2 = Usuario.objects.create(
+            nombre='Usuario 2', correo='user2@gmail.com', contrasegna='123')
+        self.partida = Partida.objects.create(capacidad=2, estado='jugando')
+        self.jugador1 = JugadorPartida.objects.create(
+            partida=self.partida, usuario=self.user1, equipo=1,
+            cartas_json=[{'palo': 'Oros', 'valor': 1}])
+        self.jugador2 = JugadorPartida.objects.create(
+            partida=self.partida, usuario=self.user2, equipo=2)
+
+    def test_cambios_en_memoria_hasta_volcar(self):
+        """
+        Los cambios sobre la sala no llegan a la base de datos hasta que se
+        vuelcan, y al volcar se escriben partida y manos
+        """
+        async def inner():
+            sala = await cargar_sala(self.partida.id)
+            self.assertIs(obtener_sala(self.partida.id), sala)
+            self.assertEqual(sala.siguiente(self.jugador1.id).id, self.jugador2.id)
+            self.assertEqual(sala.jugador_de_usuario(self.user2.id).id, self.jugador2.id)
+
+            jugador = sala.jugador(self.jugador1.id)
+            jugador.cartas_json.pop()
+            sala.marcar_jugador(jugador)
+            sala.partida.puntos_equipo_1 = 11
+            sala.marcar_partida()
+            return sala
+
+        sala = async_to_sync(inner)()
+
+        # Todavía no se ha volcado nada
+        self.assertEqual(Partida.objects.get(id=self.partida.id).puntos_equipo_1, 0)
+        self.assertEqual(len(JugadorPartida.objects.get(id=self.jugador1.id).cartas_json), 1)
+
+        async def volcar():
+            await sala.cerrar()
+            self.assertIsNone(obtener_sala(self.partida.id))
+
+        async_to_sync(volcar)()
+
+        self.assertEqual(Partida.objects.get(id=self.partida.id).puntos_equipo_1, 11)
+        self.assertEqual(JugadorPartida.objects.get(id=self.jugador1.id).cartas_json, [])
+
+    def test_estado_sin_consultas(self):
+        """
+        El estado de la partida se envía a cada jugador sin consultar la base
+        de datos: la parte común es la misma y cada uno recibe su mano
+        """
+        enviados = {}
+
+        class Capa:
+            async def send(self, canal, mensaje):
+                enviados[canal] = json.loads(mensaje['texto'])
+
+        sala = async_to_sync(cargar_sala)(self.partida.id)
+        sala.repartir(semilla=1)
+        for i, jugador in enumerate(sala.jugadores):
+            jugador.channel_name = f'canal_{i}'
+        consumer = SimpleNamespace(sala=sala, partida=sala.partida, channel_layer=Capa())
+
+        with CaptureQueriesContext(connection) as consultas:
+            async_to_sync(send_estado_jugadores)(consumer, MessageTypes.START_GAME)
+        self.assertEqual(len(consultas), 0)
+        async_to_sync(sala.cerrar)()
+
+        m0, m1 = enviados['canal_0'], enviados['canal_1']
+        self.assertEqual(m0['type'], MessageTypes.START_GAME)
+        self.assertEqual(m0['data']['chat_id'], self.partida.chat_id)
+        self.assertEqual(len(m0['data']['mis_cartas']), 6)
+        self.assertNotEqual(m0['data']['mis_cartas'], m1['data']['mis_cartas'])
+        del m0['data']['mis_cartas'], m1['data']['mis_cartas']
+        self.assertEqual(m0, m1)
+
+    def test_volcado_solo_de_lo_cambiado(self):
+        """Un volcado solo escribe las columnas y manos que han cambiado desde el anterior"""
+        async def inner():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=1)
+            await sala.volcar()
+
+            sala.partida.jugadores_pausa.append(str(self.jugador1.id))
+            sala.marcar_partida()
+            await sala.volcar()
+            await sala.cerrar()
+
+        with CaptureQueriesContext(connection) as consultas:
+            async_to_sync(inner)()
+        escrituras = [c['sql'] for c in consultas if c['sql'].startswith(
+            ('UPDATE "partidas_partida"', 'UPDATE "partidas_jugadorpartida"'))]
+        partida, mano1, mano2, pausa, cierre = escrituras[-5:]
+        self.assertIn('"estado_json"', partida)
+        self.assertIn('"cartas_json"', mano1)
+        self.assertIn('"cartas_json"', mano2)
+        self.assertIn('"jugadores_pausa"', pausa)
+        self.assertNotIn('"estado_json"', pausa)
+        self.assertNotIn('"estado_json"', cierre)
+        self.assertNotIn('"jugadores_pausa"', cierre)
+
+        self.partida.refresh_from_db()
+        self.assertEqual(self.partida.jugadores_pausa, [str(self.jugador1.id)])
+        self.assertIn('triunfo', self.partida.estado_json)
+
+    def test_formato_compacto(self):
+        """
+        Con ALMACENAMIENTO_COMPACTO las manos y el mazo se guardan como
+        máscaras y bytes; se leen los dos formatos y se pasa de uno a otro
+        """
+        async def jugar(compacto, jugada=True):
+            with self.settings(ALMACENAMIENTO_COMPACTO=compacto):
+                sala = await cargar_sala(self.partida.id)
+                if not sala.juego:
+                    sala.repartir(semilla=4)
+                if jugada:
+                    asiento = sala.juego.turno
+                    aplicar(sala.juego, bot_aleatorio(sala.juego, asiento, random.Random(1)))
+                juego = sala.juego.copia()
+                await sala.cerrar()
+                return juego
+
+        juego = async_to_sync(jugar)(True)
+        self.partida.refresh_from_db()
+        jugador1 = JugadorPartida.objects.get(id=self.jugador1.id)
+        self.assertNotIn('baraja', self.partida.estado_json)
+        self.assertEqual(list(bytes(self.partida.baraja)), juego.baraja)
+        self.assertEqual(jugador1.mano, juego.manos[0])
+        self.assertEqual(jugador1.cartas_json, [])
+        self.assertEqual(len(jugador1.cartas), juego.manos[0].bit_count())
+        self.assertEqual(len(self.partida.mazo), len(juego.baraja))
+
+        # Con el formato JSON se lee lo compacto y se vuelve a escribir como siempre
+        juego_json = async_to_sync(jugar)(False, jugada=False)
+        self.partida.refresh_from_db()
+        jugador1.refresh_from_db()
+        self.assertIsNone(self.partida.baraja)
+        self.assertEqual(self.partida.estado_json['baraja'], self.partida.mazo)
+        self.assertIsNone(jugador1.mano)
+        self.assertEqual(jugador1.cartas_json, jugador1.cartas)
+        self.assertEqual((juego_json.baraja, juego_json.manos), (juego.baraja, juego.manos))
+
+        # Y la orden de conversión lo deja compacto sin pasar por la sala
+        call_command('convertir_manos', 'compacto', stdout=io.StringIO())
+        self.partida.refresh_from_db()
+        jugador1.refresh_from_db()
+        self.assertEqual(list(bytes(self.partida.baraja)), juego.baraja)
+        self.assertEqual(jugador1.mano, juego.manos[0])
+
+    def test_registro_y_reproduccion(self):
+        """
+        Las acciones se escriben por lotes en el registro y reproducirlo da
+        el mismo estado que la sala en cualquier punto de la partida
+        """
+        rng = random.Random(3)
+        estados = {}
+
+        async def inner():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=7)
+            estados[sala.num_eventos] = sala.juego.copia()
+            while not sala.juego.terminada:
+                asiento = sala.juego.turno
+                accion = bot_aleatorio(sala.juego, asiento, rng)
+                aplicar(sala.juego, accion)
+                if accion[0] == JUGAR and rng.random() < 0.1:
+                    sala.registrar(AUTOMATICA, asiento, accion[2])
+                else:
+                    sala.registrar(*accion)
+                estados[sala.num_eventos] = sala.juego.copia()
+                if sala.num_eventos == 10:
+                    sala.registrar(PAUSA, asiento)
+                    await sala.volcar()
+                    escritos = await sync_to_async(EventoPartida.objects.filter(partida=self.partida).count)()
+                    self.assertEqual(escritos, 11)
+            await sala.cerrar()
+
+        async_to_sync(inner)()
+        self.assertEqual(EventoPartida.objects.filter(partida=self.partida).count(),
+                         max(estados))
+
+        for numero in (1, 5, 10, 30, max(estados)):
+            esperado = estados.get(numero) or estados[numero - 1]
+            juego = reproducir_partida(self.partida.id, hasta=numero)
+            for campo in ('manos', 'baraja', 'baza', 'puntos', 'turno', 'terminada'):
+                self.assertEqual(getattr(juego, campo), getattr(esperado, campo))
@@ -0,0 +1,98 @@
+from partidas.game.messages import send_to_group, send_estado_jugadores, MessageTypes
+from partidas.management.commands.medir_serializacion import mensajes_de_prueba
+from utils.serializacion import SERIALIZADORES, elegir_serializador
+from django.test import SimpleTestCase, TransactionTestCase
+from partidas.game.cartas import int_a_carta, cartas_de
+from partidas.models import Partida, JugadorPartida
+from partidas.game.consumers import PartidaConsumer
+from django.core.management import call_command
+from channels.layers import get_channel_layer
+from partidas.game.sala import cargar_sala
+from asgiref.sync import async_to_sync
+from usuarios.models import Usuario
+from utils import serializacion
+from io import StringIO
+import json
+
+class SerializacionTests(SimpleTestCase):
+
+    def test_serializadores_equivalentes(self):
+        """Todos los serializadores producen el mismo JSON"""
+        for mensaje in mensajes_de_prueba(4).values():
+            for nombre in SERIALIZADORES:
+                serializador = elegir_serializador(nombre)
+                texto = serializador.codificar(mensaje)
+                self.assertEqual(json.loads(texto), mensaje)
+                self.assertEqual(serializador.decodificar(texto), mensaje)
+        with self.assertRaises(ValueError):
+            elegir_serializador('inexistente')
+
+    def test_grupo_codificado_una_vez(self):
+        """Cada miembro del grupo recibe el mismo texto ya codificado"""
+        data = mensajes_de_prueba(4)['card_played']['data']
+
+        async def inner():
+            layer = get_channel_layer()
+            canales = [await layer.new_channel() for _ in range(4)]
+            for canal in canales:
+                await layer.group_add('serializacion', canal)
+            await send_to_group(layer, 'serializacion', MessageTypes.CARD_PLAYER, data)
+            return [await layer.receive(canal) for canal in canales]
+
+        recibidos = async_to_sync(inner)()
+        self.assertEqual({e['type'] for e in recibidos}, {'broadcast_message'})
+        # Solo viaja el JSON: el compacto lo hace cada conexión que lo usa
+        self.assertEqual({tuple(e) for e in recibidos}, {('type', 'texto')})
+        self.assertEqual(len({e['texto'] for e in recibidos}), 1)
+        self.assertEqual(json.loads(recibidos[0]['texto']), {'type': MessageTypes.CARD_PLAYER, 'data': data})
+
+        salida = StringIO()
+        call_command('medir_serializacion', iteraciones=10, stdout=salida)
+        self.assertIn('card_played', salida.getvalue())
+
+class EstadoCodificadoTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def test_estado_con_cada_serializador(self):
+        """El estado que recibe cada jugador con su mano se decodifica igual con todos los serializadores"""
+        partida = Partida.objects.create(capacidad=2, estado='jugando')
+        for i, nombre in enumerate(('Ñandú "uno"', 'null}}')):
+            usuario = Usuario.objects.create(nombre=nombre, correo=f'u{i}@gmail.com', contrasegna='123')
+            JugadorPartida.objects.create(partida=partida, usuario=usuario, equipo=i + 1)
+
+        async def inner():
+            layer = get_channel_layer()
+            sala = await cargar_sala(partida.id)
+            sala.repartir(semilla=3)
+            for jp in sala.jugadores:
+                jp.channel_name = await layer.new_channel()
+            consumer = PartidaConsumer.sin_conexion(sala, layer)
+
+            for nombre in SERIALIZADORES:
+                serializacion.serializador = elegir_serializador(nombre)
+                await send_estado_jugadores(consumer, MessageTypes.START_GAME)
+                for asiento, jp in enumerate(sala.jugadores):
+                    texto = (await layer.receive(jp.channel_name))['texto']
+                    msg = json.loads(texto)
+                    self.assertEqual(serializacion.decodificar(texto), msg)
+                    self.assertEqual((msg['type'], msg['seq']), (MessageTypes.START_GAME, sala.secuencia))
+                    self.assertEqual(msg['data']['mis_cartas'],
+                        [int_a_carta(c) for c in cartas_de(sala.juego.manos[asiento])])
+                    self.assertEqual([j['nombre'] for j in msg['data']['jugadores']],
+                                     ['Ñandú "uno"', 'null}}'])
+                    self.assertEqual(msg['data']['epoca'], sala.epoca)
+            await sala.cerrar()
+
+        serializador = serializacion.serializador
+        try:
+            async_to_sync(inner)()
+        finally:
+            serializacion.serializador = serializador
@@ -0,0 +1,28 @@
+from django.core.management import call_command, CommandError
+from partidas.game.simulador import simular
+from django.test import SimpleTestCase
+from io import StringIO
+
+class SimuladorTests(SimpleTestCase):
+
+    def test_simular(self):
+        """Los bots terminan todas las partidas pasando por todas las fases"""
+        for capacidad in (2, 4):
+            for bot in ('aleatorio', 'codicioso'):
+                r = simular(50, capacidad, bot)
+                self.assertEqual(sum(r['victorias'].values()), 50)
+                self.assertGreater(r['acciones'], 50 * 40 // capacidad)
+                self.assertGreater(r['arrastres'], 0)
+                self.assertGreater(r['cantos'], 0)
+                self.assertGreater(r['revueltas'], 0)
+                self.assertLessEqual(r['accion_p50_us'], r['accion_p99_us'])
+
+    def test_umbral(self):
+        """El comando falla si el rendimiento no llega al mínimo pedido"""
+        salida = StringIO()
+        call_command('simular_partidas', partidas=5, capacidad=[2], stdout=salida)
+        self.assertIn('acciones/s', salida.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('simular_partidas', partidas=5, capacidad=[2],
+                         min_acciones_por_segundo=1e12, stdout=StringIO())
@@ -0,0 +1,44 @@
+from partidas.game.temporizador import ServicioTemporizadores
+from django.test import SimpleTestCase
+import asyncio
+
+class ServicioTemporizadoresTests(SimpleTestCase):
+
+    def test_vence_una_sola_vez(self):
+        """Un plazo ejecuta su acción una única vez y registra la deriva"""
+        servicio = ServicioTemporizadores()
+        disparos = []
+
+        async def inner():
+            async def accion():
+                disparos.append('a')
+            servicio.programar('partida', 0.01, accion)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(inner())
+        self.assertEqual(disparos, ['a'])
+        metricas = servicio.metricas()
+        self.assertEqual(metricas['disparados'], 1)
+        self.assertEqual(metricas['pendientes'], 0)
+        self.assertGreaterEqual(metricas['deriva_max_ms'], 0)
+
+    def test_reprogramar_y_cancelar(self):
+        """Reprogramar sustituye el plazo anterior y cancelar lo anula"""
+        servicio = ServicioTemporizadores()
+        disparos = []
+
+        async def inner():
+            def accion(nombre):
+                async def disparar():
+                    disparos.append(nombre)
+                return disparar
+            servicio.programar('p1', 0.01, accion('viejo'))
+            servicio.programar('p1', 0.02, accion('nuevo'))
+            servicio.programar('p2', 0.01, accion('cancelado'))
+            self.assertTrue(servicio.cancelar('p2'))
+            self.assertFalse(servicio.cancelar('p2'))
+            await asyncio.sleep(0.06)
+
+        asyncio.run(inner())
+        self.assertEqual(disparos, ['nuevo'])
+        self.assertEqual(servicio.metricas()['cancelados'], 2)
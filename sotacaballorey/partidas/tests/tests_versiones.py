@@ -0,0 +1,105 @@
+from partidas.game.utils import guardar_con_version, cambio_de_pausa, metricas_versiones
+from partidas.game.sala import cargar_sala, obtener_sala
+from partidas.models import Partida, JugadorPartida, EventoPartida
+from partidas.game.registro import AUTOMATICA
+from partidas.game import sala as modulo_sala
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from asgiref.sync import async_to_sync
+from usuarios.models import Usuario
+from django.db.models import F
+
+class VersionesTests(TransactionTestCase):
+
+    reset_sequences = True
+
+    fixtures = [
+            'aspecto_carta/fixtures/initial_data.json',
+            'tapete/fixtures/initial_data.json'
+        ]
+    for fixture in fixtures:
+            call_command('loaddata', fixture)
+
+    def setUp(self):
+        self.partida = Partida.objects.create(capacidad=2, estado='pausada', jugadores_pausa=['1', '2'])
+        for i in (1, 2):
+            usuario = Usuario.objects.create(
+                nombre=f'Usuario {i}', correo=f'user{i}@gmail.com', contrasegna='123')
+            JugadorPartida.objects.create(partida=self.partida, usuario=usuario, equipo=i)
+
+    def test_reintento_tras_conflicto(self):
+        """Dos escrituras a partir de la misma lectura no se pisan"""
+        conflictos = metricas_versiones()['conflictos_por_minuto']
+        p1 = Partida.objects.get(id=self.partida.id)
+        p2 = Partida.objects.get(id=self.partida.id)
+
+        p1.jugadores_pausa.remove('1')
+        self.assertTrue(async_to_sync(guardar_con_version)(
+            p1, ['jugadores_pausa'], cambio_de_pausa(1, False)))
+
+        # p2 está desactualizada: se relee y se vuelve a quitar al jugador 2
+        p2.jugadores_pausa.remove('2')
+        self.assertTrue(async_to_sync(guardar_con_version)(
+            p2, ['jugadores_pausa'], cambio_de_pausa(2, False)))
+
+        self.partida.refresh_from_db()
+        self.assertEqual(self.partida.jugadores_pausa, [])
+        self.assertEqual(self.partida.version, 2)
+        self.assertEqual(metricas_versiones()['conflictos_por_minuto'], conflictos + 1)
+
+    def test_sala_desactualizada(self):
+        """Si otro cambia la partida, la sala no la sobrescribe y se descarta"""
+        Partida.objects.filter(id=self.partida.id).update(estado='jugando')
+
+        async def inner():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=1)
+            await sala.volcar()
+            self.assertIs(obtener_sala(self.partida.id), sala)
+
+            await Partida.objects.filter(id=self.partida.id).aupdate(version=F('version') + 1)
+            sala.juego.puntos = [50, 0]
+            await sala.volcar()
+            self.assertIsNone(obtener_sala(self.partida.id))
+
+        async_to_sync(inner)()
+        self.partida.refresh_from_db()
+        self.assertEqual(self.partida.puntos_equipo_1, 0)
+        self.assertIn('triunfo', self.partida.estado_json)
+
+    def test_volcado_fallido(self):
+        """Si un volcado falla, la sala sigue y el siguiente escribe lo que faltaba"""
+        Partida.objects.filter(id=self.partida.id).update(estado='jugando')
+        escribir_cambios = modulo_sala.escribir_cambios
+
+        async def fallar(*args, **kwargs):
+            raise RuntimeError('base de datos caída')
+
+        async def inner():
+            sala = await cargar_sala(self.partida.id)
+            sala.repartir(semilla=1)
+            await sala.volcar()
+            version = sala.partida.version
+
+            modulo_sala.escribir_cambios = fallar
+            try:
+                sala.registrar(AUTOMATICA, 0)
+                sala.juego.puntos = [50, 0]
+                await sala.volcar()
+            finally:
+                modulo_sala.escribir_cambios = escribir_cambios
+            self.assertEqual(sala.partida.version, version)
+
+            sala.registrar(AUTOMATICA, 1)
+            await sala.volcar()
+            self.assertIs(obtener_sala(self.partida.id), sala)
+            self.assertEqual(sala.partida.version, version + 1)
+            await sala.cerrar()
+            return sala.num_eventos
+
+        num_eventos = async_to_sync(inner)()
+        self.partida.refresh_from_db()
+        self.assertEqual(self.partida.puntos_equipo_1, 50)
+        numeros = list(EventoPartida.objects.filter(partida=self.partida)
+                       .order_by('numero').values_list('numero', flat=True))
+        self.assertEqual(numeros, list(range(1, num_eventos + 1)))
@@ -2,6 +2,7 @@ from partidas.models import Partida, JugadorPartida
 from django.test import TestCase, Client
 from utils.jwt_auth import generar_token
 from usuarios.models import Usuario
+from partidas.lobby import invalidar_salas_en_espera
 from django.core.management import call_command
 
 class SalaTests(TestCase):
@@ -164,4 +165,100 @@ class SalaTests(TestCase):
         self.assertIn(p1.id, ids)
         self.assertNotIn(p2.id, ids)
         self.assertNotIn(p3.id, ids)
-        self.assertEqual(len(salas), 1)
\ No newline at end of file
+        self.assertEqual(len(salas), 1)
+
+    def test_paginacion_y_consultas(self):
+        """
+        Los listados leen salas y jugadores en dos consultas, se paginan con un
+        cursor y la lista de salas en espera se cachea hasta que alguien entra
+        """
+        otros = [
+            Usuario.objects.create(nombre=f'Otro {i}', correo=f'otro{i}@gmail.com', contrasegna='123')
+            for i in range(3)
+        ]
+        self.usuario.amigos.add(otros[0])
+        partidas = [Partida.objects.create(capacidad=4, estado='esperando') for _ in range(7)]
+        for p in partidas:
+            for u in otros:
+                JugadorPartida.objects.create(partida=p, usuario=u)
+        invalidar_salas_en_espera()
+
+        # Primera página: partidas y jugadores en dos consultas
+        with self.assertNumQueries(2):
+            respuesta = self.cliente.get('/salas/disponibles/?limite=3', HTTP_AUTH=self.token)
+        datos = respuesta.json()
+        self.assertEqual([s['id'] for s in datos['salas']], [p.id for p in partidas[:3]])
+        self.assertEqual(datos['salas'][0]['num_jugadores'], 3)
+        self.assertEqual(datos['salas'][0]['jugadores'], ['Otro 0', 'Otro 1', 'Otro 2'])
+        self.assertEqual(datos['siguiente'], partidas[2].id)
+
+        # Las siguientes páginas salen de la caché
+        with self.assertNumQueries(0):
+            respuesta = self.cliente.get(
+                f'/salas/disponibles/?limite=3&cursor={partidas[5].id}', HTTP_AUTH=self.token)
+        datos = respuesta.json()
+        self.assertEqual([s['id'] for s in datos['salas']], [partidas[6].id])
+        self.assertIsNone(datos['siguiente'])
+
+        # Las salas de amigos cuentan todos los jugadores, no solo los amigos
+        respuesta = self.cliente.get('/salas/disponibles/amigos/', HTTP_AUTH=self.token)
+        self.assertEqual(len(respuesta.json()['salas']), 7)
+        self.assertEqual(respuesta.json()['salas'][0]['num_jugadores'], 3)
+
+        # Entrar en una sala invalida la caché
+        JugadorPartida.objects.create(partida=partidas[0], usuario=self.usuario)
+        respuesta = self.cliente.get('/salas/disponibles/', HTTP_AUTH=self.token)
+        self.assertNotIn(partidas[0].id, [s['id'] for s in respuesta.json()['salas']])
+        self.assertEqual(len(respuesta.json()['salas']), 6)
+
+        # Reconectables y pausadas también paginan en dos consultas
+        for p in partidas:
+            p.estado = 'pausada'
+            p.save()
+        JugadorPartida.objects.filter(partida__in=partidas[1:]).delete()
+        for p in partidas[1:]:
+            JugadorPartida.objects.create(partida=p, usuario=self.usuario)
+        with self.assertNumQueries(2):
+            respuesta = self.cliente.get('/salas/pausadas/?limite=4', HTTP_AUTH=self.token)
+        self.assertEqual(len(respuesta.json()['salas']), 4)
+        self.assertEqual(respuesta.json()['siguiente'], partidas[3].id)
+
+    def test_cache_con_partidas_en_curso(self):
+        """
+        Las escrituras de las partidas en curso y las reconexiones no invalidan
+        la lista de salas en espera; los cambios de las salas en espera sí
+        """
+        otro = Usuario.objects.create(nombre='Otro', correo='otro@gmail.com', contrasegna='123')
+        espera = Partida.objects.create(capacidad=2, estado='esperando')
+        esperando = JugadorPartida.objects.create(partida=espera, usuario=otro)
+        curso = Partida.objects.create(capacidad=2, estado='jugando')
+        jugando = JugadorPartida.objects.create(partida=curso, usuario=self.usuario)
+        invalidar_salas_en_espera()
+
+        def listar():
+            return self.cliente.get('/salas/disponibles/', HTTP_AUTH=self.token).json()['salas']
+        with self.assertNumQueries(2):
+            listar()
+
+        # Partida en curso: volcados, puntos, conexiones y su final
+        curso.puntos_equipo_1 = 10
+        curso.save(update_fields=['puntos_equipo_1'])
+        curso.save()
+        jugando.conectado = False
+        jugando.save(update_fields=['conectado'])
+        curso.marcar_como_finalizada()
+        # En la sala en espera, reconectarse no cambia la lista
+        esperando.channel_name = 'canal'
+        esperando.save(update_fields=['channel_name', 'conectado'])
+        with self.assertNumQueries(0):
+            self.assertEqual([s['id'] for s in listar()], [espera.id])
+
+        # Cambiar la configuración o el estado de la sala en espera sí
+        espera.solo_amigos = True
+        espera.save(update_fields=['solo_amigos'])
+        with self.assertNumQueries(2):
+            listar()
+        espera = Partida.objects.get(id=espera.id)
+        espera.estado = 'pausada'
+        espera.save()
+        self.assertEqual(listar(), [])
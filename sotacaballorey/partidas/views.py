@@ -1,7 +1,8 @@
+from .lobby import salas_en_espera, pagina_de_lista, pagina_de_consulta, parametros_pagina
 from django.views.decorators.csrf import csrf_exempt
 from utils.jwt_auth import token_required
+from partidas.metricas import obtener_metricas
 from django.http import JsonResponse
-from django.db.models import Count
 from .models import Partida
 
 @csrf_exempt
@@ -12,7 +13,9 @@ def listar_salas_disponibles(request):
     ├─ Método HTTP: GET
     ├─ Cabecera petición con Auth:<token>
     ├─ QueryParam opcional: capacidad (2|4)
+    ├─ QueryParams opcionales: cursor (id de la última sala recibida), limite
     └─ Devuelve lista de salas disponibles con ID, nombre, capacidad y jugadores actuales
+       y el cursor de la página siguiente (null si no hay más)
     """
 
     # Método incorrecto
@@ -21,26 +24,19 @@ def listar_salas_disponibles(request):
     
     # Obtener parámetros de la URL
     capacidad = request.GET.get('capacidad')
+    cursor, limite = parametros_pagina(request)
 
-    if capacidad == '2':
-        partidas = Partida.objects.filter(
-            estado='esperando', capacidad=2, solo_amigos=False)
-    elif capacidad == '4':
-        partidas = Partida.objects.filter(
-            estado='esperando', capacidad=4, solo_amigos=False)
-    else:
-        partidas = Partida.objects.filter(
-            estado='esperando', solo_amigos=False)
-
-    partidas = partidas.exclude(jugadores__usuario=request.usuario)
-    partidas = partidas.annotate(num_jugadores=Count('jugadores'))
+    # Salas en espera (caché compartida) que no son solo de amigos, de la
+    # capacidad pedida y en las que no está el usuario
+    salas = [
+        sala for sala, usuarios, solo_amigos in salas_en_espera()
+        if not solo_amigos and request.usuario.id not in usuarios and
+            (capacidad not in ('2', '4') or sala['capacidad'] == int(capacidad))
+    ]
 
     # Devolver salas
-    salas_json = [
-        construir_sala_json(p)
-    for p in partidas]
-
-    return JsonResponse({'salas': salas_json}, status=200)
+    salas_json, siguiente = pagina_de_lista(salas, cursor, limite)
+    return JsonResponse({'salas': salas_json, 'siguiente': siguiente}, status=200)
 
 @csrf_exempt
 @token_required
@@ -60,14 +56,11 @@ def listar_salas_reconectables(request):
         estado='jugando',
         jugadores__usuario=request.usuario,
         jugadores__conectado=False
-    ).annotate(num_jugadores=Count('jugadores'))
+    )
 
     # Devolver salas
-    salas_json = [
-        construir_sala_json(p)
-    for p in partidas]
-
-    return JsonResponse({'salas': salas_json}, status=200)
+    salas_json, siguiente = pagina_de_consulta(partidas, *parametros_pagina(request))
+    return JsonResponse({'salas': salas_json, 'siguiente': siguiente}, status=200)
 
 @csrf_exempt
 @token_required
@@ -86,14 +79,11 @@ def listar_salas_pausadas(request):
     partidas = Partida.objects.filter(
         estado='pausada',
         jugadores__usuario=request.usuario
-    ).annotate(num_jugadores=Count('jugadores'))
+    )
 
     # Devolver salas
-    salas_json = [
-        construir_sala_json(p)
-    for p in partidas]
-
-    return JsonResponse({'salas': salas_json}, status=200)
+    salas_json, siguiente = pagina_de_consulta(partidas, *parametros_pagina(request))
+    return JsonResponse({'salas': salas_json, 'siguiente': siguiente}, status=200)
 
 @csrf_exempt
 @token_required
@@ -110,47 +100,30 @@ def listar_salas_amigos(request):
         return JsonResponse({'error': 'Método no permitido'}, status=405)
 
     usuario = request.usuario
-    amigos = usuario.amigos.all()
+    amigos = set(usuario.amigos.values_list('id', flat=True))
 
     # Partidas en espera donde hay al menos un amigo y el usuario no está
-    partidas = Partida.objects.filter(
-        estado='esperando',
-        jugadores__usuario__in=amigos
-    ).exclude(
-        jugadores__usuario=usuario
-    ).annotate(
-        num_jugadores=Count('jugadores')
-    ).distinct()
+    salas = [
+        sala for sala, usuarios, _ in salas_en_espera()
+        if usuario.id not in usuarios and amigos.intersection(usuarios)
+    ]
 
     # Listar salas
-    salas_json = [
-        construir_sala_json(p)
-    for p in partidas]
-
-    return JsonResponse({'salas': salas_json}, status=200)
+    salas_json, siguiente = pagina_de_lista(salas, *parametros_pagina(request))
+    return JsonResponse({'salas': salas_json, 'siguiente': siguiente}, status=200)
 
-def construir_sala_json(partida: Partida, amigos=None):
+@csrf_exempt
+@token_required
+def metricas(request):
     """
-    Te devuelve la información de una sala en formato JSON
-    Añade información extra si la partida es personalizada
+    Métricas de los servicios de partidas de este proceso
+    ├─ Método HTTP: GET
+    ├─ Cabecera petición con Auth:<token>
+    └─ Devuelve las métricas agrupadas por servicio
     """
-    jugadores = partida.jugadores.all()
-    nombre_jugadores = [j.usuario.nombre for j in jugadores]
-
-    sala = {
-        'id': partida.id,
-        'nombre': f'Sala {partida.id}',
-        'capacidad': partida.capacidad,
-        'num_jugadores': partida.num_jugadores,
-        'jugadores': nombre_jugadores
-    }
-
-    if partida.es_personalizada:
-        sala['personalizacion'] = {
-            'tiempo_turno': partida.tiempo_turno,
-            'reglas_arrastre': partida.reglas_arrastre,
-            'permitir_revueltas': partida.permitir_revueltas,
-            'solo_amigos': partida.solo_amigos
-        }
-    
-    return sala
+
+    # Método incorrecto
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Método no permitido'}, status=405)
+
+    return JsonResponse({'metricas': obtener_metricas()}, status=200)
\ No newline at end of file
@@ -7,6 +7,7 @@ django.setup()
 from chat_partida.routing import websocket_urlpatterns as ws_urls_chatPartida
 from chat_global.routing import websocket_urlpatterns as ws_urls_chatGlobal
 from partidas.routing import websocket_urlpatterns as ws_urls_partidas
+from partidas.game.recuperacion import RecuperarAlArrancar
 from channels.routing import ProtocolTypeRouter, URLRouter
 from chat_global.routing import websocket_urlpatterns
 from django.contrib.auth.models import AnonymousUser
@@ -41,13 +42,14 @@ class TokenAuthMiddleware:
         else:
             print(f"Token inválido o expirado. Cerrando conexión", flush=True)
             scope['usuario'] = AnonymousUser()
+            await send({'type': 'websocket.close', 'code': 403})
             return
 
         return await self.inner(scope, receive, send)
 
 
-application = ProtocolTypeRouter({
+application = RecuperarAlArrancar(ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": TokenAuthMiddleware(
         URLRouter(ws_urls_chatGlobal + ws_urls_partidas + ws_urls_chatPartida))
-})
\ No newline at end of file
+}))
\ No newline at end of file
@@ -1,3 +1,5 @@
+from django.core.exceptions import ImproperlyConfigured
+from importlib.util import find_spec
 from pathlib import Path
 from os import getenv, path
 
@@ -76,6 +78,52 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Caché compartida por todos los procesos (p. ej. la lista de salas en espera
+# del lobby, que se invalida desde el proceso que cambia una sala). Va en otra
+# base de datos del mismo Redis que la capa de canales
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f"redis://{getenv('REDIS_HOST', '127.0.0.1')}:"
+                    f"{getenv('REDIS_PORT', 6379)}/{getenv('REDIS_DB_CACHE', 1)}",
+        'KEY_PREFIX': 'sotacaballorey',
+    }
+}
+
+# Capa de canales y caché en memoria (un único proceso, p. ej. pruebas de carga en local)
+if getenv('CHANNEL_LAYER') == 'memoria':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        }
+    }
+
+# Reanudar al arrancar las partidas que estaban en curso (partidas.game.recuperacion)
+RECUPERAR_PARTIDAS = getenv('RECUPERAR_PARTIDAS', 'true').lower() == 'true'
+
+# Identificador de este proceso en las concesiones de partidas (partidas.game.propiedad).
+# Si se deja vacío es <host>-<pid>; con un valor fijo por proceso, al reiniciarse
+# recupera sus partidas sin esperar a que venzan las concesiones
+PROCESO_PARTIDAS = getenv('PROCESO_PARTIDAS', '')
+
+# Guardar las manos y el mazo de las partidas en curso como máscaras de bits y
+# bytes en lugar de listas JSON (partidas.game.sala). Se leen los dos formatos;
+# manage.py convertir_manos pasa las partidas guardadas de uno a otro
+ALMACENAMIENTO_COMPACTO = getenv('ALMACENAMIENTO_COMPACTO', 'false').lower() == 'true'
+
+# Serializador de los mensajes de los WebSockets (utils.serializacion):
+# 'auto' usa orjson si está instalado y si no json
+SERIALIZADOR_MENSAJES = getenv('SERIALIZADOR_MENSAJES', 'auto')
+
+# Ofrecer a los clientes de /ws/partida/ el protocolo compacto en MessagePack
+# (partidas.game.protocolo). Desactivado, los mensajes solo se codifican en JSON
+PROTOCOLO_COMPACTO = getenv('PROTOCOLO_COMPACTO', 'true').lower() == 'true'
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 DATABASES = {
@@ -84,11 +132,43 @@ DATABASES = {
         'NAME': getenv('POSTGRES_DB', 'Database'),
         'USER': getenv('POSTGRES_USER', 'admin'),
         'PASSWORD': getenv('POSTGRES_PASSWORD', 'contrasenya'),
-        'HOST': 'postgres_container',
-        'PORT': '5432',
+        'HOST': getenv('POSTGRES_HOST', 'postgres_container'),
+        'PORT': getenv('POSTGRES_PORT', '5432'),
+        # Conexiones persistentes: cada hilo que atiende consultas de los
+        # consumidores reutiliza la suya en vez de abrir una por llamada
+        'CONN_MAX_AGE': int(getenv('DB_CONN_MAX_AGE', 300)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
     }
 }
 
+# Pool de conexiones de psycopg 3 (necesita psycopg[pool]; con psycopg2 no
+# hay pool). Con pool las conexiones no son persistentes: las presta el pool
+if getenv('DB_POOL', 'false').lower() == 'true':
+    if find_spec('psycopg') is None or find_spec('psycopg_pool') is None:
+        raise ImproperlyConfigured(
+            'DB_POOL=true necesita psycopg 3 con pool: pip install "psycopg[binary,pool]"')
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(getenv('DB_POOL_MIN', 2)),
+        'max_size': int(getenv('DB_POOL_MAX', 10)),
+        'timeout': 10,
+    }
+
+# Detrás de pgbouncer en modo transacción no se pueden usar cursores del
+# servidor ni mantener estado de sesión entre transacciones
+if getenv('DB_PGBOUNCER', 'false').lower() == 'true':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Base de datos SQLite para ejecutar en local sin Postgres
+if getenv('DB_ENGINE') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': getenv('SQLITE_PATH', str(BASE_DIR / 'db.sqlite3')),
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
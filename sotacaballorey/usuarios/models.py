@@ -1,8 +1,68 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.db import models
 from django.core.validators import MinValueValidator
 from aspecto_carta.models import CardSkin
 from dorso_carta.models import CardBack
 from tapete.models import Tapete
+import time
+
+#-----------------------------------------------------------------------------------#
+# Rangos y desbloqueos                                                              #
+#-----------------------------------------------------------------------------------#
+
+# Elo mínimo de cada rango, de mayor a menor
+RANGOS_ELO = [
+    (2700, 'leyenda'),
+    (2100, 'octogenario'),
+    (1600, 'parroquiano'),
+    (1200, 'casual'),
+    (0,    'guiri')
+]
+
+# Aspectos y tapetes que se desbloquean al llegar a cada rango (se conservan
+# en los rangos superiores)
+DESBLOQUEOS = [
+    ('guiri',       ['Default'], ['Default']),
+    ('casual',      [],          ['Rojo-negro']),
+    ('parroquiano', ['Poker'],   []),
+    ('octogenario', [],          ['Azul-plata']),
+    ('leyenda',     ['Paint'],   ['Rojo-dorado'])
+]
+
+_catalogo = None
+
+def rango_de_elo(elo: int) -> str:
+    for minimo, rango in RANGOS_ELO:
+        if elo >= minimo:
+            return rango
+    return RANGOS_ELO[-1][1]
+
+def catalogo() -> dict:
+    """
+    Ids de los aspectos y tapetes de DESBLOQUEOS por nombre, leídos una vez
+    y guardados hasta que cambie alguno
+    """
+    global _catalogo
+    if _catalogo is None:
+        skins = dict(CardSkin.objects.filter(
+            name__in=[n for _, s, _ in DESBLOQUEOS for n in s]).values_list('name', 'id'))
+        tapetes = dict(Tapete.objects.filter(
+            name__in=[n for _, _, t in DESBLOQUEOS for n in t]).values_list('name', 'id'))
+        por_rango, acumulado_s, acumulado_t = {}, set(), set()
+        for rango, nombres_s, nombres_t in DESBLOQUEOS:
+            acumulado_s |= {skins[n] for n in nombres_s}
+            acumulado_t |= {tapetes[n] for n in nombres_t}
+            por_rango[rango] = (frozenset(acumulado_s), frozenset(acumulado_t))
+        _catalogo = {
+            'por_rango': por_rango,
+            'defecto': (skins['Default'], tapetes['Default'])
+        }
+    return _catalogo
+
+def desbloqueos_de_rango(rango: str) -> tuple:
+    """(ids de aspectos, ids de tapetes) que corresponden a <rango>"""
+    return catalogo()['por_rango'][rango]
 
 class Usuario(models.Model):
     ELO_RANKS = [
@@ -45,69 +105,87 @@ class Usuario(models.Model):
     elo_parejas = models.IntegerField(default=1200, validators=[MinValueValidator(0)])
     elo_rank = models.CharField(max_length=20, choices=ELO_RANKS, default='casual')
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Se recuerda el rango guardado para desbloquear solo cuando cambia
+        usuario = super().from_db(db, field_names, values)
+        usuario._rango_guardado = usuario.__dict__.get('elo_rank')
+        return usuario
+
     def save(self, *args, **kwargs):
-        # Update ELO rank based on current ELO
-        is_new = self.pk is None  # Check if this is a new user instance
-        if is_new:
-            super().save(*args, **kwargs)  # Save the user to get an ID
-            self.save()
+        self.elo_rank = rango_de_elo(self.elo)
+
+        # Un usuario nuevo se guarda primero para tener id
+        if self.pk is None:
+            super().save(*args, **kwargs)
+            if self.desbloquear_rango():
+                super().save(update_fields=['equipped_skin', 'equipped_tapete'])
+            self._rango_guardado = self.elo_rank
             return
 
-        if self.elo >= 2700:
-            self.elo_rank = 'leyenda'
-        elif self.elo >= 2100:
-            self.elo_rank = 'octogenario'
-        elif self.elo >= 1600:
-            self.elo_rank = 'parroquiano'
-        elif self.elo >= 1200:
-            self.elo_rank = 'casual'
-        else:
-            self.elo_rank = 'guiri'
-        
-         # Unlock Default Skin and Tapete for all users
-        # Ensure the default skin and tapete are only added if they are not already unlocked
-        default_skin = CardSkin.objects.get(name="Default")  # Ensure this skin exists
-        default_tapete = Tapete.objects.get(name="Default")  # Ensure this tapete exists
-
-        # Only add if not already unlocked
-        if default_skin not in self.unlocked_skins.all():
-            self.unlocked_skins.add(default_skin)
-            self.equipped_skin = default_skin
-
-        if default_tapete not in self.unlocked_tapetes.all():
-            self.unlocked_tapetes.add(default_tapete)
-            self.equipped_tapete = default_tapete
-
-        # Unlock Poker Skin for "Parroquiano"
-        if self.elo_rank == 'casual' or self.elo_rank == 'parroquiano' or self.elo_rank == 'octogenario' or self.elo_rank == 'leyenda':
-            red_black_tapete = Tapete.objects.get(name="Rojo-negro")  # Ensure this skin exists
-            if red_black_tapete not in self.unlocked_tapetes.all():
-                self.unlocked_tapetes.add(red_black_tapete)
-
-        if self.elo_rank == 'parroquiano' or self.elo_rank == 'octogenario' or self.elo_rank == 'leyenda':
-            poker_skin = CardSkin.objects.get(name="Poker")  # Ensure this skin exists
-            if poker_skin not in self.unlocked_skins.all():
-                self.unlocked_skins.add(poker_skin)
-
-        if self.elo_rank == 'octogenario' or self.elo_rank == 'leyenda':
-            blue_silver_tapete = Tapete.objects.get(name="Azul-plata")  # Ensure this skin exists
-            if blue_silver_tapete not in self.unlocked_tapetes.all():
-                self.unlocked_tapetes.add(blue_silver_tapete)
-
-        # Unlock Paint Skin for "Leyenda"
-        if self.elo_rank == 'leyenda':
-            paint_skin = CardSkin.objects.get(name="Paint")  # Ensure this skin exists
-            if paint_skin not in self.unlocked_skins.all():
-                self.unlocked_skins.add(paint_skin)
-
-            red_gold_tapete = Tapete.objects.get(name="Rojo-dorado")  # Ensure this skin exists
-            if red_gold_tapete not in self.unlocked_tapetes.all():
-                self.unlocked_tapetes.add(red_gold_tapete)
-
-        # Save the updated user
-        super().save(*args, **kwargs)
+        if self.elo_rank != getattr(self, '_rango_guardado', None):
+            equipados = (self.equipped_skin_id, self.equipped_tapete_id)
+            self.desbloquear_rango()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                update_fields = set(update_fields) | {'elo_rank'}
+                if equipados != (self.equipped_skin_id, self.equipped_tapete_id):
+                    update_fields |= {'equipped_skin', 'equipped_tapete'}
+                kwargs['update_fields'] = update_fields
 
-        
+        super().save(*args, **kwargs)
+        self._rango_guardado = self.elo_rank
+
+    def desbloquear_rango(self) -> bool:
+        """
+        Añade los aspectos y tapetes del rango actual (y los anteriores) que el
+        usuario aún no tenga: una consulta para ver cuáles tiene y otra para
+        insertar los que faltan por cada relación. Si se acaba de desbloquear el
+        aspecto o tapete por defecto se equipa. Devuelve si se ha equipado algo
+        """
+        skins, tapetes = desbloqueos_de_rango(self.elo_rank)
+        nuevas_skins = self._desbloquear('unlocked_skins', skins)
+        nuevos_tapetes = self._desbloquear('unlocked_tapetes', tapetes)
+
+        defecto_skin, defecto_tapete = catalogo()['defecto']
+        equipado = False
+        if defecto_skin in nuevas_skins:
+            self.equipped_skin_id = defecto_skin
+            equipado = True
+        if defecto_tapete in nuevos_tapetes:
+            self.equipped_tapete_id = defecto_tapete
+            equipado = True
+        return equipado
+
+    def _desbloquear(self, relacion: str, ids: set) -> set:
+        """Inserta en la relación <relacion> los ids que falten. Devuelve los nuevos"""
+        campo = self._meta.get_field(relacion)
+        through = campo.remote_field.through
+        origen, destino = campo.m2m_field_name(), campo.m2m_reverse_field_name()
+        existentes = set(through.objects.filter(
+            **{origen: self.pk, f'{destino}__in': ids}
+        ).values_list(f'{destino}_id', flat=True))
+        nuevos = ids - existentes
+        through.objects.bulk_create(
+            [through(**{f'{origen}_id': self.pk, f'{destino}_id': i}) for i in nuevos])
+        return nuevos
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        # Un usuario autenticado por token solo trae el id (utils.jwt_auth): el
+        # primer campo diferido que se lee carga la fila entera y se guarda en
+        # la caché de usuarios autenticados
+        desde_token = getattr(self, 'desde_token', False)
+        if desde_token and fields is not None:
+            fields = set(fields) | self.get_deferred_fields()
+        cargado = time.monotonic()
+        super().refresh_from_db(using, fields, from_queryset)
+        if fields is None or 'elo_rank' in fields:
+            self._rango_guardado = self.__dict__.get('elo_rank')
+
+        if desde_token and not self.get_deferred_fields():
+            from utils.jwt_auth import recordar_usuario
+            self.desde_token = False
+            recordar_usuario(self, cargado)
     
     def __str__(self):
         return 'Usuario:\n' + \
@@ -129,4 +207,12 @@ class SolicitudAmistad(models.Model):
     def __str__(self):
         return 'Solicitud de amistad:\n' + \
             '├─Emisor  : ' + self.emisor.nombre + '\n' + \
-            '└─Receptor: ' + self.receptor.nombre + '\n'
\ No newline at end of file
+            '└─Receptor: ' + self.receptor.nombre + '\n'
+
+@receiver(post_save, sender=CardSkin)
+@receiver(post_delete, sender=CardSkin)
+@receiver(post_save, sender=Tapete)
+@receiver(post_delete, sender=Tapete)
+def _catalogo_modificado(sender, **kwargs):
+    global _catalogo
+    _catalogo = None
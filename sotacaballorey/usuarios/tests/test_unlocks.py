@@ -143,6 +143,38 @@ class TestUnlockSkinsAndTapetes(TestCase):
         self.assertIn(self.poker_skin, user.unlocked_skins.all())  # Poker skin should NOT be unlocked for Leyenda
         self.assertIn(self.blue_silver_tapete, user.unlocked_tapetes.all())  # Blue-silver tapete should NOT be unlocked for Leyenda
 
+    def test_unlock_only_on_rank_change(self):
+        """Unlocks run only when the rank changes and insert only the missing items"""
+        user = Usuario.objects.create(
+            nombre="Rank User",
+            correo="rank@example.com",
+            contrasegna="password",
+            elo=1200
+        )
+        self.assertEqual(user.equipped_skin, self.default_skin)
+        self.assertEqual(user.equipped_tapete, self.default_tapete)
+
+        # Same rank: a single UPDATE
+        user = Usuario.objects.get(id=user.id)
+        user.victorias += 1
+        with self.assertNumQueries(1):
+            user.save()
+
+        # New rank: one lookup per relation, one insert for the new skin, the UPDATE
+        user.elo = 1700
+        with self.assertNumQueries(4):
+            user.save()
+        self.assertEqual(Usuario.objects.get(id=user.id).elo_rank, 'parroquiano')
+        self.assertIn(self.poker_skin, user.unlocked_skins.all())
+
+        # Going down and up again does not duplicate anything
+        user.elo = 1000
+        user.save()
+        user.elo = 1700
+        user.save()
+        self.assertEqual(user.unlocked_skins.count(), 2)
+        self.assertEqual(user.unlocked_tapetes.count(), 2)
+
     def tearDown(self):
         """Clean up after tests"""
         # Delete the test objects (skins, tapetes, users)
@@ -3,6 +3,7 @@ from usuarios.models import Usuario
 from django.urls import reverse
 import json
 from django.core.management import call_command
+from utils.jwt_auth import generar_token, validar_token, cargar_usuario, _usuarios
 
 class UsuarioTests(TestCase):
 
@@ -125,6 +126,15 @@ class UsuarioTests(TestCase):
         respuesta = self.cliente.delete('/usuarios/eliminar_usuario/', HTTP_AUTH=token)
         self.assertEqual(respuesta.status_code, 200)
 
+        # Su token deja de valer aunque no haya caducado
+        respuesta = self.cliente.delete('/usuarios/eliminar_usuario/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.status_code, 401)
+
+        # Tampoco si el borrado no consta en este proceso (reinicio u otro proceso)
+        _usuarios.clear()
+        respuesta = self.cliente.delete('/usuarios/eliminar_usuario/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.status_code, 401)
+
         # Error por token no válido o expirado
         respuesta = self.cliente.delete('/usuarios/eliminar_usuario/', HTTP_AUTH='123')
         self.assertEqual(respuesta.status_code, 401)
@@ -142,4 +152,49 @@ class UsuarioTests(TestCase):
     def test_obtener_id_por_nombre_no_existente(self):
         """Test retrieving user ID for a username that does not exist."""
         response = self.client.get(reverse('obtener_id_por_nombre', args=["UsuarioInexistente"]))
-        self.assertEqual(response.status_code, 404)  # Should return "Not Found"
\ No newline at end of file
+        self.assertEqual(response.status_code, 404)  # Should return "Not Found"
+
+    def test_token_tras_cambiar_nombre(self):
+        """El nombre y el correo no se toman del token: tras cambiarlos se ven los nuevos"""
+        token = generar_token(self.usuario1)
+        self.usuario1.nombre = 'Carlos Nuevo'
+        self.usuario1.correo = 'nuevo@example.com'
+        self.usuario1.save()
+
+        usuario = validar_token(token)
+        self.assertEqual((usuario.nombre, usuario.correo), ('Carlos Nuevo', 'nuevo@example.com'))
+
+        # Para los WebSocket la fila se carga de una vez al validar el token
+        _usuarios.clear()
+        usuario = validar_token(token)
+        with self.assertNumQueries(1):
+            cargar_usuario(usuario)
+        with self.assertNumQueries(0):
+            self.assertEqual(usuario.nombre, 'Carlos Nuevo')
+            self.assertEqual(validar_token(token).correo, 'nuevo@example.com')
+
+    def test_autenticacion_con_claims(self):
+        """
+        El token autentica sin consultar la base de datos; la fila se carga
+        solo si la vista la necesita y se invalida al guardar el usuario
+        """
+        token = generar_token(self.usuario1)
+
+        # Obtener amigos solo consulta los amigos
+        with self.assertNumQueries(1):
+            respuesta = self.cliente.get('/usuarios/obtener_amigos/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.status_code, 200)
+
+        # La primera vez que se lee el Elo se carga la fila; después se reutiliza
+        with self.assertNumQueries(1):
+            respuesta = self.cliente.get('/usuarios/elo/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.json()['elo'], 1200)
+        with self.assertNumQueries(0):
+            respuesta = self.cliente.get('/usuarios/elo/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.json()['elo'], 1200)
+
+        # Guardar el usuario invalida la caché
+        self.usuario1.elo = 1700
+        self.usuario1.save()
+        respuesta = self.cliente.get('/usuarios/elo/', HTTP_AUTH=token)
+        self.assertEqual(respuesta.json()['elo'], 1700)
@@ -1,36 +1,157 @@
+from django.db.models.signals import post_save, post_delete
+from channels.db import database_sync_to_async
 from django.http import JsonResponse
+from django.dispatch import receiver
 from usuarios.models import Usuario
 from django.utils import timezone
 from django.conf import settings
 import datetime
+import copy
+import time
 import jwt
 
+DURACION_TOKEN = datetime.timedelta(hours=2)
+
 def generar_token(usuario: Usuario):
     payload = {
         'id': usuario.id,
         'nombre': usuario.nombre,
         'correo': usuario.correo,
-        'exp': timezone.now() + datetime.timedelta(hours=2),
+        'exp': timezone.now() + DURACION_TOKEN,
         'iat': timezone.now()
     }
     token = jwt.encode(payload, settings.SECRET_KEY, algorithm="HS256")
     return token
 
+#-----------------------------------------------------------------------------------#
+# Caché de usuarios autenticados                                                    #
+#-----------------------------------------------------------------------------------#
+
+# El token va firmado con el id del usuario, así que para autenticar no hace
+# falta leer su fila. Del token solo se toma el id: el nombre y el correo que
+# lleva pueden haber cambiado desde que se firmó. La fila completa se carga la
+# primera vez que la vista lee cualquier otro campo (o al conectarse a un
+# WebSocket) y se reutiliza durante TTL_CACHE_USUARIOS segundos. Guardar o
+# borrar un usuario invalida su entrada (los update() masivos no disparan
+# señales: hay que llamar a olvidar_usuario).
+#
+# La marca de usuario borrado solo está en la memoria del proceso que lo
+# borró: tras un reinicio o en otro proceso su token sigue siendo válido
+# hasta que caduca. Por eso, antes de escribir algo del usuario (peticiones
+# que no son de lectura, entrar en una partida o un chat) se comprueba que
+# sigue existiendo con usuario_existe
+
+CLAIMS_USUARIO = ('id',)
+METODOS_LECTURA = ('GET', 'HEAD', 'OPTIONS')
+TTL_CACHE_USUARIOS = 30
+MAX_CACHE_USUARIOS = 10000
+
+_usuarios = {}          # id -> (caduca, Usuario o None si se ha borrado)
+_invalidaciones = {}    # id -> instante de la última invalidación
+
+def usuario_desde_claims(payload: dict):
+    """
+    Usuario del token sin consultar la base de datos. None si se ha borrado
+    """
+    entrada = _usuarios.get(payload['id'])
+    if entrada and entrada[0] > time.monotonic():
+        return copy.copy(entrada[1]) if entrada[1] is not None else None
+
+    # Resto de campos diferidos: se cargan todos juntos al leer el primero
+    usuario = Usuario.from_db(None, CLAIMS_USUARIO, [payload[c] for c in CLAIMS_USUARIO])
+    usuario.desde_token = True
+    return usuario
+
+def recordar_usuario(usuario: Usuario, cargado: float):
+    """
+    Guarda una copia de la fila completa del usuario, cargada en el instante
+    <cargado>, salvo que se haya invalidado mientras se leía
+    """
+    if _invalidaciones.get(usuario.id, 0) >= cargado:
+        return
+    if len(_usuarios) >= MAX_CACHE_USUARIOS:
+        _purgar_cache()
+
+    copia = copy.copy(usuario)
+    copia.desde_token = False
+    copia._state.fields_cache = {}
+    copia.__dict__.pop('_prefetched_objects_cache', None)
+    _usuarios[usuario.id] = (time.monotonic() + TTL_CACHE_USUARIOS, copia)
+
+def olvidar_usuario(usuario_id: int, borrado: bool = False):
+    """
+    Invalida la entrada del usuario. Si se ha borrado se recuerda durante lo
+    que dura un token para rechazar los que sigan circulando
+    """
+    ahora = time.monotonic()
+    _invalidaciones[usuario_id] = ahora
+    if borrado:
+        _usuarios[usuario_id] = (ahora + DURACION_TOKEN.total_seconds(), None)
+    else:
+        _usuarios.pop(usuario_id, None)
+
+def cargar_usuario(usuario: Usuario):
+    """
+    Carga la fila completa del usuario del token si aún no la tiene. None si
+    se ha borrado
+    """
+    if getattr(usuario, 'desde_token', False):
+        try:
+            usuario.refresh_from_db(fields=usuario.get_deferred_fields())
+        except Usuario.DoesNotExist:
+            olvidar_usuario(usuario.id, borrado=True)
+            return None
+    return usuario
+
+def usuario_existe(usuario: Usuario) -> bool:
+    """
+    Comprueba en la base de datos que el usuario del token sigue existiendo.
+    Si no, se recuerda como borrado en este proceso
+    """
+    if Usuario.objects.filter(id=usuario.id).exists():
+        return True
+    olvidar_usuario(usuario.id, borrado=True)
+    return False
+
+# Desde los consumidores, con la revisión de la conexión de cada llamada
+usuario_existe_async = database_sync_to_async(usuario_existe)
+
+def _purgar_cache():
+    ahora = time.monotonic()
+    for usuario_id, (caduca, _) in list(_usuarios.items()):
+        if caduca <= ahora:
+            _usuarios.pop(usuario_id, None)
+    for usuario_id, instante in list(_invalidaciones.items()):
+        if instante + TTL_CACHE_USUARIOS <= ahora:
+            _invalidaciones.pop(usuario_id, None)
+
+@receiver(post_save, sender=Usuario)
+def _usuario_guardado(sender, instance, **kwargs):
+    olvidar_usuario(instance.id)
+
+@receiver(post_delete, sender=Usuario)
+def _usuario_borrado(sender, instance, **kwargs):
+    olvidar_usuario(instance.id, borrado=True)
+
+#-----------------------------------------------------------------------------------#
+# Validación                                                                        #
+#-----------------------------------------------------------------------------------#
+
 def validar_token(token: str):
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-        usuario = Usuario.objects.get(id=payload['id'])
-        return usuario
-    except(jwt.ExpiredSignatureError, jwt.InvalidTokenError, Usuario.DoesNotExist):
+        return usuario_desde_claims(payload)
+    except(jwt.ExpiredSignatureError, jwt.InvalidTokenError, KeyError):
         return None
     
 async def validar_token_async(token: str):
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-        usuario = await Usuario.objects.aget(id=payload['id'])
-        return usuario
-    except(jwt.ExpiredSignatureError, jwt.InvalidTokenError, Usuario.DoesNotExist):
-        return None
+    # Los consumidores leen el nombre desde el bucle de eventos, donde no se
+    # pueden cargar campos diferidos: si el usuario no está en la caché se
+    # carga su fila aquí
+    usuario = validar_token(token)
+    if usuario is not None and usuario.desde_token:
+        usuario = await database_sync_to_async(cargar_usuario)(usuario)
+    return usuario
 
 def token_required(func):
     def wrapper(request, *args, **kwargs):
@@ -44,9 +165,13 @@ def token_required(func):
         usuario = validar_token(token)
         if not usuario:
             return JsonResponse({'error': 'Token no válido o ha expirado'}, status=401)
+
+        # Antes de escribir nada se comprueba que el usuario no se ha borrado
+        if request.method not in METODOS_LECTURA and not usuario_existe(usuario):
+            return JsonResponse({'error': 'Token no válido o ha expirado'}, status=401)
         
         # Añadimos el usuario a la solicitud
         request.usuario = usuario
         return func(request, *args, **kwargs)
 
-    return wrapper
\ No newline at end of file
+    return wrapper
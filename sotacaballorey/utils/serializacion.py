@@ -0,0 +1,64 @@
+"""
+Serialización de los mensajes de los WebSockets.
+
+Todos los consumidores codifican y decodifican con <codificar> y
+<decodificar>. El serializador se elige con SERIALIZADOR_MENSAJES: 'orjson'
+si está instalado (bastante más rápido), 'json' de la biblioteca estándar o
+'auto' para usar orjson cuando esté disponible. Los mensajes a un grupo se
+codifican una vez y cada miembro recibe el texto ya codificado
+"""
+from django.conf import settings
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError hereda de este, así que sirve para los dos
+ErrorDecodificacion = json.JSONDecodeError
+
+class SerializadorJSON:
+    """json de la biblioteca estándar, compacto"""
+
+    nombre = 'json'
+
+    def codificar(self, obj) -> str:
+        return json.dumps(obj, separators=(',', ':'))
+
+    def decodificar(self, texto):
+        return json.loads(texto)
+
+class SerializadorOrjson:
+    """orjson: codifica directamente a UTF-8 y admite claves no textuales"""
+
+    nombre = 'orjson'
+
+    def codificar(self, obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def decodificar(self, texto):
+        return orjson.loads(texto)
+
+SERIALIZADORES = {'json': SerializadorJSON}
+if orjson:
+    SERIALIZADORES['orjson'] = SerializadorOrjson
+
+def elegir_serializador(nombre: str = 'auto'):
+    """Serializador con ese nombre ('auto': el más rápido disponible)"""
+    if nombre == 'auto':
+        nombre = 'orjson' if orjson else 'json'
+    if nombre not in SERIALIZADORES:
+        raise ValueError(f"Serializador de mensajes no disponible: {nombre}")
+    return SERIALIZADORES[nombre]()
+
+# Serializador del proceso
+serializador = elegir_serializador(getattr(settings, 'SERIALIZADOR_MENSAJES', 'auto'))
+
+def codificar(obj) -> str:
+    """Codifica un mensaje como texto JSON"""
+    return serializador.codificar(obj)
+
+def decodificar(texto):
+    """Decodifica un mensaje JSON (lanza ErrorDecodificacion si no es válido)"""
+    return serializador.decodificar(texto)